@@ -16,6 +16,7 @@ from .models import (
     TypeInfrastructure,
     ZoneContributive,
 )
+from .photos import prefetch_photo_objects
 
 admin.site.site_header = "CEEDD Stream Backend Administration"
 admin.site.site_title = "CEEDD Stream Admin Portal"
@@ -181,6 +182,10 @@ class PhotoAdmin(admin.ModelAdmin):
     readonly_fields = ("content_type", "object_id", "content_object")
     list_per_page = 20
 
+    def get_queryset(self, request):
+        # content_object is listed: one query per content type, not per row
+        return prefetch_photo_objects(super().get_queryset(request))
+
 
 admin.site.register(Photo, PhotoAdmin)
 
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CeeddStreamConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ceedd_stream'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,367 @@
+"""
+Set-based writes of batches of rows.
+
+A batch is validated row by row, but the instances its foreign keys refer
+to are loaded beforehand with one query per relation, and the valid rows
+are written with a few bulk statements: an upsert (INSERT ... ON CONFLICT
+DO UPDATE) on the model's unique_together key when it has one, otherwise
+inserts, and `bulk_update` for the rows that carry an `id`.
+"""
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.dispatch import Signal
+from django.utils import timezone
+from rest_framework import serializers, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.validators import UniqueTogetherValidator, UniqueValidator
+
+# Bulk statements send no pre_save or post_save signal. Instead, within the
+# transaction of the write, `bulk_saving` is sent with the `pks` of the
+# existing rows about to be overwritten, locked until it commits, and
+# `bulk_saved` with the `pks` of all the rows written
+bulk_saving = Signal()
+bulk_saved = Signal()
+
+MAX_BATCH_ROWS = 5000
+# Rows per INSERT statement
+WRITE_BATCH_SIZE = 500
+
+
+def get_upsert_key(model):
+    """Returns the fields of the first unique_together of `model`, if any."""
+    unique_together = model._meta.unique_together
+    return list(unique_together[0]) if unique_together else None
+
+
+def lock_overwritten(model, key, instances):
+    """
+    Locks the existing rows the upsert of `instances` on `key` (or their pk
+    without key) overwrites, and returns their pks.
+    """
+    if key is None:
+        pks = [instance.pk for instance in instances if instance.pk is not None]
+        return list(
+            model.objects.select_for_update()
+            .filter(pk__in=pks)
+            .values_list("pk", flat=True)
+        )
+
+    attnames = [model._meta.get_field(name).attname for name in key]
+    conditions = [
+        Q(**{attname: getattr(instance, attname) for attname in attnames})
+        for instance in instances
+        # A NULL never conflicts: the row is inserted
+        if all(getattr(instance, attname) is not None for attname in attnames)
+    ]
+    pks = []
+    for start in range(0, len(conditions), WRITE_BATCH_SIZE):
+        condition = Q()
+        for match in conditions[start : start + WRITE_BATCH_SIZE]:
+            condition |= match
+        pks += (
+            model.objects.select_for_update()
+            .filter(condition)
+            .values_list("pk", flat=True)
+        )
+    return pks
+
+
+class PreloadedRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    PrimaryKeyRelatedField resolving primary keys from the instances loaded
+    for the whole batch, instead of one query per row.
+    """
+
+    def __init__(self, instances, **kwargs):
+        self.instances = instances
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        try:
+            pk = self.get_queryset().model._meta.pk.to_python(data)
+        except DjangoValidationError:
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        try:
+            return self.instances[pk]
+        except KeyError:
+            self.fail("does_not_exist", pk_value=data)
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    ListSerializer whose foreign keys are resolved with one query per
+    relation and whose rows are written with set-based statements.
+    """
+
+    def preload_related(self, data):
+        items = [item for item in data if isinstance(item, dict)]
+        for name, field in list(self.child.fields.items()):
+            if field.read_only or isinstance(field, PreloadedRelatedField):
+                continue
+            if not isinstance(field, serializers.PrimaryKeyRelatedField):
+                continue
+
+            queryset = field.get_queryset()
+            pks = set()
+            for item in items:
+                try:
+                    pks.add(queryset.model._meta.pk.to_python(item[name]))
+                except (KeyError, DjangoValidationError):
+                    continue
+            pks.discard(None)
+
+            self.child.fields[name] = PreloadedRelatedField(
+                queryset.in_bulk(pks),
+                queryset=queryset,
+                source=None if field.source == name else field.source,
+                required=field.required,
+                allow_null=field.allow_null,
+                write_only=field.write_only,
+            )
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            self.preload_related(data)
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        with transaction.atomic():
+            instances = model.objects.bulk_create(
+                [model(**attrs) for attrs in validated_data],
+                batch_size=WRITE_BATCH_SIZE,
+            )
+            bulk_saved.send(sender=model, pks=[instance.pk for instance in instances])
+        return instances
+
+    def validate_rows(self, data):
+        """
+        Validates each row of `data` on its own. Returns the valid rows as
+        (index, validated data, pk) triples, `pk` being the `id` of the row
+        to update for models without an upsert key, and the errors of the
+        other rows as {"index", "errors"}.
+        """
+        model = self.child.Meta.model
+        key = get_upsert_key(model)
+        self.preload_related(data)
+        if key:
+            # Existing keys are updated, not rejected
+            self.child.validators = [
+                validator
+                for validator in self.child.validators
+                if not isinstance(validator, UniqueTogetherValidator)
+            ]
+            for field in self.child.fields.values():
+                field.validators = [
+                    validator
+                    for validator in field.validators
+                    if not isinstance(validator, UniqueValidator)
+                ]
+
+        rows = []
+        errors = {}
+        for index, item in enumerate(data):
+            try:
+                validated = self.run_child_validation(item)
+            except serializers.ValidationError as exc:
+                errors[index] = exc.detail
+                continue
+            pk = item.get("id") if key is None else None
+            rows.append((index, validated, pk))
+
+        if key:
+            errors.update(self.check_upsert_conflicts(rows, key))
+        else:
+            errors.update(self.check_existing(rows))
+
+        rows = [row for row in rows if row[0] not in errors]
+        errors = [{"index": index, "errors": errors[index]} for index in sorted(errors)]
+        return rows, errors
+
+    def check_existing(self, rows):
+        """Rejects the rows whose `id` does not exist."""
+        model = self.child.Meta.model
+        pks = set()
+        for _, _, pk in rows:
+            try:
+                pks.add(model._meta.pk.to_python(pk))
+            except DjangoValidationError:
+                continue
+        pks.discard(None)
+        existing = set(model.objects.filter(pk__in=pks).values_list("pk", flat=True))
+
+        errors = {}
+        for index, _, pk in rows:
+            if pk is None:
+                continue
+            try:
+                found = model._meta.pk.to_python(pk) in existing
+            except DjangoValidationError:
+                found = False
+            if not found:
+                errors[index] = {"id": [f'Invalid pk "{pk}" - object does not exist.']}
+        return errors
+
+    def check_upsert_conflicts(self, rows, key):
+        """
+        Rejects the rows an upsert on `key` can't write: a key repeated in
+        the batch, or the value of another unique field already taken by a
+        row with a different key.
+        """
+        model = self.child.Meta.model
+        key_fields = [model._meta.get_field(name) for name in key]
+        instances = {index: model(**validated) for index, validated, _ in rows}
+
+        def key_of(instance):
+            return tuple(getattr(instance, field.attname) for field in key_fields)
+
+        errors = {}
+        seen = {}
+        for index, instance in instances.items():
+            first = seen.setdefault(key_of(instance), index)
+            if first != index:
+                errors[index] = {
+                    "non_field_errors": [
+                        f"Same {', '.join(key)} as row {first} of the batch."
+                    ]
+                }
+
+        for field in model._meta.concrete_fields:
+            if not field.unique or field.primary_key:
+                continue
+            values = {
+                getattr(instance, field.attname) for instance in instances.values()
+            }
+            values.discard(None)
+            taken = {
+                value: tuple(owner)
+                for value, *owner in model.objects.filter(
+                    **{f"{field.attname}__in": values}
+                ).values_list(field.attname, *[f.attname for f in key_fields])
+            }
+            for index, instance in instances.items():
+                value = getattr(instance, field.attname)
+                if index in errors or value is None:
+                    continue
+                owner = taken.setdefault(value, key_of(instance))
+                if owner != key_of(instance):
+                    errors[index] = {
+                        field.name: [
+                            f"{model._meta.verbose_name} with this "
+                            f"{field.verbose_name} already exists."
+                        ]
+                    }
+        return errors
+
+    def save_rows(self, rows):
+        """
+        Writes rows returned by `validate_rows` in one transaction and
+        returns the saved instances by row index.
+        """
+        model = self.child.Meta.model
+        key = get_upsert_key(model)
+        auto_now = [
+            field.name
+            for field in model._meta.concrete_fields
+            if getattr(field, "auto_now", False)
+        ]
+
+        # One statement per set of fields sent, so that an update never
+        # overwrites a column its row did not send
+        groups = {}
+        for index, validated, pk in rows:
+            groups.setdefault(frozenset(validated), []).append((index, validated, pk))
+
+        instances = {index: model(pk=pk, **validated) for index, validated, pk in rows}
+        now = timezone.now()
+        with transaction.atomic():
+            if bulk_saving.has_listeners(model):
+                bulk_saving.send(
+                    sender=model,
+                    pks=lock_overwritten(model, key, list(instances.values())),
+                )
+
+            for fields, group in groups.items():
+                new = [
+                    instances[index]
+                    for index, _, _ in group
+                    if instances[index].pk is None
+                ]
+                existing = [
+                    instances[index]
+                    for index, _, _ in group
+                    if instances[index].pk is not None
+                ]
+                if key:
+                    # Sets the pk of the updated rows too, on PostgreSQL
+                    model.objects.bulk_create(
+                        new,
+                        batch_size=WRITE_BATCH_SIZE,
+                        update_conflicts=True,
+                        unique_fields=key,
+                        update_fields=[name for name in fields if name not in key]
+                        + auto_now,
+                    )
+                else:
+                    model.objects.bulk_create(new, batch_size=WRITE_BATCH_SIZE)
+
+                if existing:
+                    # bulk_update doesn't fill auto_now fields
+                    for instance in existing:
+                        for name in auto_now:
+                            setattr(instance, name, now)
+                    model.objects.bulk_update(
+                        existing, list(fields) + auto_now, batch_size=WRITE_BATCH_SIZE
+                    )
+
+            bulk_saved.send(
+                sender=model, pks=[instance.pk for instance in instances.values()]
+            )
+        return instances
+
+
+class BulkUpsertMixin:
+    """
+    Adds `POST <collection>/bulk/`, which takes a list of rows (the
+    serializer's `Meta.list_serializer_class` must be `BulkListSerializer`).
+    Valid rows are written together and the response gives the id of each
+    of them and the errors of the others, by position in the batch.
+    """
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        if not isinstance(request.data, list):
+            return Response(
+                {"error": "Expected a list of rows."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(request.data) > MAX_BATCH_ROWS:
+            return Response(
+                {"error": f"At most {MAX_BATCH_ROWS} rows per batch."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        rows, errors = serializer.validate_rows(request.data)
+        try:
+            saved = serializer.save_rows(rows)
+        except IntegrityError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+
+        results = [
+            {"index": index, "id": instance.pk}
+            for index, instance in sorted(saved.items())
+        ]
+        return Response(
+            {"results": results, "errors": errors},
+            status=(
+                status.HTTP_400_BAD_REQUEST
+                if errors and not results
+                else status.HTTP_200_OK
+            ),
+        )
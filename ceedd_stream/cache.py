@@ -0,0 +1,172 @@
+"""
+Per-model data versions, and the cache of artifacts computed from them.
+
+Cached artifacts (tiles, responses) embed the versions of the models they
+were computed from in their key. Saving or deleting a row bumps the version
+of its model (see signals.py), so stale entries are simply never read again.
+
+Versions are kept in the database, where a bump is a single atomic UPDATE,
+and misses are coalesced with PostgreSQL advisory locks: the default file
+cache backend has no atomic incr() or add(), which could lose bumps and let
+concurrent misses all compute.
+"""
+
+import functools
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.core.cache import cache
+from django.db import connection
+from rest_framework.response import Response
+
+from .models import DataVersion
+
+# Entries are invalidated by the data versions, the timeout only frees space
+RESPONSE_TIMEOUT = 60 * 60 * 24
+# How long a process reuses the versions it read, for get_recent_data_version
+LOCAL_VERSION_TIMEOUT = 2
+# How long the request computing a missing entry keeps the others waiting
+COMPUTE_LOCK_TIMEOUT = 30
+COMPUTE_POLL_INTERVAL = 0.05
+
+_missing = object()
+# Labels -> (expiry, versions) read by this process
+_local_versions = {}
+
+
+def get_data_version(*models):
+    """Returns a string combining the current data versions of `models`."""
+    labels = [model._meta.label_lower for model in models]
+    versions = dict(
+        DataVersion.objects.filter(model__in=labels).values_list("model", "version")
+    )
+    missing = [label for label in labels if label not in versions]
+    if missing:
+        # Seeded from the clock, so that a version never comes back with a
+        # value already used by entries cached before, e.g. after a restore
+        DataVersion.objects.bulk_create(
+            [DataVersion(model=label, version=time.time_ns()) for label in missing],
+            ignore_conflicts=True,
+        )
+        versions = dict(
+            DataVersion.objects.filter(model__in=labels).values_list("model", "version")
+        )
+    return "-".join(str(versions[label]) for label in labels)
+
+
+def get_recent_data_version(*models):
+    """
+    get_data_version() as read by this process at most
+    `LOCAL_VERSION_TIMEOUT` seconds ago: entries cached under it are served
+    without a query, but other processes may serve them for that long after
+    a change.
+    """
+    labels = tuple(model._meta.label_lower for model in models)
+    now = time.monotonic()
+    expiry, versions = _local_versions.get(labels, (0, None))
+    if expiry <= now:
+        versions = get_data_version(*models)
+        _local_versions[labels] = (now + LOCAL_VERSION_TIMEOUT, versions)
+    return versions
+
+
+def bump_data_version(*models):
+    # This process sees its own changes at once
+    bumped = {model._meta.label_lower for model in models}
+    for labels in list(_local_versions):
+        if bumped.intersection(labels):
+            _local_versions.pop(labels, None)
+
+    table = DataVersion._meta.db_table
+    with connection.cursor() as cursor:
+        for model in sorted(model._meta.label_lower for model in models):
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (model, version) VALUES (%s, %s)
+                ON CONFLICT (model) DO UPDATE SET version = {table}.version + 1
+                """,
+                [model, time.time_ns()],
+            )
+
+
+def _try_lock(key):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtextextended(%s, 0))", [key])
+        return cursor.fetchone()[0]
+
+
+def _unlock(key):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(hashtextextended(%s, 0))", [key])
+
+
+def get_or_compute(key, compute, timeout, cacheable=None):
+    """
+    Returns the value cached under `key`, computing it with `compute()` on a
+    miss; it is stored unless `cacheable(value)` is false. Concurrent misses
+    are coalesced across processes: the first one takes an advisory lock and
+    computes, the others wait for its result, and compute it themselves
+    only if it doesn't come within `COMPUTE_LOCK_TIMEOUT`.
+    """
+    value = cache.get(key, _missing)
+    if value is not _missing:
+        return value
+
+    deadline = time.monotonic() + COMPUTE_LOCK_TIMEOUT
+    locked = _try_lock(key)
+    while not locked:
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(COMPUTE_POLL_INTERVAL)
+        value = cache.get(key, _missing)
+        if value is not _missing:
+            return value
+        locked = _try_lock(key)
+
+    try:
+        # Computed by the previous holder of the lock
+        value = cache.get(key, _missing)
+        if value is _missing:
+            value = compute()
+            if cacheable is None or cacheable(value):
+                cache.set(key, value, timeout)
+    finally:
+        if locked:
+            _unlock(key)
+    return value
+
+
+def cache_response(*models, timeout=RESPONSE_TIMEOUT):
+    """
+    Caches the responses of a function view, placed under `@api_view`, by
+    its normalized query parameters and the data versions of `models`.
+    Server errors are not cached.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            # Same parameters in any order give the same key
+            params = sorted(
+                (name, value)
+                for name, values in request.query_params.lists()
+                for value in values
+            )
+            digest = hashlib.sha256(
+                f"{urlencode(params)}|{args}|{sorted(kwargs.items())}".encode()
+            ).hexdigest()
+            key = f"response:{view.__name__}:{get_data_version(*models)}:{digest}"
+
+            def compute():
+                response = view(request, *args, **kwargs)
+                return response.status_code, response.data
+
+            status_code, data = get_or_compute(
+                key, compute, timeout, cacheable=lambda value: value[0] < 500
+            )
+            return Response(data, status=status_code)
+
+        return wrapper
+
+    return decorator
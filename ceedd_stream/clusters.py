@@ -0,0 +1,84 @@
+"""
+Grid clustering of infrastructure points, computed in the database.
+
+Points are snapped to a grid whose cells are a fraction of a web map tile at
+the requested zoom, then grouped by cell and type. The response therefore
+grows with the number of cells on screen, not with the number of points.
+"""
+
+from decimal import Decimal
+
+from django.contrib.gis.db.models.functions import SnapToGrid
+from django.db.models import Avg, Count, FloatField, Func, Sum
+
+# Grid cells per tile side: about one cluster per 64px on 256px tiles
+CELLS_PER_TILE = 4
+
+
+class X(Func):
+    function = "ST_X"
+    output_field = FloatField()
+
+
+class Y(Func):
+    function = "ST_Y"
+    output_field = FloatField()
+
+
+def cluster_infrastructures(queryset, zoom):
+    """
+    Returns the clusters of the infrastructures in `queryset` at `zoom`:
+    centroid, count, summed capacite and a breakdown by type.
+    """
+    cell_size = 360 / 2**zoom / CELLS_PER_TILE
+    rows = (
+        queryset.select_related(None)
+        .prefetch_related(None)
+        .filter(location__isnull=False)
+        .annotate(
+            cell_x=X(SnapToGrid("location", cell_size)),
+            cell_y=Y(SnapToGrid("location", cell_size)),
+        )
+        # By type id, as names aren't unique; the name is read along
+        .values(
+            "cell_x", "cell_y", "type_infrastructure_id", "type_infrastructure__nom"
+        )
+        .annotate(
+            count=Count("id"),
+            capacite=Sum("capacite"),
+            x=Avg(X("location")),
+            y=Avg(Y("location")),
+        )
+        .order_by()
+    )
+
+    clusters = {}
+    for row in rows:
+        cluster = clusters.setdefault(
+            (row["cell_x"], row["cell_y"]),
+            {"count": 0, "capacite": Decimal(0), "x": 0.0, "y": 0.0, "types": []},
+        )
+        capacite = row["capacite"] or Decimal(0)
+        cluster["count"] += row["count"]
+        cluster["capacite"] += capacite
+        # Weighted by count so the centroid is the mean of all the points
+        cluster["x"] += row["x"] * row["count"]
+        cluster["y"] += row["y"] * row["count"]
+        cluster["types"].append(
+            {
+                "type_infrastructure": row["type_infrastructure__nom"],
+                "type_infrastructure_id": row["type_infrastructure_id"],
+                "count": row["count"],
+                "capacite": capacite,
+            }
+        )
+
+    return [
+        {
+            "centroid": [c["x"] / c["count"], c["y"] / c["count"]],
+            "count": c["count"],
+            "capacite": c["capacite"],
+            "types": c["types"],
+        }
+        for c in clusters.values()
+    ]
@@ -0,0 +1,208 @@
+"""
+Resized renditions of photos, for lists, popups and slow mobile links.
+
+`Photo.url` points at the full-resolution source. Each photo gets a square
+thumbnail and a medium rendition, both in WebP and JPEG, stored under
+MEDIA_ROOT next to the row with the URL they were built from. Building is
+idempotent: a photo whose renditions match its current URL is skipped, so
+it can be re-run in bulk (see the build_photo_derivatives command). New or
+changed photos are built on the job queue (see jobs.py), never in the
+request. Sources outside the media storage are only downloaded from the
+PHOTO_SOURCE_HOSTS setting's hosts, and never from private addresses.
+"""
+
+import hashlib
+import io
+import ipaddress
+import socket
+import urllib.request
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.http.request import validate_host
+from PIL import Image, ImageOps
+
+from .jobs import enqueue
+from .models import Photo
+
+# Rendition -> (width, height, cropped to exactly that size)
+RENDITIONS = {
+    "thumbnail": (320, 320, True),
+    "medium": (1280, 1280, False),
+}
+# Extension -> Pillow format and save options
+FORMATS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", {"quality": 82, "optimize": True, "progressive": True}),
+}
+DERIVATIVE_FIELDS = [
+    f"{rendition}_{extension}" for rendition in RENDITIONS for extension in FORMATS
+]
+
+FETCH_TIMEOUT = 30
+MAX_SOURCE_BYTES = 50 * 1024 * 1024
+
+
+class DerivativeError(Exception):
+    """Raised when the source of a photo can't be read as an image."""
+
+
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    # A redirect could lead anywhere, past the checks of check_source_url()
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(NoRedirectHandler)
+
+
+def check_source_url(parts):
+    """
+    Rejects the URLs the worker must not fetch: other schemes than http(s)
+    (urlopen() would read file:// URLs from the server's disk), hosts not in
+    PHOTO_SOURCE_HOSTS, and hosts resolving to private, loopback or
+    link-local addresses.
+    """
+    if parts.scheme not in ("http", "https"):
+        raise DerivativeError(f"Unsupported URL scheme: {parts.scheme}")
+    host = parts.hostname
+    if not host or not validate_host(host, settings.PHOTO_SOURCE_HOSTS):
+        raise DerivativeError(f"Photos can't be downloaded from {host}")
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError, ValueError) as e:
+        raise DerivativeError(f"Can't resolve {host}: {e}")
+    for *_, sockaddr in addresses:
+        # Scoped IPv6 addresses end with %<interface>
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if not address.is_global:
+            raise DerivativeError(f"{host} resolves to a non-public address")
+
+
+def is_own_url(parts):
+    """
+    Whether the URL is served by this site: relative, or on one of the
+    ALLOWED_HOSTS (but for "*", which would match any host).
+    """
+    if not parts.scheme and not parts.netloc:
+        return True
+    hosts = [host for host in settings.ALLOWED_HOSTS if host != "*"]
+    return (
+        parts.scheme in ("http", "https")
+        and bool(parts.hostname)
+        and validate_host(parts.hostname, hosts)
+    )
+
+
+def read_source(url):
+    """
+    Returns the bytes of the photo at `url`: from the media storage when it
+    is one of ours, otherwise downloaded from an allowed host.
+    """
+    parts = urlsplit(url)
+    # Another site's /media/ path names none of our files
+    if is_own_url(parts) and parts.path.startswith(settings.MEDIA_URL):
+        name = parts.path[len(settings.MEDIA_URL) :]
+        try:
+            if default_storage.exists(name):
+                with default_storage.open(name, "rb") as f:
+                    return f.read()
+        except SuspiciousFileOperation:
+            raise DerivativeError(f"Unsupported URL: {url}")
+
+    check_source_url(parts)
+    try:
+        with _opener.open(url, timeout=FETCH_TIMEOUT) as response:
+            data = response.read(MAX_SOURCE_BYTES + 1)
+    except (OSError, ValueError) as e:
+        raise DerivativeError(f"Can't fetch {url}: {e}")
+    if len(data) > MAX_SOURCE_BYTES:
+        raise DerivativeError(f"{url} is larger than {MAX_SOURCE_BYTES} bytes")
+    return data
+
+
+def render(image, width, height, crop):
+    if crop:
+        return ImageOps.fit(image, (width, height), Image.Resampling.LANCZOS)
+    rendition = image.copy()
+    rendition.thumbnail((width, height), Image.Resampling.LANCZOS)
+    return rendition
+
+
+def encode(image, extension):
+    image_format, options = FORMATS[extension]
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def derivatives_outdated(photo):
+    return bool(photo.url) and photo.derivatives_source != photo.url
+
+
+def delete_derivatives(photo):
+    for field in DERIVATIVE_FIELDS:
+        getattr(photo, field).delete(save=False)
+
+
+def build_derivatives(photo, force=False):
+    """
+    Builds the renditions of `photo` from its URL, unless they are already
+    built from it and `force` is false. A source that can't be read is
+    recorded in `derivatives_error` and not retried until the URL changes.
+    """
+    if not force and not derivatives_outdated(photo):
+        return photo
+
+    url = photo.url
+    delete_derivatives(photo)
+    photo.derivatives_error = ""
+    try:
+        try:
+            image = Image.open(io.BytesIO(read_source(url)))
+            image.draft("RGB", (RENDITIONS["medium"][0], RENDITIONS["medium"][1]))
+            image = ImageOps.exif_transpose(image).convert("RGB")
+        except (OSError, Image.DecompressionBombError) as e:
+            raise DerivativeError(f"{url} is not a readable image: {e}")
+
+        # Named after the source, so a new URL never reuses cached files
+        digest = hashlib.sha1(url.encode()).hexdigest()[:12]
+        for rendition, (width, height, crop) in RENDITIONS.items():
+            resized = render(image, width, height, crop)
+            for extension in FORMATS:
+                getattr(photo, f"{rendition}_{extension}").save(
+                    f"{photo.pk}/{digest}-{rendition}.{extension}",
+                    ContentFile(encode(resized, extension)),
+                    save=False,
+                )
+    except DerivativeError as e:
+        delete_derivatives(photo)
+        photo.derivatives_error = str(e)
+
+    photo.derivatives_source = url
+    photo.save(
+        update_fields=[
+            *DERIVATIVE_FIELDS,
+            "derivatives_source",
+            "derivatives_error",
+            "updated_at",
+        ]
+    )
+    return photo
+
+
+def schedule_derivatives(photo):
+    """Queues the build of the renditions of `photo`."""
+    return enqueue("photo_derivatives", photo=photo.pk)
+
+
+def run_derivatives_job(job):
+    photo = Photo.objects.filter(pk=job.params["photo"]).first()
+    if photo is None:
+        return None
+    build_derivatives(photo)
+    return {"photo": photo.pk, "error": photo.derivatives_error or None}
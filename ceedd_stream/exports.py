@@ -0,0 +1,161 @@
+"""
+Exports of infrastructures with their client, type, zone and financing.
+
+Rows are read through a server-side cursor (`.iterator()`), so an export
+runs in constant memory whatever the number of infrastructures: CSV is
+streamed to the client row by row, and the GeoPackage or zipped shapefile
+is written feature by feature with fiona to a temporary file, then sent.
+"""
+
+import csv
+import os
+import shutil
+import tempfile
+import zipfile
+from decimal import Decimal
+
+import fiona
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Concat, Trim
+from fiona.model import Feature
+
+from .clusters import X, Y
+from .models import Finance
+
+EXPORT_CHUNK_SIZE = 2000
+
+# Column -> fiona type of the exported property
+EXPORT_COLUMNS = {
+    "id": "int",
+    "nom": "str",
+    "client": "str",
+    "type_infrastructure": "str",
+    "zone": "str",
+    "capacite": "float",
+    "unite": "str",
+    "date_construction": "date",
+    "longitude": "float",
+    "latitude": "float",
+    "total_financement": "float",
+}
+
+# DBF field names are limited to 10 characters
+SHAPEFILE_NAMES = {
+    "type_infrastructure": "type",
+    "date_construction": "date_const",
+    "total_financement": "financemt",
+}
+
+
+def export_rows(queryset):
+    """Yields one tuple of `EXPORT_COLUMNS` values per infrastructure."""
+    finances = (
+        Finance.objects.filter(infrastructure=OuterRef("pk"))
+        .order_by()
+        .values("infrastructure")
+        .annotate(total=Sum("montant"))
+        .values("total")
+    )
+    expressions = {
+        "id": F("id"),
+        "nom": F("nom"),
+        "client": Trim(Concat("client__prenom", Value(" "), "client__nom")),
+        "type_infrastructure": F("type_infrastructure__nom"),
+        "zone": F("zone__nom"),
+        "capacite": F("capacite"),
+        "unite": F("unite"),
+        "date_construction": F("date_construction"),
+        "longitude": X("location"),
+        "latitude": Y("location"),
+        "total_financement": Coalesce(
+            Subquery(finances),
+            Value(Decimal(0)),
+            output_field=DecimalField(max_digits=20, decimal_places=2),
+        ),
+    }
+    # Prefixed, as annotations can't be named after model fields
+    annotations = {f"export_{column}": expressions[column] for column in EXPORT_COLUMNS}
+    return (
+        queryset.select_related(None)
+        .prefetch_related(None)
+        .annotate(**annotations)
+        .order_by("id")
+        .values_list(*annotations)
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+
+
+class Echo:
+    """File-like object whose write() returns the line, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(queryset):
+    """Yields the export of `queryset` as CSV lines."""
+    writer = csv.writer(Echo())
+    # The BOM lets spreadsheet software detect UTF-8
+    yield "\ufeff" + writer.writerow(EXPORT_COLUMNS)
+    for row in export_rows(queryset):
+        yield writer.writerow(row)
+
+
+def write_features(path, driver, queryset, names=None):
+    names = names or {}
+    schema = {
+        "geometry": "Point",
+        "properties": {
+            names.get(column, column): kind for column, kind in EXPORT_COLUMNS.items()
+        },
+    }
+    with fiona.open(
+        path, "w", driver=driver, schema=schema, crs="EPSG:4326", encoding="utf-8"
+    ) as dst:
+        batch = []
+        for row in export_rows(queryset):
+            values = dict(zip(EXPORT_COLUMNS, row))
+            geometry = None
+            if values["longitude"] is not None:
+                geometry = {
+                    "type": "Point",
+                    "coordinates": (values["longitude"], values["latitude"]),
+                }
+            properties = {}
+            for column, value in values.items():
+                if isinstance(value, Decimal):
+                    value = float(value)
+                elif EXPORT_COLUMNS[column] == "date" and value is not None:
+                    value = value.isoformat()
+                properties[names.get(column, column)] = value
+
+            batch.append(
+                Feature.from_dict({"geometry": geometry, "properties": properties})
+            )
+            if len(batch) >= EXPORT_CHUNK_SIZE:
+                dst.writerecords(batch)
+                batch = []
+        dst.writerecords(batch)
+
+
+def export_geodata(queryset, file_format):
+    """
+    Writes the export of `queryset` as a GeoPackage ("gpkg") or a zipped
+    shapefile ("shp") and returns it as an open temporary file, deleted
+    once closed.
+    """
+    output = tempfile.TemporaryFile()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if file_format == "gpkg":
+            path = os.path.join(tmpdir, "infrastructures.gpkg")
+            write_features(path, "GPKG", queryset)
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, output)
+        else:
+            path = os.path.join(tmpdir, "infrastructures.shp")
+            write_features(path, "ESRI Shapefile", queryset, SHAPEFILE_NAMES)
+            with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as z:
+                for name in sorted(os.listdir(tmpdir)):
+                    z.write(os.path.join(tmpdir, name), name)
+    output.seek(0)
+    return output
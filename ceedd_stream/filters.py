@@ -0,0 +1,176 @@
+from math import cos, radians
+
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Greatest, Upper
+import django_filters
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend, SearchFilter
+
+from .models import ShpFeature, ZoneContributive
+
+# Length of one degree of latitude, in meters
+METERS_PER_DEGREE = 111320
+
+# Annotation holding the similarity of fuzzy search results
+SEARCH_RANK = "search_rank"
+
+
+def parse_floats(value, count, param):
+    try:
+        numbers = [float(v) for v in value.split(",")]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise ValidationError({param: f"Expected {count} comma-separated numbers."})
+    return numbers
+
+
+class InfrastructureSpatialFilter(BaseFilterBackend):
+    """
+    Spatial filters on `Infrastructure.location`, all run in the database as
+    predicates that can use the GiST indexes:
+
+    ?in_bbox=minx,miny,maxx,maxy
+    ?point=lon,lat&dist=<meters>
+    ?within_shp=<shapefile id>
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+
+        if params.get("in_bbox"):
+            bbox = parse_floats(params["in_bbox"], 4, "in_bbox")
+            polygon = Polygon.from_bbox(bbox)
+            polygon.srid = 4326
+            queryset = queryset.filter(location__intersects=polygon)
+
+        if params.get("dist") or params.get("point"):
+            lon, lat = parse_floats(params.get("point", ""), 2, "point")
+            (dist,) = parse_floats(params.get("dist", ""), 1, "dist")
+            point = Point(lon, lat, srid=4326)
+            # Indexed ST_DWithin on a radius in degrees wide enough to hold
+            # `dist` meters at this latitude, then the exact spherical check
+            degrees = dist / (METERS_PER_DEGREE * max(cos(radians(lat)), 0.01))
+            queryset = queryset.filter(
+                location__dwithin=(point, degrees),
+                location__distance_lte=(point, D(m=dist)),
+            )
+
+        if params.get("within_shp"):
+            try:
+                shp_id = int(params["within_shp"])
+            except ValueError:
+                raise ValidationError({"within_shp": "Expected a shapefile id."})
+            features = ShpFeature.objects.filter(
+                shp_id=shp_id, geom__intersects=OuterRef("location")
+            )
+            queryset = queryset.filter(Exists(features))
+
+        return queryset
+
+
+def trigram_filter(queryset, field, term):
+    """
+    Keeps the rows of `queryset` whose `field` is trigram-similar to `term`.
+    Values are compared upper-cased: trigram similarity ignores case, and
+    the UPPER() trigram indexes are the ones icontains uses too.
+    """
+    alias = f"{field.replace('__', '_')}_upper"
+    return queryset.alias(**{alias: Upper(field)}).filter(
+        **{f"{alias}__trigram_similar": term}
+    )
+
+
+class FuzzySearchFilter(SearchFilter):
+    """
+    SearchFilter with a typo-tolerant mode, `?search=<term>&fuzzy=true`,
+    keeping the rows where one of the view's `fuzzy_search_fields` is
+    trigram-similar to the term, most similar first (annotated as
+    `search_rank`).
+
+    Each field is matched on its own table, where its trigram index
+    applies: a related field is resolved first to the primary keys of its
+    most similar rows, so the OR of the conditions is an OR of indexed
+    scans rather than a similarity computed on every row.
+    """
+
+    fuzzy_param = "fuzzy"
+    # Related rows matched per field
+    related_matches = 1000
+
+    def filter_queryset(self, request, queryset, view):
+        fields = getattr(view, "fuzzy_search_fields", None)
+        if not fields or request.query_params.get(self.fuzzy_param) not in (
+            "1",
+            "true",
+        ):
+            return super().filter_queryset(request, queryset, view)
+
+        term = " ".join(self.get_search_terms(request))
+        if not term:
+            return queryset
+
+        condition = Q()
+        for field in fields:
+            path, _, column = field.rpartition("__")
+            if not path:
+                alias = f"{column}_upper"
+                queryset = queryset.alias(**{alias: Upper(column)})
+                condition |= Q(**{f"{alias}__trigram_similar": term})
+                continue
+
+            model = queryset.model
+            for name in path.split("__"):
+                model = model._meta.get_field(name).related_model
+            pks = (
+                trigram_filter(model.objects.all(), column, term)
+                .annotate(similarity=TrigramSimilarity(Upper(column), term))
+                .order_by("-similarity")
+                .values_list("pk", flat=True)[: self.related_matches]
+            )
+            condition |= Q(**{f"{path}__in": list(pks)})
+
+        # Only computed on the matching rows
+        scores = [TrigramSimilarity(Upper(field), term) for field in fields]
+        rank = Greatest(*scores) if len(scores) > 1 else scores[0]
+        return (
+            queryset.filter(condition)
+            .annotate(**{SEARCH_RANK: rank})
+            .order_by(f"-{SEARCH_RANK}", "pk")
+        )
+
+
+class ZoneContributiveFilter(django_filters.FilterSet):
+    """Filters on the aggregates annotated by `with_aggregates()`."""
+
+    infrastructures_count_min = django_filters.NumberFilter(
+        field_name="infrastructures_count", lookup_expr="gte"
+    )
+    infrastructures_count_max = django_filters.NumberFilter(
+        field_name="infrastructures_count", lookup_expr="lte"
+    )
+    total_capacite_min = django_filters.NumberFilter(
+        field_name="total_capacite", lookup_expr="gte"
+    )
+    total_capacite_max = django_filters.NumberFilter(
+        field_name="total_capacite", lookup_expr="lte"
+    )
+    total_financement_min = django_filters.NumberFilter(
+        field_name="total_financement", lookup_expr="gte"
+    )
+    total_financement_max = django_filters.NumberFilter(
+        field_name="total_financement", lookup_expr="lte"
+    )
+    derniere_inspection_after = django_filters.IsoDateTimeFilter(
+        field_name="derniere_inspection", lookup_expr="gte"
+    )
+    derniere_inspection_before = django_filters.IsoDateTimeFilter(
+        field_name="derniere_inspection", lookup_expr="lte"
+    )
+
+    class Meta:
+        model = ZoneContributive
+        fields = ["nom", "etat_ravin", "shapefile_id"]
@@ -0,0 +1,208 @@
+"""
+Streaming import of spreadsheets (CSV or XLSX).
+
+Rows are read one at a time and handled in chunks of `IMPORT_CHUNK_SIZE`:
+each chunk is validated by the bulk serializer of its kind, its foreign
+keys resolved with one query per relation, and upserted in its own
+transaction. Memory is bounded by the chunk size whatever the size of the
+file, and an invalid row only rejects that row. Progress and row errors
+are recorded on the `ImportJob`.
+"""
+
+import csv
+import datetime
+import io
+import os
+
+from django.db import IntegrityError
+from django.utils import timezone
+from openpyxl import load_workbook
+
+from .jobs import JobError, enqueue, report_progress
+from .models import ImportJob
+from .serializers import ClientSerializer, InfrastructureSerializer
+
+IMPORT_CHUNK_SIZE = 1000
+# Row errors stored on the job; later ones are only counted
+MAX_STORED_ERRORS = 1000
+
+IMPORT_SERIALIZERS = {
+    "infrastructures": InfrastructureSerializer,
+    "clients": ClientSerializer,
+}
+
+
+class SpreadsheetError(Exception):
+    """Raised when a stored file is not a readable CSV or XLSX spreadsheet."""
+
+
+def read_csv(path):
+    """Yields (line, progress, row) for each row of the CSV file at `path`."""
+    size = os.path.getsize(path) or 1
+    with open(path, "rb") as raw:
+        text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+        sample = text.read(4096)
+        text.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+
+        reader = csv.DictReader(text, dialect=dialect)
+        for row in reader:
+            # Bytes consumed so far, ahead of the row by at most one buffer
+            yield reader.line_num, min(raw.tell() / size, 1), row
+
+
+def read_xlsx(path):
+    """Yields (line, progress, row) for each row of the first sheet at `path`."""
+    # read_only streams the sheet instead of loading it whole
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        values = sheet.iter_rows(values_only=True)
+        header = next(values, None) or ()
+        total = sheet.max_row
+        for line, row in enumerate(values, start=2):
+            progress = line / total if total else 0
+            yield line, progress, dict(zip(header, row))
+    finally:
+        workbook.close()
+
+
+READERS = {".csv": read_csv, ".xlsx": read_xlsx}
+
+
+def clean_row(row):
+    """
+    Normalizes the headers of `row` and drops its empty cells, so that they
+    are treated as missing rather than as invalid values.
+    """
+    cleaned = {}
+    for key, value in row.items():
+        if key is None:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+        elif isinstance(value, float) and value.is_integer():
+            # Spreadsheets store every number as a float, ids included
+            value = int(value)
+        elif isinstance(value, datetime.datetime) and value.time() == datetime.time():
+            value = value.date()
+        if value is None or value == "":
+            continue
+        cleaned[str(key).strip().lower()] = value
+    return cleaned
+
+
+def import_chunk(job, serializer_class, chunk, progress):
+    lines = [line for line, _ in chunk]
+    data = [row for _, row in chunk]
+
+    serializer = serializer_class(data=data, many=True)
+    rows, errors = serializer.validate_rows(data)
+    try:
+        saved = serializer.save_rows(rows)
+    except IntegrityError as e:
+        # The chunk's transaction was rolled back
+        saved = {}
+        errors += [
+            {"index": index, "errors": {"non_field_errors": [str(e)]}}
+            for index, _, _ in rows
+        ]
+
+    room = max(MAX_STORED_ERRORS - len(job.errors), 0)
+    job.errors += [
+        {"row": lines[error["index"]], "errors": error["errors"]}
+        for error in sorted(errors, key=lambda error: error["index"])[:room]
+    ]
+    job.processed_rows += len(chunk)
+    job.written_rows += len(saved)
+    job.error_count += len(errors)
+    job.progress = progress
+    job.save(
+        update_fields=[
+            "errors",
+            "processed_rows",
+            "written_rows",
+            "error_count",
+            "progress",
+            "updated_at",
+        ]
+    )
+
+
+def run_import(job, callback=None):
+    """
+    Imports the file of `job` chunk by chunk, saving its progress after each
+    chunk and calling `callback(job)` if given.
+    """
+    serializer_class = IMPORT_SERIALIZERS[job.kind]
+    # From scratch, also when run again after its worker stopped
+    job.status = "running"
+    job.processed_rows = 0
+    job.written_rows = 0
+    job.error_count = 0
+    job.errors = []
+    job.progress = 0
+    job.save(
+        update_fields=[
+            "status",
+            "processed_rows",
+            "written_rows",
+            "error_count",
+            "errors",
+            "progress",
+            "updated_at",
+        ]
+    )
+
+    try:
+        extension = os.path.splitext(job.file.name)[1].lower()
+        if extension not in READERS:
+            raise SpreadsheetError(f"Unsupported file type: {extension}")
+
+        chunk = []
+        progress = 0
+        for line, progress, row in READERS[extension](job.file.path):
+            chunk.append((line, clean_row(row)))
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                import_chunk(job, serializer_class, chunk, progress)
+                chunk = []
+                if callback:
+                    callback(job)
+        if chunk:
+            import_chunk(job, serializer_class, chunk, progress)
+    except Exception as e:
+        job.status = "failed"
+        job.message = str(e)
+    else:
+        job.status = "done"
+        job.progress = 1
+
+    job.finished_at = timezone.now()
+    job.save(
+        update_fields=["status", "message", "progress", "finished_at", "updated_at"]
+    )
+    if callback:
+        callback(job)
+    return job
+
+
+def start_import(job):
+    """Queues `job` to be run by a worker, once the current transaction commits."""
+    return enqueue("import", import_job=job.pk)
+
+
+def run_import_job(job):
+    import_job = ImportJob.objects.get(pk=job.params["import_job"])
+    run_import(
+        import_job, callback=lambda current: report_progress(job, current.progress)
+    )
+    if import_job.status == "failed":
+        raise JobError(import_job.message)
+    return {
+        "import_job": import_job.pk,
+        "written_rows": import_job.written_rows,
+        "error_count": import_job.error_count,
+    }
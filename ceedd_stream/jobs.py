@@ -0,0 +1,137 @@
+"""
+Background jobs queued in the database.
+
+A request that starts long work (a spreadsheet import, a shapefile ingest,
+photo renditions) enqueues a `Job` and answers 202 with its id instead of
+holding a gunicorn worker. Jobs are run by `manage.py run_jobs` workers,
+which claim them with SELECT ... FOR UPDATE SKIP LOCKED: any number of
+workers share the queue and a job is only ever claimed by one of them.
+Status, progress, result or error are recorded on the row, which clients
+poll at /api/v1/jobs/<id>/.
+
+While a job runs, its worker touches `updated_at` every
+`HEARTBEAT_INTERVAL` seconds; a running job whose heartbeat stopped lost
+its worker and is queued again, up to `MAX_ATTEMPTS` times.
+"""
+
+import threading
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .cache import bump_data_version
+from .models import Job
+
+# Kind -> function called with the claimed job, returning its JSON result
+JOB_HANDLERS = {
+    "import": "ceedd_stream.imports.run_import_job",
+    "ingest_shapefile": "ceedd_stream.shapefiles.run_ingest_job",
+    "photo_derivatives": "ceedd_stream.derivatives.run_derivatives_job",
+}
+
+HEARTBEAT_INTERVAL = 30
+STALE_AFTER = timedelta(seconds=5 * HEARTBEAT_INTERVAL)
+MAX_ATTEMPTS = 3
+
+
+class JobError(Exception):
+    """Raised by a job handler to fail its job with a message."""
+
+
+def _jobs_updated():
+    # Queryset updates send no post_save: bump the version the job list
+    # ETags are built from, as signals.bump_model_version does
+    transaction.on_commit(lambda: bump_data_version(Job))
+
+
+def enqueue(kind, **params):
+    """
+    Queues a job of `kind`. Queued inside a transaction, it is only seen by
+    the workers once that transaction commits.
+    """
+    return Job.objects.create(kind=kind, params=params)
+
+
+def claim_job():
+    """Marks the oldest pending job as running and returns it, or None."""
+    with transaction.atomic():
+        job = (
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status="pending")
+            .order_by("created_at", "id")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = "running"
+        job.started_at = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=["status", "started_at", "attempts", "updated_at"])
+    return job
+
+
+def requeue_stale_jobs():
+    """
+    Queues again the running jobs whose worker stopped sending heartbeats,
+    or fails them once they used up their attempts.
+    """
+    now = timezone.now()
+    stale = Job.objects.filter(status="running", updated_at__lt=now - STALE_AFTER)
+    stale.filter(attempts__lt=MAX_ATTEMPTS).update(status="pending", updated_at=now)
+    # Those left are out of attempts
+    stale.update(
+        status="failed",
+        message="The worker running the job stopped.",
+        finished_at=now,
+        updated_at=now,
+    )
+    _jobs_updated()
+
+
+def report_progress(job, progress):
+    job.progress = progress
+    Job.objects.filter(pk=job.pk).update(progress=progress, updated_at=timezone.now())
+    _jobs_updated()
+
+
+def _heartbeat(pk, stop):
+    try:
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            Job.objects.filter(pk=pk).update(updated_at=timezone.now())
+            _jobs_updated()
+    finally:
+        connection.close()
+
+
+def run_job(job):
+    """Runs a claimed job and records its result or error."""
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(job.pk, stop), daemon=True)
+    heartbeat.start()
+    try:
+        handler = import_string(JOB_HANDLERS[job.kind])
+        job.result = handler(job)
+    except Exception as e:
+        job.status = "failed"
+        job.message = str(e) or type(e).__name__
+    else:
+        job.status = "done"
+        job.progress = 1
+    finally:
+        stop.set()
+        heartbeat.join()
+
+    job.finished_at = timezone.now()
+    job.save(
+        update_fields=[
+            "status",
+            "progress",
+            "result",
+            "message",
+            "finished_at",
+            "updated_at",
+        ]
+    )
+    return job
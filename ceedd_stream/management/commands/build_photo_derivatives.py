@@ -0,0 +1,72 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ceedd_stream.derivatives import build_derivatives, derivatives_outdated
+from ceedd_stream.models import Photo
+
+# Photos submitted ahead per worker: the rest of the table is only read as
+# workers free up
+PENDING_PER_WORKER = 4
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the thumbnail and medium renditions of the photos whose "
+        "renditions are missing or built from another URL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Rebuild every photo")
+        parser.add_argument(
+            "--failed",
+            action="store_true",
+            help="Also retry the photos whose source couldn't be read",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=2,
+            help="Photos built in parallel",
+        )
+
+    def handle(self, *args, **options):
+        force = options["force"]
+
+        def build(photo):
+            try:
+                return build_derivatives(photo, force=True)
+            finally:
+                connection.close()
+
+        photos = (
+            photo
+            for photo in Photo.objects.order_by("pk").iterator()
+            if force
+            or derivatives_outdated(photo)
+            or (options["failed"] and photo.derivatives_error)
+        )
+        built = failed = 0
+
+        def report(futures):
+            nonlocal built, failed
+            for future in futures:
+                photo = future.result()
+                if photo.derivatives_error:
+                    failed += 1
+                    self.stderr.write(f"Photo {photo.pk}: {photo.derivatives_error}")
+                else:
+                    built += 1
+
+        workers = max(options["workers"], 1)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for photo in photos:
+                if len(pending) >= workers * PENDING_PER_WORKER:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    report(done)
+                pending.add(executor.submit(build, photo))
+            report(wait(pending).done)
+
+        self.stdout.write(self.style.SUCCESS(f"{built} photos built, {failed} failed."))
@@ -0,0 +1,39 @@
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from ceedd_stream.imports import IMPORT_SERIALIZERS, run_import
+from ceedd_stream.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = "Imports infrastructures or clients from a CSV or XLSX file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=sorted(IMPORT_SERIALIZERS))
+        parser.add_argument("path", help="Path of the .csv or .xlsx file")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.isfile(path):
+            raise CommandError(f"File not found: {path}")
+
+        # Keep a copy with the job, like imports uploaded through the API
+        job = ImportJob(kind=options["kind"])
+        with open(path, "rb") as f:
+            job.file.save(os.path.basename(path), File(f))
+
+        def report(job):
+            self.stdout.write(
+                f"{job.progress:.0%} - {job.processed_rows} rows read, "
+                f"{job.written_rows} written, {job.error_count} errors"
+            )
+
+        run_import(job, callback=report)
+
+        for error in job.errors:
+            self.stderr.write(f"Line {error['row']}: {error['errors']}")
+        if job.status == "failed":
+            raise CommandError(f"Import {job.id} failed: {job.message}")
+        self.stdout.write(self.style.SUCCESS(f"Import {job.id} done."))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ceedd_stream.cache import bump_data_version
+from ceedd_stream.models import Infrastructure
+from ceedd_stream.rollups import KEY_FIELDS, rebuild_rollup, verify_rollup
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the capacite rollup from the infrastructures, then checks it "
+        "against them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Only check the rollup, without rebuilding it",
+        )
+
+    def handle(self, *args, **options):
+        if not options["verify"]:
+            rebuild_rollup()
+            # Drop the statistics cached from the previous rollup
+            bump_data_version(Infrastructure)
+            self.stdout.write("Rollup rebuilt.")
+
+        differences = verify_rollup()
+        for key, expected, stored in differences:
+            self.stderr.write(
+                f"{dict(zip(KEY_FIELDS, key))}: expected {expected}, stored {stored}"
+            )
+        if differences:
+            raise CommandError(f"{len(differences)} rollup keys differ.")
+        self.stdout.write(self.style.SUCCESS("Rollup matches the infrastructures."))
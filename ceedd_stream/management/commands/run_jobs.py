@@ -0,0 +1,61 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ceedd_stream.jobs import claim_job, requeue_stale_jobs, run_job
+
+# Seconds between two checks for jobs whose worker died
+REQUEUE_INTERVAL = 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the queued background jobs (imports, shapefile ingests, photo "
+        "renditions) until stopped. Start as many workers as needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of waiting for jobs",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2,
+            help="Seconds to wait before checking an empty queue again",
+        )
+
+    def handle(self, *args, **options):
+        self.stopping = False
+
+        def stop(signum, frame):
+            # Finish the current job, then exit
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        next_requeue = 0
+        while not self.stopping:
+            close_old_connections()
+            if time.monotonic() >= next_requeue:
+                requeue_stale_jobs()
+                next_requeue = time.monotonic() + REQUEUE_INTERVAL
+
+            job = claim_job()
+            if job is None:
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+                continue
+
+            self.stdout.write(f"Job {job.id} ({job.kind}) started")
+            run_job(job)
+            if job.status == "failed":
+                self.stderr.write(f"Job {job.id} failed: {job.message}")
+            else:
+                self.stdout.write(f"Job {job.id} done")
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0009_client_province_finance_created_at_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="shp",
+            name="bbox",
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="shp",
+            name="feature_count",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="shp",
+            name="crs",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="shp",
+            name="geojson",
+            field=models.FileField(
+                blank=True, null=True, upload_to="shapefiles/geojson/%Y/%m/%d/"
+            ),
+        ),
+        migrations.AddField(
+            model_name="shp",
+            name="artifacts_source",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
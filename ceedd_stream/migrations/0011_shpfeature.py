@@ -0,0 +1,60 @@
+import django.contrib.gis.db.models.fields
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def reset_artifacts_source(apps, schema_editor):
+    # Force existing uploads to be re-ingested into the feature table
+    Shp = apps.get_model("ceedd_stream", "Shp")
+    Shp.objects.update(artifacts_source="")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0010_shp_artifacts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ShpFeature",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("fid", models.PositiveIntegerField()),
+                (
+                    "properties",
+                    models.JSONField(
+                        blank=True,
+                        default=dict,
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                    ),
+                ),
+                (
+                    "geom",
+                    django.contrib.gis.db.models.fields.GeometryField(
+                        blank=True, null=True, srid=4326
+                    ),
+                ),
+                (
+                    "shp",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="features",
+                        to="ceedd_stream.shp",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("shp", "fid")},
+            },
+        ),
+        migrations.RunPython(reset_artifacts_source, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def create_location_index(apps, schema_editor):
+    # PointField creates this index by default; make sure it exists on
+    # databases where it was dropped or never created
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(
+        "CREATE INDEX IF NOT EXISTS ceedd_stream_infrastructure_location_id "
+        "ON ceedd_stream_infrastructure USING GIST (location)"
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0011_shpfeature"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_location_index, migrations.RunPython.noop),
+    ]
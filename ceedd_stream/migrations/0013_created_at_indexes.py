@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0012_infrastructure_location_gist"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="infrastructure",
+            index=models.Index(
+                fields=["created_at", "id"], name="infrastructure_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="inspection",
+            index=models.Index(
+                fields=["created_at", "id"], name="inspection_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="photo",
+            index=models.Index(fields=["created_at", "id"], name="photo_created_idx"),
+        ),
+    ]
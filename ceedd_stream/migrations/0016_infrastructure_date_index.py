@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0015_client_address_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="infrastructure",
+            index=models.Index(
+                fields=["date_construction"], name="infrastructure_date_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,107 @@
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
+
+
+def build_rollup(apps, schema_editor):
+    Infrastructure = apps.get_model("ceedd_stream", "Infrastructure")
+    CapaciteRollup = apps.get_model("ceedd_stream", "CapaciteRollup")
+
+    rows = (
+        Infrastructure.objects.values(
+            "type_infrastructure_id",
+            "zone_id",
+            province=F("client__province"),
+            commune=F("client__commune"),
+            quartier=F("client__quartier"),
+            month=TruncMonth("date_construction"),
+        )
+        .annotate(
+            infrastructures_count=Count("id"),
+            capacite_count=Count("capacite"),
+            capacite_total=Coalesce(Sum("capacite"), Value(Decimal(0))),
+        )
+        .order_by()
+    )
+    CapaciteRollup.objects.bulk_create(
+        (CapaciteRollup(**row) for row in rows.iterator()), batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0016_infrastructure_date_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CapaciteRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "province",
+                    models.CharField(blank=True, max_length=255, null=True),
+                ),
+                ("commune", models.CharField(blank=True, max_length=255, null=True)),
+                (
+                    "quartier",
+                    models.CharField(blank=True, max_length=255, null=True),
+                ),
+                ("month", models.DateField(blank=True, null=True)),
+                ("infrastructures_count", models.IntegerField(default=0)),
+                ("capacite_count", models.IntegerField(default=0)),
+                (
+                    "capacite_total",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+                (
+                    "type_infrastructure",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="ceedd_stream.typeinfrastructure",
+                    ),
+                ),
+                (
+                    "zone",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="ceedd_stream.zonecontributive",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=(
+                            "province",
+                            "commune",
+                            "quartier",
+                            "type_infrastructure",
+                            "zone",
+                            "month",
+                        ),
+                        name="capacite_rollup_key_uniq",
+                        nulls_distinct=False,
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(build_rollup, migrations.RunPython.noop),
+    ]
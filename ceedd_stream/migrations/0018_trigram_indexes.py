@@ -0,0 +1,42 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+from django.db.models.functions import Upper
+
+
+def trigram_index(column, name):
+    return GinIndex(OpClass(Upper(column), name="gin_trgm_ops"), name=name)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0017_capaciterollup"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name="client",
+            index=trigram_index("nom", "client_nom_trgm_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="client",
+            index=trigram_index("avenue", "client_avenue_trgm_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="client",
+            index=trigram_index("quartier", "client_quartier_trgm_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="client",
+            index=trigram_index("commune", "client_commune_trgm_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="client",
+            index=trigram_index("province", "client_province_trgm_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="infrastructure",
+            index=trigram_index("nom", "infrastructure_nom_trgm_idx"),
+        ),
+    ]
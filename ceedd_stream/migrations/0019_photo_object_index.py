@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0018_trigram_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="photo",
+            index=models.Index(
+                fields=["content_type", "object_id"], name="photo_object_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ceedd_stream", "0019_photo_object_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="photo",
+            name="thumbnail_webp",
+            field=models.FileField(
+                blank=True, null=True, upload_to="photos/derivatives/"
+            ),
+        ),
+        migrations.AddField(
+            model_name="photo",
+            name="thumbnail_jpeg",
+            field=models.FileField(
+                blank=True, null=True, upload_to="photos/derivatives/"
+            ),
+        ),
+        migrations.AddField(
+            model_name="photo",
+            name="medium_webp",
+            field=models.FileField(
+                blank=True, null=True, upload_to="photos/derivatives/"
+            ),
+        ),
+        migrations.AddField(
+            model_name="photo",
+            name="medium_jpeg",
+            field=models.FileField(
+                blank=True, null=True, upload_to="photos/derivatives/"
+            ),
+        ),
+        migrations.AddField(
+            model_name="photo",
+            name="derivatives_source",
+            field=models.CharField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name="photo",
+            name="derivatives_error",
+            field=models.TextField(blank=True),
+        ),
+    ]
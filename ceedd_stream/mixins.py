@@ -0,0 +1,351 @@
+import functools
+import hashlib
+import sys
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Prefetch
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+from .cache import get_data_version
+
+
+def parse_expand(paths):
+    """Turns ["a", "a.b", "c"] into {"a": ["b"], "c": []}."""
+    tree = {}
+    for path in paths:
+        head, _, rest = path.partition(".")
+        tree.setdefault(head, [])
+        if rest:
+            tree[head].append(rest)
+    return tree
+
+
+def split_param(value):
+    """Turns "a, b," into {"a", "b"}."""
+    return {part.strip() for part in (value or "").split(",") if part.strip()}
+
+
+def is_top_level(serializer):
+    parent = serializer.parent
+    return parent is None or (
+        isinstance(parent, serializers.ListSerializer) and parent.parent is None
+    )
+
+
+def get_relation(model, name):
+    """Returns the relation of `model` reachable through attribute `name`."""
+    for field in model._meta.get_fields():
+        if not field.is_relation or field.related_model is None:
+            continue
+        if field.auto_created and not field.concrete:
+            accessor = field.get_accessor_name()
+        else:
+            accessor = field.name
+        if accessor == name:
+            return field
+    return None
+
+
+class ExpandableFieldsMixin:
+    """
+    Nests the serializers listed in `Meta.expandable_fields` only when they
+    are requested, e.g. `?expand=infrastructures,infrastructures.client`.
+    Otherwise a foreign key is rendered as its primary key and any other
+    relation is left out.
+
+    `expandable_fields` maps a field name to `(serializer, kwargs)`, where
+    `serializer` is a class or the name of a class of the same module.
+    """
+
+    def __init__(self, *args, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._expand = expand
+
+    def get_expand(self):
+        if self._expand is not None:
+            return self._expand
+        # Only the serializer of the requested resource reads the context;
+        # nested serializers are given their part of the tree explicitly
+        if is_top_level(self):
+            return self.context.get("expand", [])
+        return []
+
+    def get_fields(self):
+        fields = super().get_fields()
+        tree = parse_expand(self.get_expand())
+        module = sys.modules[type(self).__module__]
+
+        for name, (serializer_class, kwargs) in self.Meta.expandable_fields.items():
+            source = kwargs.get("source", name)
+            if name in tree:
+                if isinstance(serializer_class, str):
+                    serializer_class = getattr(module, serializer_class)
+                if issubclass(serializer_class, ExpandableFieldsMixin):
+                    kwargs = {**kwargs, "expand": tree[name]}
+                fields[name] = serializer_class(read_only=True, **kwargs)
+                continue
+
+            relation = get_relation(self.Meta.model, source)
+            if relation is not None and relation.concrete and not relation.many_to_many:
+                fields[name] = serializers.PrimaryKeyRelatedField(
+                    read_only=True, source=None if source == name else source
+                )
+            else:
+                fields.pop(name, None)
+
+        return fields
+
+
+class SparseFieldsMixin:
+    """
+    Lets the caller of a read request choose the rendered fields of the
+    top-level serializer with `?fields=id,nom` or `?omit=inspections`.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if (
+            request is None
+            or request.method not in SAFE_METHODS
+            or not is_top_level(self)
+        ):
+            return fields
+
+        requested = split_param(request.query_params.get("fields"))
+        omitted = split_param(request.query_params.get("omit"))
+        for name in list(fields):
+            if (requested and name not in requested) or name in omitted:
+                fields.pop(name)
+        return fields
+
+
+def plan_queryset(queryset, serializer, skip=None, narrow=True):
+    """
+    Adds to `queryset` the select_related/prefetch_related lookups needed to
+    render `serializer`, so that any expansion runs in a constant number of
+    queries, and defers with `.only()` the columns no rendered field reads.
+    `skip` names a foreign key already filled by a parent prefetch.
+    """
+    select = set()
+    prefetch = {}
+    only = _plan(
+        serializer,
+        queryset.model,
+        "",
+        select,
+        prefetch,
+        skip,
+        annotations=queryset.query.annotations,
+        narrow=narrow,
+    )
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch.values())
+    if narrow and only is not None:
+        if skip:
+            only.add(skip)
+        queryset = queryset.only(*only)
+    return queryset
+
+
+def _plan(
+    serializer,
+    model,
+    prefix,
+    select,
+    prefetch,
+    skip=None,
+    annotations=(),
+    narrow=True,
+):
+    """
+    Collects the lookups needed by `serializer` and returns the columns it
+    reads, or None when some field (a method, a property, ...) may read
+    anything.
+    """
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+
+    only = set()
+    narrowable = True
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if field.source == "*":
+            narrowable = False
+            continue
+        name = field.source.split(".")[0]
+        if name == skip:
+            continue
+
+        relation = get_relation(model, name)
+        if relation is None:
+            if name in annotations:
+                continue
+            try:
+                model_field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                model_field = None
+            if model_field is not None and model_field.concrete:
+                only.add(prefix + name)
+            else:
+                narrowable = False
+            continue
+
+        lookup = prefix + name
+        nested = field
+        if isinstance(field, serializers.ListSerializer):
+            nested = field.child
+        is_serializer = isinstance(nested, serializers.BaseSerializer)
+
+        if relation.one_to_many or relation.many_to_many:
+            if is_serializer:
+                back = relation.field.name if relation.one_to_many else None
+                child_queryset = plan_queryset(
+                    relation.related_model._default_manager.all(),
+                    nested,
+                    back,
+                    narrow=narrow,
+                )
+                prefetch[lookup] = Prefetch(lookup, queryset=child_queryset)
+            else:
+                prefetch.setdefault(lookup, lookup)
+        elif is_serializer:
+            select.add(lookup)
+            only.add(lookup)
+            nested_only = _plan(
+                nested,
+                relation.related_model,
+                lookup + "__",
+                select,
+                prefetch,
+                narrow=narrow,
+            )
+            # Without restrictions, the related row is loaded entirely
+            if nested_only is not None:
+                only.update(nested_only)
+        else:
+            only.add(lookup)
+            if not (
+                isinstance(field, serializers.PrimaryKeyRelatedField)
+                and field.source == name
+            ):
+                # StringRelatedField, dotted sources, ... need the related row
+                select.add(lookup)
+
+    return only if narrowable else None
+
+
+class DynamicFieldsViewSetMixin:
+    """
+    Reads `?expand=` (or `default_expand` when absent) for the serializer and
+    plans the queryset from the fields that will actually be rendered, so
+    that `?fields=`/`?omit=` also narrow the columns and prefetches.
+    """
+
+    default_expand = ()
+
+    def get_expand(self):
+        request = getattr(self, "request", None)
+        expand = request.query_params.get("expand") if request else None
+        if expand is None:
+            return list(self.default_expand)
+        return [path.strip() for path in expand.split(",") if path.strip()]
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["expand"] = self.get_expand()
+        return context
+
+    def get_queryset(self):
+        # Instances loaded for writes are saved back, keep them complete
+        narrow = self.request is not None and self.request.method in SAFE_METHODS
+        return plan_queryset(
+            super().get_queryset(), self.get_serializer(), narrow=narrow
+        )
+
+
+class ConditionalGetMixin:
+    """
+    Answers list and detail requests with 304 Not Modified while the
+    client's copy is current (If-None-Match, or If-Modified-Since for
+    details), checked before any serialization or prefetch. The validator
+    of a list is the data version of its model, bumped once every write
+    commits (see signals.py), so that no query runs over the collection,
+    which keyset pages never count; that of a detail is the row's
+    `validator_field`. Both include the data versions of `validator_models`,
+    the models rendered nested in the representation or whose deletion sets
+    its foreign keys to NULL without a signal.
+
+    Lists send no Last-Modified, as deleting a row doesn't change it, and
+    neither do details with `validator_models`, whose nested rows can change
+    without their own.
+    """
+
+    validator_field = "updated_at"
+    validator_models = ()
+
+    def get_etag(self, request, *validator, models=()):
+        models = (*models, *self.validator_models)
+        versions = get_data_version(*models) if models else ""
+        # The URL and media type select the representation
+        key = "|".join(
+            str(part)
+            for part in (
+                request.get_full_path(),
+                request.accepted_media_type,
+                versions,
+                *validator,
+            )
+        )
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+    def conditional_response(self, request, etag, last_modified, render):
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = render()
+        if response.status_code in (200, 304):
+            response["ETag"] = etag
+            if timestamp is not None:
+                response["Last-Modified"] = http_date(timestamp)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        etag = self.get_etag(request, models=[self.queryset.model])
+        return self.conditional_response(
+            request,
+            etag,
+            None,
+            functools.partial(super().list, request, *args, **kwargs),
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            last = (
+                self.filter_queryset(self.get_queryset())
+                .select_related(None)
+                .prefetch_related(None)
+                .filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+                .values_list(self.validator_field, flat=True)
+                .first()
+            )
+        except (TypeError, ValueError, ValidationError):
+            last = None
+        if last is None:
+            # Not found: get_object() answers
+            return super().retrieve(request, *args, **kwargs)
+
+        etag = self.get_etag(request, last)
+        return self.conditional_response(
+            request,
+            etag,
+            None if self.validator_models else last,
+            functools.partial(super().retrieve, request, *args, **kwargs),
+        )
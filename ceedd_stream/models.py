@@ -1,4 +1,11 @@
+from decimal import Decimal
+
 from django.contrib.gis.db import models
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Upper
 from django.utils import timezone
 
 
@@ -8,11 +15,64 @@ class Shp(models.Model):
     description = models.CharField(max_length=1000, blank=True)
     file = models.FileField(upload_to="shapefiles/%Y/%m/%d/")
     uploaded_date = models.DateTimeField(auto_now_add=True)
+    # Derived artifacts, computed once at ingest time (see shapefiles.py)
+    bbox = models.JSONField(null=True, blank=True)
+    feature_count = models.PositiveIntegerField(null=True, blank=True)
+    crs = models.CharField(max_length=255, blank=True)
+    geojson = models.FileField(
+        upload_to="shapefiles/geojson/%Y/%m/%d/", null=True, blank=True
+    )
+    # Name of the source file the artifacts above were built from
+    artifacts_source = models.CharField(max_length=255, blank=True)
 
     def __str__(self):
         return self.name
 
 
+class ZoneContributiveQuerySet(models.QuerySet):
+    def with_aggregates(self):
+        """
+        Annotates each zone with its infrastructure count, summed capacite,
+        summed financing and last inspection date. Each aggregate is a
+        correlated subquery, so they don't multiply each other's rows and
+        the whole list is computed in a single SQL statement.
+        """
+        infrastructures = (
+            Infrastructure.objects.filter(zone=OuterRef("pk")).order_by().values("zone")
+        )
+        finances = (
+            Finance.objects.filter(infrastructure__zone=OuterRef("pk"))
+            .order_by()
+            .values("infrastructure__zone")
+        )
+        inspections = (
+            Inspection.objects.filter(infrastructure__zone=OuterRef("pk"))
+            .order_by()
+            .values("infrastructure__zone")
+        )
+        amount = models.DecimalField(max_digits=20, decimal_places=2)
+
+        return self.annotate(
+            infrastructures_count=Coalesce(
+                Subquery(infrastructures.annotate(n=Count("pk")).values("n")),
+                0,
+            ),
+            total_capacite=Coalesce(
+                Subquery(infrastructures.annotate(s=Sum("capacite")).values("s")),
+                Value(Decimal(0)),
+                output_field=amount,
+            ),
+            total_financement=Coalesce(
+                Subquery(finances.annotate(s=Sum("montant")).values("s")),
+                Value(Decimal(0)),
+                output_field=amount,
+            ),
+            derniere_inspection=Subquery(
+                inspections.annotate(d=Max("date")).values("d")
+            ),
+        )
+
+
 class ZoneContributive(models.Model):
     nom = models.CharField(max_length=255)
     # superficie = models.DecimalField(
@@ -29,10 +89,27 @@ class ZoneContributive(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ZoneContributiveQuerySet.as_manager()
+
     def __str__(self):
         return self.nom
 
 
+# One feature of an uploaded shapefile, reprojected to EPSG:4326
+class ShpFeature(models.Model):
+    shp = models.ForeignKey(Shp, related_name="features", on_delete=models.CASCADE)
+    fid = models.PositiveIntegerField()
+    properties = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    # spatial_index (default) creates the GiST index on PostGIS
+    geom = models.GeometryField(srid=4326, null=True, blank=True)
+
+    class Meta:
+        unique_together = ("shp", "fid")
+
+    def __str__(self):
+        return f"{self.shp} #{self.fid}"
+
+
 class Bailleur(models.Model):
     nom = models.CharField(max_length=255)
     sigle = models.CharField(max_length=50, null=True, blank=True)
@@ -74,6 +151,34 @@ class Client(models.Model):
 
     class Meta:
         unique_together = ("nom", "postnom", "prenom")
+        # Exact-match address filters (see views.get_volume_by_filters)
+        indexes = [
+            models.Index(fields=["commune"], name="client_commune_idx"),
+            models.Index(fields=["quartier"], name="client_quartier_idx"),
+            models.Index(fields=["avenue"], name="client_avenue_idx"),
+            models.Index(fields=["province"], name="client_province_idx"),
+            # Trigram indexes on UPPER(), which serve both icontains and the
+            # fuzzy search (see filters.FuzzySearchFilter)
+            GinIndex(
+                OpClass(Upper("nom"), name="gin_trgm_ops"), name="client_nom_trgm_idx"
+            ),
+            GinIndex(
+                OpClass(Upper("avenue"), name="gin_trgm_ops"),
+                name="client_avenue_trgm_idx",
+            ),
+            GinIndex(
+                OpClass(Upper("quartier"), name="gin_trgm_ops"),
+                name="client_quartier_trgm_idx",
+            ),
+            GinIndex(
+                OpClass(Upper("commune"), name="gin_trgm_ops"),
+                name="client_commune_trgm_idx",
+            ),
+            GinIndex(
+                OpClass(Upper("province"), name="gin_trgm_ops"),
+                name="client_province_trgm_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.prenom} {self.nom}".strip()
@@ -82,6 +187,12 @@ class Client(models.Model):
     def full_name(self):
         return f"{self.prenom} {self.postnom} {self.nom}".strip()
 
+    def save(self, *args, **kwargs):
+        # Address changes move the rollup of its infrastructures from a row
+        # locked in pre_save (see signals.remember_client_address)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
 
 class Infrastructure(models.Model):
     client = models.ForeignKey(
@@ -107,6 +218,19 @@ class Infrastructure(models.Model):
 
     class Meta:
         unique_together = ("client", "nom")
+        indexes = [
+            # Keyset pagination order (see pagination.KeysetPagination)
+            models.Index(
+                fields=["created_at", "id"], name="infrastructure_created_idx"
+            ),
+            # Date filters and series of views.get_volume_by_date
+            models.Index(fields=["date_construction"], name="infrastructure_date_idx"),
+            # icontains and fuzzy search on the name
+            GinIndex(
+                OpClass(Upper("nom"), name="gin_trgm_ops"),
+                name="infrastructure_nom_trgm_idx",
+            ),
+        ]
 
     def __str__(self):
         return self.nom or f"Infrastructure {self.id}"
@@ -120,7 +244,10 @@ class Infrastructure(models.Model):
             from django.contrib.gis.geos import Point
 
             self.location = Point(self.longitude, self.latitude, srid=4326)
-        super().save(*args, **kwargs)
+        # The rollup signals lock the row in pre_save and move its
+        # contribution in post_save (see signals.remember_rollup_state)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
 
 class Finance(models.Model):
@@ -167,6 +294,11 @@ class Inspection(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="inspection_created_idx")
+        ]
+
     def __str__(self):
         return f"Inspection {self.id} - {self.infrastructure}"
 
@@ -188,13 +320,176 @@ class Photo(models.Model):
     description = models.TextField(null=True, blank=True)
     numero_photo = models.CharField(max_length=100, null=True, blank=True)
     date_prise = models.DateField(null=True, blank=True)
+    # Renditions built in the background from `url` (see derivatives.py)
+    thumbnail_webp = models.FileField(
+        upload_to="photos/derivatives/", null=True, blank=True
+    )
+    thumbnail_jpeg = models.FileField(
+        upload_to="photos/derivatives/", null=True, blank=True
+    )
+    medium_webp = models.FileField(
+        upload_to="photos/derivatives/", null=True, blank=True
+    )
+    medium_jpeg = models.FileField(
+        upload_to="photos/derivatives/", null=True, blank=True
+    )
+    # URL the renditions above were built from, and why building failed
+    derivatives_source = models.CharField(max_length=500, blank=True)
+    derivatives_error = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="photo_created_idx"),
+            # Photos of given objects (see photos.photos_by_object)
+            models.Index(fields=["content_type", "object_id"], name="photo_object_idx"),
+        ]
+
     def __str__(self):
         return f"Photo for {self.content_object}"
 
 
+# A spreadsheet import, run chunk by chunk (see imports.py)
+class ImportJob(models.Model):
+    kind = models.CharField(
+        max_length=50,
+        choices=[("infrastructures", "Infrastructures"), ("clients", "Clients")],
+    )
+    file = models.FileField(upload_to="imports/%Y/%m/%d/")
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            ("pending", "En attente"),
+            ("running", "En cours"),
+            ("done", "Terminé"),
+            ("failed", "Échoué"),
+        ],
+        default="pending",
+    )
+    # Share of the file read so far, from 0 to 1
+    progress = models.FloatField(default=0)
+    processed_rows = models.PositiveIntegerField(default=0)
+    written_rows = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    # First errors only, as {"row": line in the file, "errors": {...}}
+    errors = models.JSONField(default=list, blank=True)
+    message = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Import {self.id} ({self.kind}, {self.status})"
+
+
+# A unit of background work, claimed and run by the run_jobs command
+# (see jobs.py)
+class Job(models.Model):
+    kind = models.CharField(
+        max_length=50,
+        choices=[
+            ("import", "Import"),
+            ("ingest_shapefile", "Shapefile"),
+            ("photo_derivatives", "Miniatures"),
+        ],
+    )
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            ("pending", "En attente"),
+            ("running", "En cours"),
+            ("done", "Terminé"),
+            ("failed", "Échoué"),
+        ],
+        default="pending",
+    )
+    # Reported by the job while it runs, from 0 to 1
+    progress = models.FloatField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    message = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Also the heartbeat of a running job
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Queue order of the pending jobs (see jobs.claim_job)
+            models.Index(
+                fields=["created_at", "id"],
+                condition=models.Q(status="pending"),
+                name="job_pending_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.kind}, {self.status})"
+
+
+# Number and capacite of the infrastructures of each address, type, zone and
+# construction month, kept up to date by signals (see rollups.py). Deleting a
+# type or zone merges its rows into those without one before SET_NULL runs.
+class CapaciteRollup(models.Model):
+    province = models.CharField(max_length=255, null=True, blank=True)
+    commune = models.CharField(max_length=255, null=True, blank=True)
+    quartier = models.CharField(max_length=255, null=True, blank=True)
+    type_infrastructure = models.ForeignKey(
+        TypeInfrastructure,
+        related_name="+",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    zone = models.ForeignKey(
+        ZoneContributive,
+        related_name="+",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    # First day of the construction month
+    month = models.DateField(null=True, blank=True)
+    infrastructures_count = models.IntegerField(default=0)
+    # Infrastructures with a capacite, for averages
+    capacite_count = models.IntegerField(default=0)
+    capacite_total = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            # One row per key, NULLs included, which writers upsert into
+            models.UniqueConstraint(
+                fields=[
+                    "province",
+                    "commune",
+                    "quartier",
+                    "type_infrastructure",
+                    "zone",
+                    "month",
+                ],
+                name="capacite_rollup_key_uniq",
+                nulls_distinct=False,
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.commune} / {self.quartier} / {self.month}"
+
+
+# Version of the data of a model, bumped on every write to it, which cached
+# tiles and responses are keyed by (see cache.py)
+class DataVersion(models.Model):
+    # app_label.model_name
+    model = models.CharField(max_length=100, primary_key=True)
+    version = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.model} v{self.version}"
+
+
 # class Role(models.Model):
 #     ROLES = [
 #         ('admin', 'Admin'),
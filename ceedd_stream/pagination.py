@@ -0,0 +1,128 @@
+import json
+
+from django.db import connections
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .filters import SEARCH_RANK
+
+
+class FeaturePagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination over the features of a layer, with an optional
+    count-free cursor mode (`?cursor=<feature id>`) for sequential reads.
+    """
+
+    cursor_query_param = "cursor"
+    cursor_field = "fid"
+    max_limit = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.cursor = self.get_cursor(request)
+        if self.cursor is None:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.limit = self.get_limit(request)
+        # Keyset read on the (shp, fid) index, plus one row to know whether
+        # there is a next page
+        lookup = {f"{self.cursor_field}__gte": self.cursor}
+        page = list(queryset.filter(**lookup)[: self.limit + 1])
+        self.next_cursor = None
+        if len(page) > self.limit:
+            self.next_cursor = getattr(page[self.limit], self.cursor_field)
+        return page[: self.limit]
+
+    def get_cursor(self, request):
+        try:
+            cursor = int(request.query_params[self.cursor_query_param])
+        except (KeyError, ValueError):
+            return None
+        return max(cursor, 0)
+
+    def get_next_cursor_link(self):
+        if self.next_cursor is None:
+            return None
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.offset_query_param
+        )
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        if self.cursor is None:
+            return super().get_paginated_response(data)
+        return Response({"next": self.get_next_cursor_link(), "results": data})
+
+
+def estimate_count(queryset):
+    """
+    Returns the number of rows the PostgreSQL planner expects `queryset` to
+    return, from its statistics and without scanning the table, or None on
+    other databases.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Count-free cursor pagination, newest first, on the (created_at, id)
+    index of the collection: every page is an index range read, however
+    deep. `?count=true` adds the planner's estimate of the total.
+
+    Results ranked by a fuzzy search (see filters.FuzzySearchFilter) keep
+    their order and are returned as a single page of the best matches.
+    """
+
+    ordering = ("-created_at", "-id")
+    page_size_query_param = "limit"
+    max_page_size = 1000
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ("1", "true"):
+            self.count = estimate_count(queryset)
+
+        if SEARCH_RANK in queryset.query.annotations:
+            self.base_url = request.build_absolute_uri()
+            self.page_size = self.get_page_size(request)
+            self.cursor = None
+            self.has_next = self.has_previous = False
+            self.page = list(queryset[: self.page_size])
+            return self.page
+
+        # The cursor is built from the ordering fields of the page's rows,
+        # load them along with columns narrowed by .only()
+        field_names, defer = queryset.query.deferred_loading
+        if field_names and not defer:
+            ordering = [
+                field.lstrip("-")
+                for field in self.get_ordering(request, queryset, view)
+            ]
+            queryset = queryset.only(*field_names, *ordering)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data["count"] = self.count
+        return response
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema["properties"]["count"] = {
+            "type": "integer",
+            "nullable": True,
+            "description": "Estimated total, only with ?count=true",
+        }
+        return schema
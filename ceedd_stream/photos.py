@@ -0,0 +1,79 @@
+"""
+Lookup of the photos attached to objects through Photo's generic relation.
+
+Content types are resolved by model name within this app, through Django's
+in-process ContentType cache, so naming a model costs no query and can't
+match a model of another app. The photos of any number of objects, of one
+or several models, are read with a single query on the (content_type,
+object_id) index, with the described objects prefetched.
+"""
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes.prefetch import GenericPrefetch
+from django.db.models import Q
+
+from .models import Bailleur, Infrastructure, Inspection, Photo, ZoneContributive
+
+# Models photos can be attached to
+PHOTO_MODELS = ("infrastructure", "bailleur", "zonecontributive", "inspection")
+# Objects per batch lookup
+MAX_PHOTO_OBJECTS = 200
+
+
+def get_photo_content_type(model_name):
+    """Returns the ContentType of `model_name`, or None if photos can't use it."""
+    model_name = (model_name or "").lower()
+    if model_name not in PHOTO_MODELS:
+        return None
+    model = apps.get_model("ceedd_stream", model_name)
+    return ContentType.objects.get_for_model(model)
+
+
+def prefetch_photo_objects(queryset):
+    """
+    Loads the content type of each photo in the main query, and the objects
+    the photos are attached to with one query per content type, so that
+    describing a page of photos (see PhotoSerializer.get_related_object)
+    runs a constant number of queries.
+    """
+    return queryset.select_related("content_type").prefetch_related(
+        GenericPrefetch(
+            "content_object",
+            [
+                Infrastructure.objects.all(),
+                Bailleur.objects.all(),
+                ZoneContributive.objects.all(),
+                # str() of an inspection names its infrastructure
+                Inspection.objects.select_related("infrastructure"),
+            ],
+        )
+    )
+
+
+def photos_by_object(objects):
+    """
+    Returns the photos of `objects`, (ContentType, object id) pairs, as a
+    dict of lists by pair, every pair included.
+    """
+    ids_by_type = {}
+    for content_type, object_id in objects:
+        ids_by_type.setdefault(content_type, set()).add(object_id)
+
+    grouped = {
+        (content_type, object_id): []
+        for content_type, ids in ids_by_type.items()
+        for object_id in ids
+    }
+    if not grouped:
+        return grouped
+
+    condition = Q()
+    for content_type, ids in ids_by_type.items():
+        condition |= Q(content_type=content_type, object_id__in=ids)
+    photos = prefetch_photo_objects(Photo.objects.filter(condition)).order_by(
+        "object_id", "id"
+    )
+    for photo in photos:
+        grouped[(photo.content_type, photo.object_id)].append(photo)
+    return grouped
@@ -0,0 +1,258 @@
+"""
+Rollup of infrastructure counts and capacite for the volume statistics.
+
+`CapaciteRollup` holds one row per (province, commune, quartier, type,
+zone, construction month) with the number of infrastructures and their
+summed capacite, so that the statistics read a few rows per group instead
+of aggregating every infrastructure.
+
+It is maintained incrementally: each save or delete of an Infrastructure
+moves its contribution from its old key to its new one, and an address
+change or deletion of a Client moves the contributions of all of its
+infrastructures. The old state is read under a lock of the row, in the
+transaction of the write, so that concurrent writes of the same row never
+both remove the same contribution. Bulk writes of either, which send no per-row signal,
+remove the contributions of the rows they overwrite and add those of the
+rows they wrote (see bulk.bulk_saving). Deleting a type or zone merges its
+rows into the keys without one. Each key is stored on a single row (a
+unique constraint treating NULLs as equal), which amounts are added to with
+INSERT ... ON CONFLICT DO UPDATE, so concurrent writers never create it
+twice.
+"""
+
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import (
+    Count,
+    DecimalField,
+    ExpressionWrapper,
+    F,
+    Q,
+    Sum,
+    Value,
+)
+from django.db.models.functions import Coalesce, NullIf, TruncMonth
+
+from .models import CapaciteRollup, Infrastructure
+
+ADDRESS_FIELDS = ("province", "commune", "quartier")
+KEY_FIELDS = (*ADDRESS_FIELDS, "type_infrastructure_id", "zone_id", "month")
+AMOUNT_FIELDS = ("infrastructures_count", "capacite_count", "capacite_total")
+# Keys per INSERT statement
+ROLLUP_BATCH_SIZE = 1000
+
+
+def rollup_aggregates():
+    """Aggregates over rollup rows matching those computed on Infrastructure."""
+    return {
+        # NULL, like Sum("capacite"), when no infrastructure has a capacite
+        "total_volume": Sum("capacite_total", filter=Q(capacite_count__gt=0)),
+        "count": Coalesce(Sum("infrastructures_count"), 0),
+        "average_volume": ExpressionWrapper(
+            Sum("capacite_total") / NullIf(Sum("capacite_count"), 0),
+            output_field=DecimalField(max_digits=20, decimal_places=2),
+        ),
+    }
+
+
+def live_rows(queryset=None):
+    """Aggregates `queryset` (every infrastructure by default) by rollup key."""
+    if queryset is None:
+        queryset = Infrastructure.objects.all()
+    return (
+        queryset.values(
+            "type_infrastructure_id",
+            "zone_id",
+            province=F("client__province"),
+            commune=F("client__commune"),
+            quartier=F("client__quartier"),
+            month=TruncMonth("date_construction"),
+        )
+        .annotate(
+            infrastructures_count=Count("id"),
+            capacite_count=Count("capacite"),
+            capacite_total=Coalesce(Sum("capacite"), Value(Decimal(0))),
+        )
+        .order_by()
+    )
+
+
+def infrastructure_state(pk, lock=False):
+    """
+    Returns the rollup key and capacite stored for Infrastructure `pk`,
+    locking its row until the transaction ends when `lock` is set.
+    """
+    queryset = Infrastructure.objects.filter(pk=pk)
+    if lock:
+        # Not the client, on the nullable side of the join
+        queryset = queryset.select_for_update(of=("self",))
+    return queryset.values(
+        "type_infrastructure_id",
+        "zone_id",
+        "capacite",
+        province=F("client__province"),
+        commune=F("client__commune"),
+        quartier=F("client__quartier"),
+        month=TruncMonth("date_construction"),
+    ).first()
+
+
+def add_delta(deltas, key, amounts, sign=1):
+    """Adds `amounts` times `sign` to those of `key` in `deltas`."""
+    current = deltas.get(key, (0, 0, Decimal(0)))
+    deltas[key] = tuple(
+        total + sign * amount for total, amount in zip(current, amounts)
+    )
+
+
+def add_to_rollup(deltas):
+    """
+    Adds amounts, negative to remove them, to the rollup. `deltas` maps
+    keys, tuples of the KEY_FIELDS values, to (count, capacite_count,
+    capacite_total). Rows left without infrastructure are deleted.
+    """
+    # Rows locked in the same order by every writer, so they can't deadlock
+    keys = sorted(
+        (key for key, amounts in deltas.items() if any(amounts)),
+        key=lambda key: [(value is not None, value) for value in key],
+    )
+    table = CapaciteRollup._meta.db_table
+    columns = [CapaciteRollup._meta.get_field(name).column for name in KEY_FIELDS]
+    placeholders = f"({', '.join(['%s'] * (len(columns) + len(AMOUNT_FIELDS)))})"
+    empty = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(keys), ROLLUP_BATCH_SIZE):
+            batch = keys[start : start + ROLLUP_BATCH_SIZE]
+            cursor.execute(
+                f"""
+                INSERT INTO {table} ({", ".join(columns + list(AMOUNT_FIELDS))})
+                VALUES {", ".join([placeholders] * len(batch))}
+                ON CONFLICT ({", ".join(columns)}) DO UPDATE SET {", ".join(
+                    f"{name} = {table}.{name} + EXCLUDED.{name}"
+                    for name in AMOUNT_FIELDS
+                )}
+                RETURNING id, infrastructures_count
+                """,
+                [value for key in batch for value in (*key, *deltas[key])],
+            )
+            empty += [pk for pk, count in cursor.fetchall() if count <= 0]
+    if empty:
+        CapaciteRollup.objects.filter(pk__in=empty).delete()
+
+
+def collect_deltas(queryset, sign, deltas=None):
+    """
+    Adds the contributions of the infrastructures of `queryset`, times
+    `sign`, to `deltas` and returns it.
+    """
+    if deltas is None:
+        deltas = {}
+    for row in live_rows(queryset).iterator():
+        add_delta(
+            deltas,
+            tuple(row[field] for field in KEY_FIELDS),
+            tuple(row[amount] for amount in AMOUNT_FIELDS),
+            sign,
+        )
+    return deltas
+
+
+def move_infrastructure(old, new):
+    """Moves one infrastructure from state `old` to state `new` (either None)."""
+    if old == new:
+        return
+    deltas = {}
+    for state, sign in ((old, -1), (new, 1)):
+        if state is None:
+            continue
+        capacite = state["capacite"]
+        add_delta(
+            deltas,
+            tuple(state[field] for field in KEY_FIELDS),
+            (1, int(capacite is not None), capacite or Decimal(0)),
+            sign,
+        )
+    add_to_rollup(deltas)
+
+
+def move_client(client_id, old_address, new_address):
+    """Moves the infrastructures of a client from one address to another."""
+    if old_address == new_address:
+        return
+    positions = [KEY_FIELDS.index(field) for field in ADDRESS_FIELDS]
+    deltas = {}
+    infrastructures = Infrastructure.objects.filter(client_id=client_id)
+    for key, amounts in collect_deltas(infrastructures, 1).items():
+        for address, sign in ((old_address, -1), (new_address, 1)):
+            moved = list(key)
+            for position, value in zip(positions, address):
+                moved[position] = value
+            add_delta(deltas, tuple(moved), amounts, sign)
+    add_to_rollup(deltas)
+
+
+def merge_deleted_key(field, pk):
+    """
+    Moves the rows keyed by the TypeInfrastructure or ZoneContributive `pk`,
+    about to be deleted, to the keys without one, as SET_NULL does with its
+    infrastructures.
+    """
+    position = KEY_FIELDS.index(f"{field}_id")
+    deltas = {}
+    rows = CapaciteRollup.objects.filter(**{f"{field}_id": pk}).values_list(
+        *KEY_FIELDS, *AMOUNT_FIELDS
+    )
+    for row in rows:
+        key, amounts = row[: len(KEY_FIELDS)], row[len(KEY_FIELDS) :]
+        add_delta(deltas, key, amounts, -1)
+        add_delta(deltas, key[:position] + (None,) + key[position + 1 :], amounts)
+    add_to_rollup(deltas)
+
+
+def rebuild_rollup():
+    """
+    Recomputes the whole rollup from Infrastructure, blocking its readers
+    and writers meanwhile (see the rebuild_rollup command).
+    """
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            # Incremental updates wait until the rebuild is committed
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"LOCK TABLE {CapaciteRollup._meta.db_table} IN EXCLUSIVE MODE"
+                )
+        CapaciteRollup.objects.all().delete()
+        CapaciteRollup.objects.bulk_create(
+            (CapaciteRollup(**row) for row in live_rows().iterator()),
+            batch_size=1000,
+        )
+
+
+def verify_rollup():
+    """
+    Compares the rollup with Infrastructure and returns the differing keys
+    as (key, expected, stored), the amounts being (count, capacite_count,
+    capacite_total).
+    """
+    expected = {}
+    for row in live_rows().iterator():
+        key = tuple(row[field] for field in KEY_FIELDS)
+        expected[key] = tuple(row[amount] for amount in AMOUNT_FIELDS)
+
+    # There should be one row per key, left empty by no write: a key stored
+    # twice is reported with its summed amounts even if they are right
+    stored = {}
+    duplicated = set()
+    rows = CapaciteRollup.objects.values_list(*KEY_FIELDS, *AMOUNT_FIELDS)
+    for row in rows.iterator():
+        key = row[: len(KEY_FIELDS)]
+        if key in stored:
+            duplicated.add(key)
+        add_delta(stored, key, row[len(KEY_FIELDS) :])
+
+    return [
+        (key, expected.get(key), stored.get(key))
+        for key in expected.keys() | stored.keys()
+        if key in duplicated or expected.get(key) != stored.get(key)
+    ]
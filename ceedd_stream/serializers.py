@@ -1,9 +1,14 @@
+import os
+
 from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
 from rest_framework import serializers
-from django.contrib.contenttypes.models import ContentType
 
-# from rest_framework_gis.serializers import GeoFeatureModelSerializer
+from rest_framework_gis.serializers import GeoFeatureModelSerializer
 
+from .bulk import BulkListSerializer
+from .derivatives import DERIVATIVE_FIELDS
+from .mixins import ExpandableFieldsMixin, SparseFieldsMixin
 from .models import (
     ZoneContributive,
     Bailleur,
@@ -11,20 +16,34 @@ from .models import (
     Client,
     Infrastructure,
     Finance,
+    ImportJob,
     Inspection,
+    Job,
     Photo,
     Shp,
+    ShpFeature,
 )
+from .photos import get_photo_content_type
 
 
-class FinanceSerializer(serializers.ModelSerializer):
+class FinanceSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     bailleur = serializers.StringRelatedField()
     infrastructure = serializers.StringRelatedField()
+    # Use PrimaryKeyRelatedField for write operations (POST, PUT)
+    bailleur_id = serializers.PrimaryKeyRelatedField(
+        queryset=Bailleur.objects.all(), source="bailleur", write_only=True
+    )
+    infrastructure_id = serializers.PrimaryKeyRelatedField(
+        queryset=Infrastructure.objects.all(),
+        source="infrastructure",
+        write_only=True,
+    )
 
     class Meta:
         model = Finance
         fields = "__all__"
         # depth = 1
+        list_serializer_class = BulkListSerializer
 
 
 class FinanceNestedSerializer(serializers.ModelSerializer):
@@ -43,7 +62,7 @@ class FinanceNestedSerializer(serializers.ModelSerializer):
         ]
 
 
-class BailleurSerializer(serializers.ModelSerializer):
+class BailleurSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     # finances = FinanceSerializer(many=True, read_only=True)
     finances = FinanceNestedSerializer(many=True, read_only=True)
 
@@ -52,25 +71,22 @@ class BailleurSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class TypeInfrastructureSerializer(serializers.ModelSerializer):
+class TypeInfrastructureSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = TypeInfrastructure
         fields = "__all__"
 
 
-class ClientSerializer(serializers.ModelSerializer):
+class ClientSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Client
         fields = "__all__"
+        list_serializer_class = BulkListSerializer
 
 
-class InfrastructureSerializer(serializers.ModelSerializer):
-    # finances = FinanceSerializer(many=True, read_only=True)
-    client = ClientSerializer(read_only=True)
-    type_infrastructure = TypeInfrastructureSerializer(read_only=True)
-    infrastructure_finances = serializers.SerializerMethodField(read_only=True)
-    inspections = serializers.SerializerMethodField(read_only=True)
-
+class InfrastructureSerializer(
+    SparseFieldsMixin, ExpandableFieldsMixin, serializers.ModelSerializer
+):
     # Use PrimaryKeyRelatedField for write operations (POST, PUT)
     client_id = serializers.PrimaryKeyRelatedField(
         queryset=Client.objects.all(), source="client", write_only=True
@@ -85,33 +101,57 @@ class InfrastructureSerializer(serializers.ModelSerializer):
         model = Infrastructure
         geo_field = "location"
         fields = "__all__"
-
-    def get_infrastructure_finances(self, obj):
-        # finances = Finance.objects.filter(infrastructure=obj)
-        finances = obj.finance_set.all()
-        return FinanceSerializer(finances, many=True).data
-
-    def get_inspections(self, obj):
-        inspections = obj.inspections.all()
-        return InspectionSerializer(inspections, many=True).data
-
-
-class ZoneContributiveSerializer(serializers.ModelSerializer):
-    infrastructures = InfrastructureSerializer(
-        many=True, source="infrastructure_set", read_only=True
+        expandable_fields = {
+            "client": (ClientSerializer, {}),
+            "type_infrastructure": (TypeInfrastructureSerializer, {}),
+            "infrastructure_finances": (
+                FinanceSerializer,
+                {"many": True, "source": "finance_set"},
+            ),
+            "inspections": ("InspectionSerializer", {"many": True}),
+        }
+        list_serializer_class = BulkListSerializer
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        # Same as Infrastructure.save(), which bulk writes don't go through
+        if (
+            attrs.get("location") is None
+            and getattr(self.instance, "location", None) is None
+            and attrs.get("latitude") is not None
+            and attrs.get("longitude") is not None
+        ):
+            attrs["location"] = Point(attrs["longitude"], attrs["latitude"], srid=4326)
+        return attrs
+
+
+class ZoneContributiveSerializer(
+    SparseFieldsMixin, ExpandableFieldsMixin, serializers.ModelSerializer
+):
+    # Annotated by ZoneContributiveQuerySet.with_aggregates()
+    infrastructures_count = serializers.IntegerField(read_only=True)
+    total_capacite = serializers.DecimalField(
+        max_digits=20, decimal_places=2, read_only=True
     )
-    infrastructures_count = serializers.IntegerField(
-        source="infrastructure_set.count", read_only=True
+    total_financement = serializers.DecimalField(
+        max_digits=20, decimal_places=2, read_only=True
     )
+    derniere_inspection = serializers.DateTimeField(read_only=True)
 
     class Meta:
         model = ZoneContributive
         # geo_field = "geom"
         fields = "__all__"
         # read_only_fields = ["geom"]
+        expandable_fields = {
+            "infrastructures": (
+                InfrastructureSerializer,
+                {"many": True, "source": "infrastructure_set"},
+            ),
+        }
 
 
-class InspectionSerializer(serializers.ModelSerializer):
+class InspectionSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     infrastructure_id = serializers.PrimaryKeyRelatedField(
         queryset=Infrastructure.objects.all(),
         source="infrastructure",
@@ -122,10 +162,12 @@ class InspectionSerializer(serializers.ModelSerializer):
         model = Inspection
         fields = "__all__"
         depth = 1
+        list_serializer_class = BulkListSerializer
 
 
-class PhotoSerializer(serializers.ModelSerializer):
+class PhotoSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     related_object = serializers.SerializerMethodField(read_only=True)
+    derivatives = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = Photo
@@ -137,6 +179,7 @@ class PhotoSerializer(serializers.ModelSerializer):
             "content_type",
             "object_id",
             "related_object",
+            "derivatives",
             "created_at",
             "updated_at",
         ]
@@ -154,6 +197,23 @@ class PhotoSerializer(serializers.ModelSerializer):
             }
         return None
 
+    def get_derivatives(self, obj):
+        """
+        Returns the URLs of the resized renditions by size and format, or
+        None until they are built: `url` is then the only one.
+        """
+        if not obj.thumbnail_webp:
+            return None
+        request = self.context.get("request")
+        derivatives = {}
+        for field in DERIVATIVE_FIELDS:
+            rendition, _, extension = field.rpartition("_")
+            url = getattr(obj, field).url
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            derivatives.setdefault(rendition, {})[extension] = url
+        return derivatives
+
     def create(self, validated_data):
         request = self.context["request"]
         model_name = request.data.get("model_name")
@@ -164,19 +224,13 @@ class PhotoSerializer(serializers.ModelSerializer):
                 "`model_name` and `object_id` are required to create a photo."
             )
 
-        # Whitelist allowed models
-        ALLOWED = ["infrastructure", "bailleur", "zonecontributive", "inspection"]
-        m = model_name.lower()
-        if m not in ALLOWED:
+        # Whitelisted models only, resolved within this app
+        ct = get_photo_content_type(model_name)
+        if ct is None:
             raise serializers.ValidationError(
                 f"Model '{model_name}' is not allowed for photo association."
             )
 
-        try:
-            ct = ContentType.objects.get(model=m)
-        except ContentType.DoesNotExist:
-            raise serializers.ValidationError("Invalid model_name.")
-
         # Validate referenced object exists
         model_class = ct.model_class()
         if not model_class.objects.filter(pk=object_id).exists():
@@ -199,7 +253,69 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
-class ShpSerializer(serializers.ModelSerializer):
+class ShpSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Shp
         fields = "__all__"
+        read_only_fields = [
+            "bbox",
+            "feature_count",
+            "crs",
+            "geojson",
+            "artifacts_source",
+        ]
+
+
+class ShpMetadataSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Shp
+        fields = [
+            "id",
+            "name",
+            "description",
+            "uploaded_date",
+            "bbox",
+            "feature_count",
+        ]
+
+
+class ShpFeatureSerializer(GeoFeatureModelSerializer):
+    class Meta:
+        model = ShpFeature
+        geo_field = "geom"
+        id_field = "fid"
+        fields = ["fid", "geom", "properties"]
+
+    def get_properties(self, instance, fields):
+        # Expose the shapefile attributes, not the model columns
+        return instance.properties
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = "__all__"
+        read_only_fields = [
+            "status",
+            "progress",
+            "processed_rows",
+            "written_rows",
+            "error_count",
+            "errors",
+            "message",
+            "finished_at",
+        ]
+
+    def validate_file(self, value):
+        extension = os.path.splitext(value.name)[1].lower()
+        if extension not in (".csv", ".xlsx"):
+            raise serializers.ValidationError(
+                "Only .csv and .xlsx files can be imported."
+            )
+        return value
+
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = "__all__"
@@ -0,0 +1,214 @@
+"""
+Reading of uploaded shapefiles and maintenance of their derived artifacts.
+
+Opening a stored ZIP and decoding every feature is expensive, so it is done
+once when a `Shp` is ingested: every feature is loaded into the indexed
+`ShpFeature` table (reprojected to EPSG:4326), and the bbox, feature count,
+CRS and a serialized GeoJSON FeatureCollection are stored next to the row.
+All later spatial reads query the table or the stored artifact. Ingests
+run on the job queue (see jobs.py), outside of the requests.
+"""
+
+import json
+import os
+import tempfile
+import zipfile
+from contextlib import contextmanager
+
+import fiona
+from django.contrib.gis.db.models import Extent
+from django.contrib.gis.db.models.functions import AsGeoJSON
+from django.contrib.gis.gdal import CoordTransform, SpatialReference
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from fiona.model import to_dict
+
+from .jobs import enqueue
+from .models import Job, Shp, ShpFeature
+
+# Number of features inserted per transaction during ingest
+IMPORT_BATCH_SIZE = 2000
+
+
+class ShapefileError(Exception):
+    """Raised when a stored file does not contain a readable shapefile."""
+
+
+def find_shp(archive):
+    """
+    Returns the name of the .shp inside the ZIP `archive` (a path or a file
+    object), from its central directory, without extracting anything.
+    """
+    try:
+        with zipfile.ZipFile(archive) as z:
+            names = z.namelist()
+    except zipfile.BadZipFile:
+        raise ShapefileError("File must be a .zip containing the shapefile")
+
+    shp_names = sorted(
+        name
+        for name in names
+        if name.lower().endswith(".shp") and not name.startswith("__MACOSX/")
+    )
+    if not shp_names:
+        raise ShapefileError("No .shp file found inside the ZIP")
+    return shp_names[0]
+
+
+@contextmanager
+def open_shapefile(file_path):
+    """
+    Opens the shapefile stored at `file_path` (a .zip archive or a .shp)
+    and yields the fiona collection. An archive is read in place through
+    GDAL's /vsizip/ virtual file system: fiona only reads the members and
+    byte ranges it needs, and nothing is extracted to disk.
+    """
+    if file_path.lower().endswith(".zip"):
+        file_path = f"/vsizip/{file_path}/{find_shp(file_path)}"
+
+    with fiona.open(file_path) as src:
+        yield src
+
+
+def serialize_feature(fid, geometry, properties):
+    """Returns a GeoJSON Feature as text from an already serialized geometry."""
+    return '{"type": "Feature", "id": %d, "geometry": %s, "properties": %s}' % (
+        fid,
+        geometry or "null",
+        json.dumps(properties, cls=DjangoJSONEncoder),
+    )
+
+
+def iter_featurecollection(features):
+    """
+    Yields a GeoJSON FeatureCollection as text chunks, one serialized feature
+    at a time, so that the whole collection never has to be held in memory.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ""
+    for feature in features:
+        yield separator + feature
+        separator = ", "
+    yield "]}"
+
+
+def stream_featurecollection(shp):
+    """
+    Yields the FeatureCollection of `shp` chunk by chunk, straight from a
+    server-side cursor over its `ShpFeature` rows.
+    """
+    rows = (
+        ShpFeature.objects.filter(shp=shp)
+        .order_by("fid")
+        .annotate(geometry=AsGeoJSON("geom"))
+        .values_list("fid", "geometry", "properties")
+        .iterator(chunk_size=IMPORT_BATCH_SIZE)
+    )
+    return iter_featurecollection(serialize_feature(*row) for row in rows)
+
+
+def _save_batch(batch):
+    with transaction.atomic():
+        ShpFeature.objects.bulk_create(batch)
+
+
+def ingest_shapefile(shp):
+    """
+    Reads the source file of `shp` once: loads its features into
+    `ShpFeature` in batched transactions, writes the GeoJSON artifact and
+    stores bbox, feature count and CRS, replacing any previous ingest.
+    """
+    ShpFeature.objects.filter(shp=shp).delete()
+
+    with open_shapefile(shp.file.path) as src, tempfile.TemporaryFile() as tmp:
+        crs = src.crs.to_string() if src.crs else ""
+        transform = None
+        if src.crs_wkt:
+            transform = CoordTransform(
+                SpatialReference(src.crs_wkt), SpatialReference(4326)
+            )
+
+        def features():
+            batch = []
+            for fid, feature in src.items():
+                geom = None
+                if feature["geometry"] is not None:
+                    geom = GEOSGeometry(json.dumps(to_dict(feature["geometry"])))
+                    if transform is not None:
+                        geom.transform(transform)
+                    geom.srid = 4326
+                properties = dict(feature["properties"])
+
+                batch.append(
+                    ShpFeature(
+                        shp=shp,
+                        fid=fid,
+                        properties=properties,
+                        geom=geom,
+                    )
+                )
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    _save_batch(batch)
+                    batch = []
+
+                yield serialize_feature(fid, geom.json if geom else None, properties)
+            _save_batch(batch)
+
+        for chunk in iter_featurecollection(features()):
+            tmp.write(chunk.encode("utf-8"))
+        tmp.seek(0)
+
+        if shp.geojson:
+            shp.geojson.delete(save=False)
+        name = os.path.splitext(os.path.basename(shp.file.name))[0]
+        shp.geojson.save(f"{name}.geojson", File(tmp), save=False)
+
+    features = ShpFeature.objects.filter(shp=shp)
+    extent = features.aggregate(extent=Extent("geom"))["extent"]
+
+    shp.bbox = list(extent) if extent else None
+    shp.crs = crs
+    shp.feature_count = features.count()
+    shp.artifacts_source = shp.file.name
+    shp.save(
+        update_fields=["bbox", "crs", "feature_count", "geojson", "artifacts_source"]
+    )
+
+
+def artifacts_outdated(shp):
+    return bool(shp.file) and (not shp.geojson or shp.artifacts_source != shp.file.name)
+
+
+def delete_artifacts(shp):
+    if shp.geojson:
+        shp.geojson.delete(save=False)
+
+
+def enqueue_ingest(shp):
+    """
+    Queues the ingest of the current file of `shp` and returns its job, or
+    the job already queued, running or failed for that file.
+    """
+    job = (
+        Job.objects.filter(
+            kind="ingest_shapefile", params__shp=shp.pk, params__file=shp.file.name
+        )
+        .exclude(status="done")
+        .order_by("-created_at")
+        .first()
+    )
+    if job is None:
+        job = enqueue("ingest_shapefile", shp=shp.pk, file=shp.file.name)
+    return job
+
+
+def run_ingest_job(job):
+    shp = Shp.objects.filter(pk=job.params["shp"]).first()
+    if shp is None:
+        return None
+    # Unless already built, or superseded by a newer file
+    if shp.file.name == job.params["file"] and artifacts_outdated(shp):
+        ingest_shapefile(shp)
+    return {"shp": shp.pk, "feature_count": shp.feature_count}
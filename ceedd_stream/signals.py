@@ -0,0 +1,178 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .bulk import bulk_saved, bulk_saving
+from .cache import bump_data_version
+from .derivatives import delete_derivatives, derivatives_outdated, schedule_derivatives
+from .models import (
+    Bailleur,
+    Client,
+    Finance,
+    ImportJob,
+    Infrastructure,
+    Inspection,
+    Job,
+    Photo,
+    Shp,
+    TypeInfrastructure,
+    ZoneContributive,
+)
+from .rollups import (
+    ADDRESS_FIELDS,
+    add_to_rollup,
+    collect_deltas,
+    infrastructure_state,
+    merge_deleted_key,
+    move_client,
+    move_infrastructure,
+)
+from .shapefiles import artifacts_outdated, delete_artifacts, enqueue_ingest
+
+# Models whose data version is bumped on every save or delete, invalidating
+# the cached tiles and responses, and the ETags, computed from them
+VERSIONED_MODELS = [
+    Infrastructure,
+    Client,
+    TypeInfrastructure,
+    ZoneContributive,
+    Shp,
+    Bailleur,
+    Finance,
+    Inspection,
+    Photo,
+    ImportJob,
+    Job,
+]
+
+
+@receiver(post_save, sender=Shp)
+def refresh_shp_artifacts(sender, instance, raw=False, **kwargs):
+    # Rebuild, in the background, only when the source file changed since
+    # the last build
+    if raw or not artifacts_outdated(instance):
+        return
+    enqueue_ingest(instance)
+
+
+@receiver(post_delete, sender=Shp)
+def remove_shp_artifacts(sender, instance, **kwargs):
+    delete_artifacts(instance)
+
+
+@receiver(post_save, sender=Photo)
+def refresh_photo_derivatives(sender, instance, raw=False, **kwargs):
+    # Built in the background, only when the URL changed since the last build
+    if raw or not derivatives_outdated(instance):
+        return
+    schedule_derivatives(instance)
+
+
+@receiver(post_delete, sender=Photo)
+def remove_photo_derivatives(sender, instance, **kwargs):
+    delete_derivatives(instance)
+
+
+@receiver(pre_save, sender=Infrastructure)
+def remember_rollup_state(sender, instance, raw=False, **kwargs):
+    # Locked until the rollup is moved in post_save, within the transaction
+    # of Infrastructure.save, so a concurrent write waits for the new state
+    instance._rollup_state = None
+    if not raw and instance.pk is not None:
+        instance._rollup_state = infrastructure_state(instance.pk, lock=True)
+
+
+@receiver(post_save, sender=Infrastructure)
+def update_rollup_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    move_infrastructure(
+        getattr(instance, "_rollup_state", None), infrastructure_state(instance.pk)
+    )
+
+
+@receiver(pre_delete, sender=Infrastructure)
+def update_rollup_on_delete(sender, instance, **kwargs):
+    # Sent within the transaction of the deletion: a concurrent delete waits
+    # for the lock, then finds no row to remove
+    move_infrastructure(infrastructure_state(instance.pk, lock=True), None)
+
+
+@receiver(pre_save, sender=Client)
+def remember_client_address(sender, instance, raw=False, **kwargs):
+    instance._rollup_address = None
+    if not raw and instance.pk is not None:
+        instance._rollup_address = (
+            Client.objects.select_for_update()
+            .filter(pk=instance.pk)
+            .values_list(*ADDRESS_FIELDS)
+            .first()
+        )
+
+
+@receiver(post_save, sender=Client)
+def update_rollup_on_address_change(sender, instance, raw=False, **kwargs):
+    old_address = getattr(instance, "_rollup_address", None)
+    if raw or old_address is None:
+        return
+    new_address = tuple(getattr(instance, field) for field in ADDRESS_FIELDS)
+    move_client(instance.pk, old_address, new_address)
+
+
+@receiver(pre_delete, sender=Client)
+def update_rollup_on_client_delete(sender, instance, **kwargs):
+    # Its infrastructures are kept, without client (SET_NULL)
+    address = tuple(getattr(instance, field) for field in ADDRESS_FIELDS)
+    move_client(instance.pk, address, (None,) * len(ADDRESS_FIELDS))
+
+
+@receiver(pre_delete, sender=TypeInfrastructure)
+def merge_rollup_on_type_delete(sender, instance, **kwargs):
+    # Its infrastructures are kept, without type (SET_NULL), by an UPDATE
+    # sending no signal
+    merge_deleted_key("type_infrastructure", instance.pk)
+
+
+@receiver(pre_delete, sender=ZoneContributive)
+def merge_rollup_on_zone_delete(sender, instance, **kwargs):
+    merge_deleted_key("zone", instance.pk)
+
+
+def bulk_written_infrastructures(sender, pks):
+    if sender is Client:
+        return Infrastructure.objects.filter(client_id__in=pks)
+    return Infrastructure.objects.filter(pk__in=pks)
+
+
+@receiver(bulk_saving, sender=Infrastructure)
+@receiver(bulk_saving, sender=Client)
+def remove_from_rollup_before_bulk_write(sender, pks, **kwargs):
+    add_to_rollup(collect_deltas(bulk_written_infrastructures(sender, pks), -1))
+
+
+@receiver(bulk_saved, sender=Infrastructure)
+@receiver(bulk_saved, sender=Client)
+def add_to_rollup_after_bulk_write(sender, pks, **kwargs):
+    add_to_rollup(collect_deltas(bulk_written_infrastructures(sender, pks), 1))
+
+
+def bump_model_version(sender, **kwargs):
+    # Once committed: bumped earlier, a concurrent request could cache data
+    # read before the commit under the new version
+    transaction.on_commit(lambda: bump_data_version(sender))
+
+
+bulk_saved.connect(bump_model_version, dispatch_uid="bump_version_on_bulk_save")
+
+
+for model in VERSIONED_MODELS:
+    post_save.connect(
+        bump_model_version,
+        sender=model,
+        dispatch_uid=f"bump_version_on_save_{model._meta.label_lower}",
+    )
+    post_delete.connect(
+        bump_model_version,
+        sender=model,
+        dispatch_uid=f"bump_version_on_delete_{model._meta.label_lower}",
+    )
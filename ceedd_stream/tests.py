@@ -1,3 +1,1641 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import fiona
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from openpyxl import Workbook
+from rest_framework.test import APITestCase
+
+from .cache import bump_data_version, get_data_version, get_or_compute
+from .derivatives import DerivativeError, read_source
+from .exports import EXPORT_COLUMNS
+from .imports import run_import
+from .jobs import (
+    JOB_HANDLERS,
+    MAX_ATTEMPTS,
+    STALE_AFTER,
+    JobError,
+    claim_job,
+    enqueue,
+    report_progress,
+    requeue_stale_jobs,
+    run_job,
+)
+from .models import (
+    Bailleur,
+    CapaciteRollup,
+    Client,
+    Finance,
+    ImportJob,
+    Infrastructure,
+    Inspection,
+    Job,
+    Shp,
+    ShpFeature,
+    TypeInfrastructure,
+    ZoneContributive,
+)
+from .pagination import estimate_count
+from .serializers import ClientSerializer, InfrastructureSerializer
+from .shapefiles import ingest_shapefile
+from .tiles import get_tile
+from .views import VOLUME_BUCKETS
+
+# Local caches, so that tests never share entries or throttling state with
+# the server's
+TEST_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def use_temporary_media(test):
+    """Stores the files saved during `test` in a directory of their own."""
+    media = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media)
+    storage = override_settings(
+        MEDIA_ROOT=media,
+        STORAGES={
+            **settings.STORAGES,
+            "default": {
+                "BACKEND": "django.core.files.storage.FileSystemStorage",
+                "OPTIONS": {"location": media, "base_url": "/media/"},
+            },
+        },
+    )
+    storage.enable()
+    test.addCleanup(storage.disable)
+    return media
+
+
+def square(x, y, size=1):
+    return [[(x, y), (x + size, y), (x + size, y + size), (x, y + size), (x, y)]]
+
+
+def write_zipped_shapefile(directory, polygons):
+    """Writes `polygons` as a zipped EPSG:4326 shapefile and returns its path."""
+    source = os.path.join(directory, "source")
+    os.makedirs(source)
+    schema = {"geometry": "Polygon", "properties": {"name": "str"}}
+    with fiona.open(
+        os.path.join(source, "zones.shp"),
+        "w",
+        driver="ESRI Shapefile",
+        crs="EPSG:4326",
+        schema=schema,
+    ) as dst:
+        for name, coordinates in polygons:
+            dst.write(
+                {
+                    "geometry": {"type": "Polygon", "coordinates": coordinates},
+                    "properties": {"name": name},
+                }
+            )
+
+    path = os.path.join(directory, "zones.zip")
+    with zipfile.ZipFile(path, "w") as archive:
+        for name in os.listdir(source):
+            archive.write(os.path.join(source, name), name)
+    return path
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ShapefileIngestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media = use_temporary_media(self)
+
+        path = write_zipped_shapefile(
+            self.media, [("a", square(15, -5)), ("b", square(17, -5))]
+        )
+        with open(path, "rb") as f:
+            self.shp = Shp.objects.create(name="zones.zip", file=File(f, "zones.zip"))
+
+    def test_ingest_loads_features_and_artifacts(self):
+        ingest_shapefile(self.shp)
+
+        self.shp.refresh_from_db()
+        self.assertEqual(self.shp.feature_count, 2)
+        self.assertEqual([round(value) for value in self.shp.bbox], [15, -5, 18, -4])
+        self.assertEqual(self.shp.artifacts_source, self.shp.file.name)
+        self.assertTrue(self.shp.geojson)
+        self.assertEqual(
+            sorted(
+                ShpFeature.objects.filter(shp=self.shp).values_list(
+                    "properties__name", flat=True
+                )
+            ),
+            ["a", "b"],
+        )
+
+    def test_ingest_replaces_previous_features(self):
+        ingest_shapefile(self.shp)
+        ingest_shapefile(self.shp)
+
+        self.assertEqual(ShpFeature.objects.filter(shp=self.shp).count(), 2)
+
+    def test_cached_tiles_are_served_without_queries(self):
+        ingest_shapefile(self.shp)
+        tile = get_tile("shapefiles", 0, 0, 0)
+        self.assertTrue(tile)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_tile("shapefiles", 0, 0, 0), tile)
+
+    def test_zone_tiles_follow_the_shapefile_link(self):
+        ingest_shapefile(self.shp)
+        first = ZoneContributive.objects.create(nom="Zone Kimbondo")
+        second = ZoneContributive.objects.create(nom="Zone Lemba")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.shapefile_id = self.shp
+            first.save()
+        tile = get_tile("zones", 0, 0, 0)
+        self.assertIn(b"Zone Kimbondo", tile)
+        self.assertNotIn(b"Zone Lemba", tile)
+
+        # Relinked after the ingest: the tile draws the new zone only
+        with self.captureOnCommitCallbacks(execute=True):
+            first.shapefile_id = None
+            first.save()
+            second.shapefile_id = self.shp
+            second.save()
+        tile = get_tile("zones", 0, 0, 0)
+        self.assertNotIn(b"Zone Kimbondo", tile)
+        self.assertIn(b"Zone Lemba", tile)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BulkUpsertTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(User.objects.create_user("agent"))
+        self.type = TypeInfrastructure.objects.create(nom="Citerne")
+        self.owner = Client.objects.create(nom="Mbala", prenom="Jean")
+
+    def test_upserts_on_the_unique_key(self):
+        existing = Client.objects.create(nom="Kasongo", prenom="Marie", commune="Lemba")
+
+        response = self.client.post(
+            "/api/v1/clients/bulk/",
+            [
+                {"nom": "Kasongo", "prenom": "Marie", "commune": "Ngaliema"},
+                {"nom": "Ilunga", "prenom": "Paul", "commune": "Limete"},
+            ],
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["errors"], [])
+        ids = {row["index"]: row["id"] for row in response.data["results"]}
+        self.assertEqual(ids[0], existing.pk)
+        existing.refresh_from_db()
+        self.assertEqual(existing.commune, "Ngaliema")
+        self.assertEqual(Client.objects.get(pk=ids[1]).commune, "Limete")
+
+    def test_update_keeps_the_columns_not_sent(self):
+        existing = Client.objects.create(
+            nom="Kasongo", prenom="Marie", commune="Lemba", quartier="Righini"
+        )
+
+        self.client.post(
+            "/api/v1/clients/bulk/",
+            [{"nom": "Kasongo", "prenom": "Marie", "commune": "Ngaliema"}],
+            format="json",
+        )
+
+        existing.refresh_from_db()
+        self.assertEqual(existing.quartier, "Righini")
+
+    def test_rejects_a_key_repeated_in_the_batch(self):
+        response = self.client.post(
+            "/api/v1/clients/bulk/",
+            [
+                {"nom": "Ilunga", "prenom": "Paul", "commune": "Limete"},
+                {"nom": "Ilunga", "prenom": "Paul", "commune": "Lemba"},
+            ],
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["index"] for row in response.data["results"]], [0])
+        self.assertEqual([error["index"] for error in response.data["errors"]], [1])
+        self.assertEqual(
+            Client.objects.get(nom="Ilunga", prenom="Paul").commune, "Limete"
+        )
+
+    def test_rejects_a_unique_value_taken_by_another_key(self):
+        Infrastructure.objects.create(
+            nom="Citerne 1", client=self.owner, type_infrastructure=self.type
+        )
+        other = Client.objects.create(nom="Ilunga", prenom="Paul")
+
+        response = self.client.post(
+            "/api/v1/infrastructures/bulk/",
+            [
+                {
+                    "nom": "Citerne 1",
+                    "client_id": other.pk,
+                    "type_infrastructure_id": self.type.pk,
+                },
+                {
+                    "nom": "Citerne 2",
+                    "client_id": other.pk,
+                    "type_infrastructure_id": self.type.pk,
+                },
+            ],
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["errors"][0]["index"], 0)
+        self.assertIn("nom", response.data["errors"][0]["errors"])
+        self.assertEqual(
+            Infrastructure.objects.get(nom="Citerne 1").client_id, self.owner.pk
+        )
+        self.assertTrue(Infrastructure.objects.filter(nom="Citerne 2").exists())
+
+    def test_reports_invalid_rows_and_writes_the_others(self):
+        response = self.client.post(
+            "/api/v1/infrastructures/bulk/",
+            [
+                {
+                    "nom": "Citerne 1",
+                    "client_id": self.owner.pk,
+                    "type_infrastructure_id": self.type.pk,
+                    "capacite": "1500.50",
+                },
+                {
+                    "nom": "Citerne 2",
+                    "client_id": 0,
+                    "type_infrastructure_id": self.type.pk,
+                },
+                {"client_id": self.owner.pk, "type_infrastructure_id": self.type.pk},
+            ],
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["index"] for row in response.data["results"]], [0])
+        errors = {error["index"]: error["errors"] for error in response.data["errors"]}
+        self.assertIn("client_id", errors[1])
+        self.assertIn("nom", errors[2])
+        self.assertEqual(
+            list(Infrastructure.objects.values_list("nom", flat=True)), ["Citerne 1"]
+        )
+
+    def test_answers_400_when_no_row_is_valid(self):
+        response = self.client.post(
+            "/api/v1/clients/bulk/", [{"prenom": "Paul"}], format="json"
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["results"], [])
+
+    def test_rejects_other_payloads_than_a_list(self):
+        response = self.client.post(
+            "/api/v1/clients/bulk/", {"nom": "Ilunga"}, format="json"
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_batches_over_the_limit(self):
+        with mock.patch("ceedd_stream.bulk.MAX_BATCH_ROWS", 1):
+            response = self.client.post(
+                "/api/v1/clients/bulk/",
+                [{"nom": "Ilunga"}, {"nom": "Kasongo"}],
+                format="json",
+            )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Client.objects.filter(nom="Ilunga").exists())
+
+    def test_updates_rows_without_key_by_id(self):
+        infrastructure = Infrastructure.objects.create(
+            nom="Citerne 1", client=self.owner, type_infrastructure=self.type
+        )
+        inspection = Inspection.objects.create(
+            infrastructure=infrastructure, etat="bon"
+        )
+
+        response = self.client.post(
+            "/api/v1/inspections/bulk/",
+            [
+                {
+                    "id": inspection.pk,
+                    "infrastructure_id": infrastructure.pk,
+                    "etat": "mauvais",
+                },
+                {"id": 0, "infrastructure_id": infrastructure.pk, "etat": "moyen"},
+                {"infrastructure_id": infrastructure.pk, "etat": "moyen"},
+            ],
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["index"] for row in response.data["results"]], [0, 2])
+        self.assertEqual([error["index"] for error in response.data["errors"]], [1])
+        inspection.refresh_from_db()
+        self.assertEqual(inspection.etat, "mauvais")
+        self.assertEqual(Inspection.objects.count(), 2)
+
+    def test_upserts_finances_on_bailleur_and_infrastructure(self):
+        infrastructure = Infrastructure.objects.create(
+            nom="Citerne 1", client=self.owner, type_infrastructure=self.type
+        )
+        bailleur = Bailleur.objects.create(nom="Banque")
+        finance = Finance.objects.create(
+            bailleur=bailleur, infrastructure=infrastructure, montant=100
+        )
+
+        response = self.client.post(
+            "/api/v1/finances/bulk/",
+            [
+                {
+                    "bailleur_id": bailleur.pk,
+                    "infrastructure_id": infrastructure.pk,
+                    "montant": "250.00",
+                }
+            ],
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["results"], [{"index": 0, "id": finance.pk}])
+        finance.refresh_from_db()
+        self.assertEqual(finance.montant, 250)
+
+
+class RollupTestMixin:
+    def setUp(self):
+        self.type = TypeInfrastructure.objects.create(nom="Citerne")
+        self.zone = ZoneContributive.objects.create(nom="Kimbondo")
+        self.owner = Client.objects.create(
+            nom="Mbala", commune="Mont-Ngafula", quartier="Kimbondo"
+        )
+
+    def add_infrastructure(self, nom, **kwargs):
+        return Infrastructure.objects.create(
+            **{
+                "nom": nom,
+                "client": self.owner,
+                "type_infrastructure": self.type,
+                "zone": self.zone,
+                "capacite": Decimal("1000"),
+                "date_construction": datetime.date(2023, 7, 14),
+                **kwargs,
+            }
+        )
+
+    def bulk_write(self, serializer_class, data):
+        serializer = serializer_class(data=data, many=True)
+        rows, errors = serializer.validate_rows(data)
+        self.assertEqual(errors, [])
+        return serializer.save_rows(rows)
+
+    def assert_rollup_matches(self):
+        stderr = io.StringIO()
+        try:
+            call_command(
+                "rebuild_rollup", "--verify", stdout=io.StringIO(), stderr=stderr
+            )
+        except CommandError:
+            self.fail(stderr.getvalue())
+
+
+class RollupTests(RollupTestMixin, TestCase):
+    def test_follows_saves_and_deletes(self):
+        first = self.add_infrastructure("Citerne 1")
+        self.add_infrastructure("Citerne 2", capacite=None)
+        self.add_infrastructure("Citerne 3", date_construction=None)
+        self.assert_rollup_matches()
+
+        first.capacite = Decimal("2500.50")
+        first.date_construction = datetime.date(2024, 1, 3)
+        first.save()
+        self.assert_rollup_matches()
+
+        first.type_infrastructure = None
+        first.zone = None
+        first.save()
+        self.assert_rollup_matches()
+
+        first.delete()
+        self.assert_rollup_matches()
+
+    def test_stores_each_key_on_one_row(self):
+        for index in range(3):
+            self.add_infrastructure(f"Citerne {index}")
+
+        row = CapaciteRollup.objects.get()
+        self.assertEqual(row.infrastructures_count, 3)
+        self.assertEqual(row.capacite_total, Decimal("3000"))
+
+    def test_deletes_rows_left_empty(self):
+        self.add_infrastructure("Citerne 1").delete()
+
+        self.assertFalse(CapaciteRollup.objects.exists())
+
+    def test_rejects_a_second_row_for_a_key_with_nulls(self):
+        CapaciteRollup.objects.create(infrastructures_count=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CapaciteRollup.objects.create(infrastructures_count=1)
+
+    def test_follows_client_address_changes_and_deletion(self):
+        self.add_infrastructure("Citerne 1")
+        self.add_infrastructure("Citerne 2", client=None)
+
+        self.owner.commune = "Lemba"
+        self.owner.save()
+        self.assert_rollup_matches()
+
+        self.owner.delete()
+        self.assert_rollup_matches()
+        self.assertEqual(CapaciteRollup.objects.count(), 1)
+
+    def test_merges_the_rows_of_a_deleted_type(self):
+        self.add_infrastructure("Citerne 1")
+        self.add_infrastructure("Citerne 2", type_infrastructure=None)
+
+        self.type.delete()
+
+        self.assert_rollup_matches()
+        self.assertEqual(CapaciteRollup.objects.get().infrastructures_count, 2)
+
+    def test_merges_the_rows_of_a_deleted_zone(self):
+        self.add_infrastructure("Citerne 1")
+        self.add_infrastructure("Citerne 2", zone=None)
+
+        self.zone.delete()
+
+        self.assert_rollup_matches()
+        self.assertEqual(CapaciteRollup.objects.get().infrastructures_count, 2)
+
+    def test_follows_bulk_writes_of_infrastructures(self):
+        self.add_infrastructure("Citerne 1")
+        self.add_infrastructure(
+            "Citerne 2", date_construction=datetime.date(2020, 1, 1)
+        )
+        untouched_row = CapaciteRollup.objects.get(month=datetime.date(2020, 1, 1))
+        other_type = TypeInfrastructure.objects.create(nom="Puits")
+
+        self.bulk_write(
+            InfrastructureSerializer,
+            [
+                {
+                    "nom": "Citerne 1",
+                    "client_id": self.owner.pk,
+                    "type_infrastructure_id": other_type.pk,
+                    "capacite": "200",
+                },
+                {
+                    "nom": "Citerne 3",
+                    "client_id": self.owner.pk,
+                    "type_infrastructure_id": self.type.pk,
+                    "zone": self.zone.pk,
+                    "date_construction": "2023-07-01",
+                },
+            ],
+        )
+
+        self.assert_rollup_matches()
+        # Only the keys written are touched: the rollup wasn't rebuilt
+        self.assertTrue(CapaciteRollup.objects.filter(pk=untouched_row.pk).exists())
+
+    def test_follows_bulk_writes_of_clients(self):
+        self.add_infrastructure("Citerne 1")
+
+        self.bulk_write(
+            ClientSerializer,
+            [
+                {"nom": "Mbala", "commune": "Lemba", "quartier": "Righini"},
+                {"nom": "Ilunga", "commune": "Limete"},
+            ],
+        )
+
+        self.assert_rollup_matches()
+        self.assertEqual(CapaciteRollup.objects.get().commune, "Lemba")
+
+    def test_rebuild_command_repairs_the_rollup(self):
+        self.add_infrastructure("Citerne 1")
+        CapaciteRollup.objects.update(infrastructures_count=5)
+
+        with self.assertRaises(CommandError):
+            call_command(
+                "rebuild_rollup",
+                "--verify",
+                stdout=io.StringIO(),
+                stderr=io.StringIO(),
+            )
+
+        call_command("rebuild_rollup", stdout=io.StringIO())
+        self.assert_rollup_matches()
+
+
+class RollupConcurrencyTests(RollupTestMixin, TransactionTestCase):
+    def write_concurrently(self, write):
+        """
+        Runs `write` in another connection while this one holds an open
+        transaction, committed once `write` is seen waiting for it.
+        """
+        errors = []
+
+        def worker():
+            try:
+                write()
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        # Waiting for the row this transaction locked
+        thread.join(timeout=1)
+        self.assertTrue(thread.is_alive())
+        return thread, errors
+
+    def test_concurrent_updates_move_the_row_once(self):
+        infrastructure = self.add_infrastructure("Citerne 1")
+        other = Infrastructure.objects.get(pk=infrastructure.pk)
+
+        with transaction.atomic():
+            infrastructure.capacite = Decimal("2000")
+            infrastructure.save()
+
+            other.capacite = Decimal("3000")
+            other.date_construction = datetime.date(2024, 1, 3)
+            thread, errors = self.write_concurrently(other.save)
+        thread.join()
+
+        self.assertEqual(errors, [])
+        self.assert_rollup_matches()
+        row = CapaciteRollup.objects.get()
+        self.assertEqual(row.infrastructures_count, 1)
+        self.assertEqual(row.capacite_total, Decimal("3000"))
+
+    def test_concurrent_deletes_remove_the_row_once(self):
+        infrastructure = self.add_infrastructure("Citerne 1")
+        self.add_infrastructure("Citerne 2")
+        other = Infrastructure.objects.get(pk=infrastructure.pk)
+
+        with transaction.atomic():
+            infrastructure.delete()
+            thread, errors = self.write_concurrently(other.delete)
+        thread.join()
+
+        self.assertEqual(errors, [])
+        self.assert_rollup_matches()
+        self.assertEqual(CapaciteRollup.objects.get().infrastructures_count, 1)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ConditionalGetTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(User.objects.create_user("agent"))
+        self.type = TypeInfrastructure.objects.create(nom="Citerne")
+        self.owner = Client.objects.create(nom="Mbala", commune="Lemba")
+        self.infrastructure = Infrastructure.objects.create(
+            nom="Citerne 1", client=self.owner, type_infrastructure=self.type
+        )
+
+    def test_list_answers_304_until_it_changes(self):
+        url = "/api/v1/types-infrastructure/"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Last-Modified", response)
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            TypeInfrastructure.objects.create(nom="Puits")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_list_etag_changes_when_a_row_is_deleted(self):
+        url = "/api/v1/types-infrastructure/"
+        TypeInfrastructure.objects.create(nom="Puits")
+        etag = self.client.get(url)["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            TypeInfrastructure.objects.get(nom="Puits").delete()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_list_validator_reads_no_row(self):
+        url = "/api/v1/infrastructures/"
+        etag = self.client.get(url)["ETag"]
+
+        # The data versions only
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_list_etag_follows_queryset_updates_of_jobs(self):
+        url = "/api/v1/jobs/"
+        job = enqueue("import", import_job=1)
+        etag = self.client.get(url)["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            report_progress(job, 0.5)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["results"][0]["progress"], 0.5)
+
+    def test_list_etag_depends_on_the_query(self):
+        url = "/api/v1/types-infrastructure/"
+        etag = self.client.get(url)["ETag"]
+
+        response = self.client.get(f"{url}?limit=1", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail_answers_304_to_either_validator(self):
+        url = f"/api/v1/types-infrastructure/{self.type.pk}/"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        self.type.description = "Réservoir d'eau de pluie"
+        self.type.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["description"], "Réservoir d'eau de pluie")
+
+    def test_detail_with_nested_models_follows_their_changes(self):
+        url = f"/api/v1/infrastructures/{self.infrastructure.pk}/"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # Its nested rows can change without it
+        self.assertNotIn("Last-Modified", response)
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owner.commune = "Limete"
+            self.owner.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["client"]["commune"], "Limete")
+
+    def test_missing_detail_answers_404(self):
+        response = self.client.get("/api/v1/types-infrastructure/0/")
+        self.assertEqual(response.status_code, 404)
+
+
+def succeeding_handler(job):
+    return {"params": job.params}
+
+
+def failing_handler(job):
+    raise JobError("The file is gone.")
+
+
+class JobQueueTests(TestCase):
+    def make_stale(self, job):
+        Job.objects.filter(pk=job.pk).update(
+            updated_at=timezone.now() - STALE_AFTER - datetime.timedelta(seconds=1)
+        )
+
+    def test_claims_pending_jobs_oldest_first(self):
+        first = enqueue("import", import_job=1)
+        second = enqueue("import", import_job=2)
+
+        claimed = claim_job()
+        self.assertEqual(claimed.pk, first.pk)
+        self.assertEqual(claimed.status, "running")
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNotNone(claimed.started_at)
+
+        self.assertEqual(claim_job().pk, second.pk)
+        self.assertIsNone(claim_job())
+
+    def test_requeues_running_jobs_whose_worker_stopped(self):
+        enqueue("import", import_job=1)
+        enqueue("import", import_job=2)
+        stale, alive = claim_job(), claim_job()
+        self.make_stale(stale)
+
+        requeue_stale_jobs()
+
+        stale.refresh_from_db()
+        alive.refresh_from_db()
+        self.assertEqual(stale.status, "pending")
+        self.assertEqual(alive.status, "running")
+        # Claimed again, as another attempt
+        self.assertEqual(claim_job().attempts, 2)
+
+    def test_fails_stale_jobs_out_of_attempts(self):
+        job = enqueue("import", import_job=1)
+        Job.objects.filter(pk=job.pk).update(status="running", attempts=MAX_ATTEMPTS)
+        self.make_stale(job)
+
+        requeue_stale_jobs()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertTrue(job.message)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_records_the_result_of_a_job(self):
+        enqueue("import", import_job=1)
+        handlers = {"import": "ceedd_stream.tests.succeeding_handler"}
+        with mock.patch.dict(JOB_HANDLERS, handlers):
+            job = run_job(claim_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.progress, 1)
+        self.assertEqual(job.result, {"params": {"import_job": 1}})
+        self.assertIsNotNone(job.finished_at)
+
+    def test_records_the_error_of_a_job(self):
+        enqueue("import", import_job=1)
+        handlers = {"import": "ceedd_stream.tests.failing_handler"}
+        with mock.patch.dict(JOB_HANDLERS, handlers):
+            job = run_job(claim_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.message, "The file is gone.")
+
+    def test_rerun_import_counts_from_scratch(self):
+        use_temporary_media(self)
+        import_job = ImportJob.objects.create(
+            kind="clients",
+            file=ContentFile(
+                b"nom,prenom,email\nIlunga,Paul,\nKasongo,Marie,not-an-email\n",
+                name="clients.csv",
+            ),
+        )
+
+        # As when its worker stopped and the job was claimed again
+        run_import(import_job)
+        run_import(import_job)
+
+        import_job.refresh_from_db()
+        self.assertEqual(import_job.status, "done")
+        self.assertEqual(import_job.processed_rows, 2)
+        self.assertEqual(import_job.written_rows, 1)
+        self.assertEqual(import_job.error_count, 1)
+        self.assertEqual([error["row"] for error in import_job.errors], [3])
+
+
+class JobClaimConcurrencyTests(TransactionTestCase):
+    def test_workers_skip_jobs_claimed_by_others(self):
+        first = enqueue("import", import_job=1)
+        second = enqueue("import", import_job=2)
+        claimed = []
+
+        def worker():
+            try:
+                claimed.append(claim_job())
+            finally:
+                connection.close()
+
+        # Another worker is claiming the first job
+        with transaction.atomic():
+            Job.objects.select_for_update().get(pk=first.pk)
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(claimed[0].pk, second.pk)
+        first.refresh_from_db()
+        self.assertEqual(first.status, "pending")
+
+
+@override_settings(CACHES=TEST_CACHES)
+class InfrastructureMapTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.citerne = TypeInfrastructure.objects.create(nom="Citerne")
+        self.puits = TypeInfrastructure.objects.create(nom="Puits")
+
+    def add_infrastructure(self, nom, lon, lat, **kwargs):
+        return Infrastructure.objects.create(
+            nom=nom, longitude=lon, latitude=lat, **kwargs
+        )
+
+    def noms(self, **params):
+        response = self.client.get("/api/v1/infrastructures/", params)
+        self.assertEqual(response.status_code, 200)
+        return sorted(row["nom"] for row in response.data["results"])
+
+    def add_spatial_set(self):
+        self.add_infrastructure("Kimbondo", 15.30, -4.40)
+        # About 22 km east
+        self.add_infrastructure("Lemba", 15.50, -4.40)
+        self.add_infrastructure("Kisantu", 16.50, -4.40)
+        Infrastructure.objects.create(nom="Sans position")
+
+    def test_filters_by_bounding_box(self):
+        self.add_spatial_set()
+
+        self.assertEqual(self.noms(in_bbox="15.2,-4.5,15.4,-4.3"), ["Kimbondo"])
+        self.assertEqual(self.noms(in_bbox="15,-5,16,-4"), ["Kimbondo", "Lemba"])
+
+    def test_filters_by_distance_in_meters(self):
+        self.add_spatial_set()
+
+        self.assertEqual(self.noms(point="15.30,-4.40", dist=5000), ["Kimbondo"])
+        self.assertEqual(
+            self.noms(point="15.30,-4.40", dist=25000), ["Kimbondo", "Lemba"]
+        )
+
+    def test_filters_within_the_features_of_a_shapefile(self):
+        self.add_spatial_set()
+        media = use_temporary_media(self)
+        path = write_zipped_shapefile(media, [("a", square(15.25, -4.45, 0.1))])
+        with open(path, "rb") as f:
+            shp = Shp.objects.create(name="zones.zip", file=File(f, "zones.zip"))
+        ingest_shapefile(shp)
+
+        self.assertEqual(self.noms(within_shp=shp.pk), ["Kimbondo"])
+
+    def test_rejects_malformed_spatial_parameters(self):
+        for params in (
+            {"in_bbox": "15,-5,16"},
+            {"point": "15.3", "dist": "100"},
+            {"point": "15.3,-4.4"},
+            {"within_shp": "abc"},
+        ):
+            with self.subTest(params=params):
+                response = self.client.get("/api/v1/infrastructures/", params)
+                self.assertEqual(response.status_code, 400)
+
+    def test_clusters_break_down_by_type_id(self):
+        self.add_infrastructure(
+            "Citerne 1", 15.30, -4.40, type_infrastructure=self.citerne, capacite=100
+        )
+        self.add_infrastructure(
+            "Citerne 2", 15.31, -4.41, type_infrastructure=self.citerne, capacite=50
+        )
+        self.add_infrastructure("Puits 1", 15.32, -4.40, type_infrastructure=self.puits)
+
+        response = self.client.get(
+            "/api/v1/infrastructures/clusters/",
+            {"zoom": 3, "in_bbox": "15,-5,16,-4"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        (cluster,) = response.data["clusters"]
+        self.assertEqual(cluster["count"], 3)
+        self.assertEqual(cluster["capacite"], Decimal("150"))
+        self.assertEqual(
+            sorted(
+                (
+                    row["type_infrastructure_id"],
+                    row["type_infrastructure"],
+                    row["count"],
+                )
+                for row in cluster["types"]
+            ),
+            [(self.citerne.pk, "Citerne", 2), (self.puits.pk, "Puits", 1)],
+        )
+
+
+@override_settings(ALLOWED_HOSTS=["api.ceedd.example"], PHOTO_SOURCE_HOSTS=[])
+class PhotoSourceTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        default_storage.save("photos/citerne.jpg", ContentFile(b"ours"))
+
+    def test_reads_our_media_urls_from_storage(self):
+        for url in (
+            "/media/photos/citerne.jpg",
+            "https://api.ceedd.example/media/photos/citerne.jpg",
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(read_source(url), b"ours")
+
+    def test_downloads_media_paths_of_other_hosts(self):
+        # Checked as any download: the host isn't in PHOTO_SOURCE_HOSTS
+        with self.assertRaisesMessage(DerivativeError, "other.example"):
+            read_source("https://other.example/media/photos/citerne.jpg")
+
+    def test_rejects_other_schemes(self):
+        with self.assertRaises(DerivativeError):
+            read_source("file:///media/photos/citerne.jpg")
+
+
+def table_queries(queries, model):
+    """The SQL of the captured `queries` reading the table of `model`."""
+    table = f'FROM "{model._meta.db_table}"'
+    return [query["sql"] for query in queries if table in query["sql"]]
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ExpandTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(User.objects.create_user("agent"))
+        self.type = TypeInfrastructure.objects.create(nom="Citerne")
+
+    def add_zone(self, nom, infrastructures=2):
+        zone = ZoneContributive.objects.create(nom=nom)
+        for index in range(infrastructures):
+            Infrastructure.objects.create(
+                nom=f"{nom} {index}",
+                zone=zone,
+                type_infrastructure=self.type,
+                client=Client.objects.create(nom=f"{nom} {index}"),
+            )
+        return zone
+
+    def test_expanded_zones_take_a_constant_number_of_queries(self):
+        url = "/api/v1/zones/?expand=infrastructures,infrastructures.client"
+        self.add_zone("Kimbondo")
+        # Seeds the data versions
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+
+        for index in range(3):
+            self.add_zone(f"Zone {index}", infrastructures=3)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        zones = {zone["nom"]: zone for zone in response.data["results"]}
+        self.assertEqual(len(zones), 4)
+        infrastructure = zones["Zone 0"]["infrastructures"][0]
+        self.assertEqual(infrastructure["client"]["nom"], infrastructure["nom"])
+        # Not expanded: rendered as its primary key
+        self.assertEqual(infrastructure["type_infrastructure"], self.type.pk)
+
+    def test_unexpanded_relations_are_left_out(self):
+        self.add_zone("Kimbondo")
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/v1/zones/")
+
+        self.assertNotIn("infrastructures", response.data["results"][0])
+        self.assertEqual(table_queries(queries, Client), [])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SparseFieldsTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(User.objects.create_user("agent"))
+        self.infrastructure = Infrastructure.objects.create(
+            nom="Citerne 1",
+            client=Client.objects.create(nom="Mbala"),
+            type_infrastructure=TypeInfrastructure.objects.create(nom="Citerne"),
+            capacite=Decimal("1000"),
+            date_construction=datetime.date(2023, 7, 14),
+        )
+        Inspection.objects.create(infrastructure=self.infrastructure)
+
+    def get_infrastructures(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/v1/infrastructures/", params)
+        self.assertEqual(response.status_code, 200)
+        return response, queries
+
+    def test_fields_narrow_columns_and_prefetches(self):
+        response, queries = self.get_infrastructures()
+        self.assertTrue(table_queries(queries, Inspection))
+        self.assertTrue(table_queries(queries, Finance))
+
+        response, queries = self.get_infrastructures(fields="id,nom")
+
+        self.assertEqual(set(response.data["results"][0]), {"id", "nom"})
+        (select,) = table_queries(queries, Infrastructure)
+        self.assertNotIn('"capacite"', select)
+        self.assertNotIn('"date_construction"', select)
+        for model in (Client, TypeInfrastructure, Finance, Inspection):
+            self.assertEqual(table_queries(queries, model), [])
+
+    def test_omit_drops_the_prefetch_of_the_field(self):
+        response, queries = self.get_infrastructures(omit="inspections")
+
+        row = response.data["results"][0]
+        self.assertNotIn("inspections", row)
+        self.assertEqual(row["client"]["nom"], "Mbala")
+        self.assertEqual(table_queries(queries, Inspection), [])
+        self.assertTrue(table_queries(queries, Finance))
+
+    def test_writes_load_and_render_complete_rows(self):
+        url = f"/api/v1/infrastructures/{self.infrastructure.pk}/?fields=id"
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(url, {"capacite": "1500"}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["date_construction"], "2023-07-14")
+        loaded = table_queries(queries, Infrastructure)[0]
+        self.assertIn('"date_construction"', loaded)
+        self.infrastructure.refresh_from_db()
+        self.assertEqual(self.infrastructure.capacite, Decimal("1500"))
+        self.assertEqual(self.infrastructure.nom, "Citerne 1")
+
+
+@override_settings(CACHES=TEST_CACHES)
+class KeysetPaginationTests(APITestCase):
+    url = "/api/v1/infrastructures/"
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(User.objects.create_user("agent"))
+        now = timezone.now()
+        self.infrastructures = []
+        for index, nom in enumerate(
+            ["Citerne Lemba", "Citerne Limete", "Citerne Kimbondo", "Puits Ngaliema"]
+        ):
+            infrastructure = Infrastructure.objects.create(nom=nom)
+            # Newest first: Citerne Lemba, Citerne Limete, ...
+            Infrastructure.objects.filter(pk=infrastructure.pk).update(
+                created_at=now - datetime.timedelta(minutes=index)
+            )
+            self.infrastructures.append(infrastructure.pk)
+
+    def ids(self, response):
+        return [row["id"] for row in response.data["results"]]
+
+    def test_pages_follow_the_cursor_despite_inserts(self):
+        response = self.client.get(self.url, {"limit": 2, "fields": "id"})
+        self.assertEqual(self.ids(response), self.infrastructures[:2])
+        self.assertNotIn("count", response.data)
+
+        # Newer than every page: never shifts the pages already read
+        Infrastructure.objects.create(nom="Citerne Righini")
+        Infrastructure.objects.create(nom="Citerne Matete")
+        response = self.client.get(response.data["next"])
+
+        self.assertEqual(self.ids(response), self.infrastructures[2:])
+        self.assertIsNone(response.data["next"])
+
+    def test_limit_sets_the_page_size(self):
+        response = self.client.get(self.url, {"limit": 3})
+
+        self.assertEqual(self.ids(response), self.infrastructures[:3])
+        self.assertIsNotNone(response.data["next"])
+
+    def test_count_is_the_planner_estimate(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {"count": "true", "fields": "id"})
+
+        self.assertEqual(
+            response.data["count"], estimate_count(Infrastructure.objects.all())
+        )
+        self.assertTrue(any("EXPLAIN" in query["sql"] for query in queries))
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries))
+
+    def test_fuzzy_search_returns_one_page_of_the_best_matches(self):
+        response = self.client.get(
+            self.url, {"search": "Citerne Lemba", "fuzzy": "true", "limit": 2}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row["nom"] for row in response.data["results"]][:1], ["Citerne Lemba"]
+        )
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertIsNone(response.data["next"])
+        self.assertIsNone(response.data["previous"])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class VolumeStatisticsTests(APITestCase):
+    """
+    Requests without avenue filter, and with date ranges of whole months,
+    read the rollup; the others aggregate the infrastructures.
+    """
+
+    # The avenue of every client: filtering on it, whatever the match,
+    # keeps every row but sends the request to the live path
+    AVENUE = "Avenue de la Paix"
+
+    def setUp(self):
+        cache.clear()
+        lemba = Client.objects.create(
+            nom="Mbala", commune="Lemba", quartier="Righini", avenue=self.AVENUE
+        )
+        ngaliema = Client.objects.create(
+            nom="Ilunga", commune="Ngaliema", quartier="Binza", avenue=self.AVENUE
+        )
+        self.citerne = TypeInfrastructure.objects.create(nom="Citerne")
+        self.puits = TypeInfrastructure.objects.create(nom="Puits")
+        self.kimbondo = ZoneContributive.objects.create(nom="Kimbondo")
+        self.lukaya = ZoneContributive.objects.create(nom="Lukaya")
+        # Averages are exact in every group, so both paths give equal values
+        for nom, client, type_infrastructure, zone, capacite, date in [
+            ("C1", lemba, self.citerne, self.kimbondo, "1000", "2023-02-10"),
+            ("C2", lemba, self.citerne, self.kimbondo, "3000", "2023-05-20"),
+            ("P1", lemba, self.puits, self.lukaya, None, "2023-08-05"),
+            ("C3", ngaliema, self.citerne, self.lukaya, "2000", "2024-01-15"),
+            ("P2", ngaliema, self.puits, None, "4000", None),
+        ]:
+            Infrastructure.objects.create(
+                nom=nom,
+                client=client,
+                type_infrastructure=type_infrastructure,
+                zone=zone,
+                capacite=capacite and Decimal(capacite),
+                date_construction=date and datetime.date.fromisoformat(date),
+            )
+
+    def get_volume(self, **params):
+        response = self.client.get("/api/infras/volume", params)
+        self.assertIn(response.status_code, (200, 404))
+        return response
+
+    def assert_paths_agree(self, **params):
+        """Compares the rollup's answer with the live aggregate's."""
+        rollup = self.get_volume(**params)
+        live = self.get_volume(avenue=self.AVENUE, **params)
+        self.assertEqual(rollup.status_code, live.status_code)
+        self.assertEqual(rollup.data, live.data)
+        return rollup
+
+    def test_totals_of_the_rollup_match_the_live_aggregate(self):
+        response = self.assert_paths_agree()
+        self.assertEqual(response.data["count"], 5)
+        self.assertEqual(response.data["total_volume"], Decimal("10000"))
+        self.assertEqual(response.data["average_volume"], Decimal("2500"))
+
+        response = self.assert_paths_agree(commune="lemba")
+        self.assertEqual(response.data["count"], 3)
+        self.assertEqual(response.data["average_volume"], Decimal("2000"))
+
+    def test_group_by_zone_and_type_is_by_id_with_the_name(self):
+        response = self.assert_paths_agree(group_by="zone")
+        self.assertEqual(
+            [
+                (row["zone_id"], row["zone"], row["count"])
+                for row in response.data["results"]
+            ],
+            [
+                (self.kimbondo.pk, "Kimbondo", 2),
+                (self.lukaya.pk, "Lukaya", 2),
+                (None, None, 1),
+            ],
+        )
+
+        response = self.assert_paths_agree(group_by="type_infrastructure")
+        self.assertEqual(
+            [
+                (row["type_infrastructure_id"], row["count"], row["average_volume"])
+                for row in response.data["results"]
+            ],
+            [
+                (self.citerne.pk, 3, Decimal("2000")),
+                (self.puits.pk, 2, Decimal("4000")),
+            ],
+        )
+
+    def test_group_by_address(self):
+        response = self.assert_paths_agree(group_by="commune")
+        self.assertEqual(
+            [(row["commune"], row["count"]) for row in response.data["results"]],
+            [("Lemba", 3), ("Ngaliema", 2)],
+        )
+
+        response = self.get_volume(group_by="avenue")
+        self.assertEqual(
+            [(row["avenue"], row["count"]) for row in response.data["results"]],
+            [(self.AVENUE, 5)],
+        )
+
+    def test_exact_match_compares_the_whole_value(self):
+        response = self.assert_paths_agree(commune="Lemba", match="exact")
+        self.assertEqual(response.data["count"], 3)
+
+        response = self.assert_paths_agree(commune="Lemb", match="exact")
+        self.assertEqual(response.status_code, 404)
+
+    def test_fuzzy_match_tolerates_typos(self):
+        response = self.assert_paths_agree(commune="Ngaliemma", match="fuzzy")
+        self.assertEqual(response.data["count"], 2)
+
+        self.assertEqual(self.get_volume(commune="Ngaliemma").status_code, 404)
+
+    def get_volume_by_date(self, **params):
+        response = self.client.get("/api/infras/volume_by_date", params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_date_ranges_through_a_month_match_the_rollup(self):
+        # Whole months read the rollup; no infrastructure was built on the
+        # last day, so the range cut before it (live) has the same totals
+        for date_to, cut in (
+            ("2023-06-30", "2023-06-29"),
+            ("2023-12-31", "2023-12-30"),
+        ):
+            with self.subTest(date_to=date_to):
+                rollup = self.get_volume_by_date(
+                    date_from="2023-01-01", date_to=date_to
+                )
+                live = self.get_volume_by_date(date_from="2023-01-01", date_to=cut)
+                self.assertEqual(rollup.data, live.data)
+
+        response = self.get_volume_by_date(date_from="2023-01-01", date_to="2023-06-30")
+        self.assertEqual(response.data["count"], 2)
+        self.assertEqual(response.data["total_volume"], Decimal("4000"))
+
+    def test_buckets_of_the_rollup_match_the_live_series(self):
+        for bucket in VOLUME_BUCKETS:
+            with self.subTest(bucket=bucket):
+                rollup = self.get_volume_by_date(bucket=bucket, date_from="2023-01-01")
+                live = self.get_volume_by_date(bucket=bucket, date_from="2023-01-02")
+                self.assertEqual(rollup.data, live.data)
+
+    def test_semesters_merge_their_quarters(self):
+        response = self.get_volume_by_date(bucket="semester")
+
+        self.assertEqual(
+            [
+                (
+                    row["label"],
+                    row["count"],
+                    row["total_volume"],
+                    row["cumulative_volume"],
+                )
+                for row in response.data["results"]
+            ],
+            [
+                ("2023-S1", 2, Decimal("4000"), Decimal("4000")),
+                ("2023-S2", 1, Decimal("0"), Decimal("4000")),
+                ("2024-S1", 1, Decimal("2000"), Decimal("6000")),
+            ],
+        )
+
+    def test_bucket_labels(self):
+        labels = {
+            "month": ["2023-02", "2023-05", "2023-08", "2024-01"],
+            "trimester": ["2023-T1", "2023-T2", "2023-T3", "2024-T1"],
+            "year": ["2023", "2024"],
+        }
+        for bucket, expected in labels.items():
+            with self.subTest(bucket=bucket):
+                response = self.get_volume_by_date(bucket=bucket)
+                self.assertEqual(
+                    [row["label"] for row in response.data["results"]], expected
+                )
+
+    def test_cached_responses_change_once_a_write_commits(self):
+        self.assertEqual(self.get_volume(commune="Lemba").data["count"], 3)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            Infrastructure.objects.create(
+                nom="C4", client=Client.objects.get(nom="Mbala"), capacite=500
+            )
+        # Served from the cache until the data versions are bumped
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_volume(commune="Lemba").data["count"], 3)
+
+        for callback in callbacks:
+            callback()
+        response = self.get_volume(commune="Lemba")
+        self.assertEqual(response.data["count"], 4)
+        self.assertEqual(response.data["total_volume"], Decimal("4500"))
+
+    def test_rejects_unknown_modes(self):
+        for params in ({"group_by": "nom"}, {"match": "regex"}):
+            with self.subTest(params=params):
+                response = self.client.get("/api/infras/volume", params)
+                self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DataVersionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bumps_change_only_the_version_of_their_model(self):
+        before = get_data_version(Infrastructure, Client)
+
+        bump_data_version(Infrastructure)
+
+        after = get_data_version(Infrastructure, Client)
+        self.assertNotEqual(after, before)
+        self.assertEqual(after.split("-")[1], before.split("-")[1])
+
+    def test_computes_a_missing_entry_once(self):
+        compute = mock.Mock(return_value=42)
+
+        self.assertEqual(get_or_compute("entry", compute, 60), 42)
+        self.assertEqual(get_or_compute("entry", compute, 60), 42)
+
+        compute.assert_called_once_with()
+
+    def test_leaves_values_not_cacheable_out(self):
+        compute = mock.Mock(return_value=500)
+
+        get_or_compute("entry", compute, 60, cacheable=lambda value: value < 500)
+        get_or_compute("entry", compute, 60, cacheable=lambda value: value < 500)
+
+        self.assertEqual(compute.call_count, 2)
+
+
+class ComputeLockTests(TransactionTestCase):
+    @override_settings(CACHES=TEST_CACHES)
+    def test_concurrent_misses_wait_for_the_first(self):
+        cache.clear()
+        started, release = threading.Event(), threading.Event()
+        results = []
+
+        def slow_compute():
+            started.set()
+            release.wait(5)
+            return "computed"
+
+        def worker(compute):
+            try:
+                results.append(get_or_compute("entry", compute, 60))
+            finally:
+                connection.close()
+
+        first = threading.Thread(target=worker, args=(slow_compute,))
+        first.start()
+        started.wait(5)
+        # Waits for the lock the first worker holds, then reads its result
+        second_compute = mock.Mock(return_value="computed again")
+        second = threading.Thread(target=worker, args=(second_compute,))
+        second.start()
+        second.join(timeout=0.5)
+        self.assertTrue(second.is_alive())
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(results, ["computed", "computed"])
+        second_compute.assert_not_called()
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ExportTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.infrastructure = Infrastructure.objects.create(
+            nom="Citerne 1",
+            client=Client.objects.create(nom="Mbala", prenom="Jean"),
+            type_infrastructure=TypeInfrastructure.objects.create(nom="Citerne"),
+            zone=ZoneContributive.objects.create(nom="Kimbondo"),
+            capacite=Decimal("1000"),
+            unite="L",
+            date_construction=datetime.date(2023, 7, 14),
+            longitude=15.3,
+            latitude=-4.4,
+        )
+        bailleur = Bailleur.objects.create(nom="Banque mondiale")
+        for montant in ("500", "250"):
+            Finance.objects.create(
+                bailleur=bailleur,
+                infrastructure=self.infrastructure,
+                montant=Decimal(montant),
+            )
+        # Outside the bounding box of the requests, and without position
+        Infrastructure.objects.create(nom="Citerne 2", longitude=20, latitude=0)
+        self.params = {"in_bbox": "15,-5,16,-4"}
+
+    def export(self, file_format):
+        response = self.client.get(
+            f"/api/v1/infrastructures/export/{file_format}/", self.params
+        )
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content)
+
+    def read_features(self, path):
+        with fiona.open(path) as src:
+            return [
+                (feature.geometry.coordinates, dict(feature.properties))
+                for feature in src
+            ]
+
+    def test_csv_export(self):
+        content = self.export("csv").decode("utf-8-sig")
+
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], list(EXPORT_COLUMNS))
+        self.assertEqual(len(rows), 2)
+        row = dict(zip(rows[0], rows[1]))
+        self.assertEqual(row["nom"], "Citerne 1")
+        self.assertEqual(row["client"], "Jean Mbala")
+        self.assertEqual(row["type_infrastructure"], "Citerne")
+        self.assertEqual(row["zone"], "Kimbondo")
+        self.assertEqual(Decimal(row["capacite"]), Decimal("1000"))
+        self.assertEqual(row["date_construction"], "2023-07-14")
+        self.assertEqual(
+            (float(row["longitude"]), float(row["latitude"])), (15.3, -4.4)
+        )
+        self.assertEqual(Decimal(row["total_financement"]), Decimal("750"))
+
+    def test_geopackage_export(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "infrastructures.gpkg")
+        with open(path, "wb") as f:
+            f.write(self.export("gpkg"))
+
+        ((coordinates, properties),) = self.read_features(path)
+        self.assertEqual(coordinates, (15.3, -4.4))
+        self.assertEqual(properties["id"], self.infrastructure.pk)
+        self.assertEqual(properties["client"], "Jean Mbala")
+        self.assertEqual(properties["capacite"], 1000)
+        self.assertEqual(properties["total_financement"], 750)
+        self.assertEqual(str(properties["date_construction"]), "2023-07-14")
+
+    def test_zipped_shapefile_export(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with zipfile.ZipFile(io.BytesIO(self.export("shp"))) as archive:
+            self.assertIn("infrastructures.shp", archive.namelist())
+            archive.extractall(directory)
+
+        ((coordinates, properties),) = self.read_features(
+            os.path.join(directory, "infrastructures.shp")
+        )
+        self.assertEqual(coordinates, (15.3, -4.4))
+        # DBF field names are cut to 10 characters
+        self.assertEqual(properties["type"], "Citerne")
+        self.assertEqual(properties["financemt"], 750)
+        self.assertEqual(str(properties["date_const"]), "2023-07-14")
+
+
+@override_settings(CACHES=TEST_CACHES)
+class FuzzySearchTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(User.objects.create_user("agent"))
+        for nom in ("Mbala", "Kabongo", "Kasongu", "Kasongo"):
+            Client.objects.create(nom=nom)
+
+    def search_clients(self, **params):
+        response = self.client.get("/api/v1/clients/", params)
+        self.assertEqual(response.status_code, 200)
+        return [row["nom"] for row in response.data["results"]]
+
+    def test_ranks_the_most_similar_first(self):
+        self.assertEqual(
+            self.search_clients(search="Kasongo", fuzzy="true"),
+            ["Kasongo", "Kasongu", "Kabongo"],
+        )
+
+    def test_plain_search_needs_the_exact_substring(self):
+        self.assertEqual(self.search_clients(search="Kasongo"), ["Kasongo"])
+
+    def test_matches_typos_in_related_fields(self):
+        Infrastructure.objects.create(
+            nom="Citerne 1", client=Client.objects.get(nom="Kasongu")
+        )
+        Infrastructure.objects.create(
+            nom="Citerne 2", client=Client.objects.get(nom="Mbala")
+        )
+
+        response = self.client.get(
+            "/api/v1/infrastructures/", {"search": "Kasongo", "fuzzy": "true"}
+        )
+
+        self.assertEqual(
+            [row["nom"] for row in response.data["results"]], ["Citerne 1"]
+        )
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ImportTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        self.owner = Client.objects.create(nom="Mbala")
+        self.type = TypeInfrastructure.objects.create(nom="Citerne")
+
+    def run_file(self, name, content, kind="infrastructures"):
+        job = ImportJob.objects.create(kind=kind, file=ContentFile(content, name=name))
+        run_import(job)
+        job.refresh_from_db()
+        return job
+
+    def xlsx(self, rows):
+        workbook = Workbook()
+        for row in rows:
+            workbook.active.append(row)
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        return buffer.getvalue()
+
+    def test_csv_import_reports_errors_by_line(self):
+        content = (
+            "nom;client_id;type_infrastructure_id;capacite;date_construction\n"
+            f"Citerne 1;{self.owner.pk};{self.type.pk};1000;2023-07-14\n"
+            f"Citerne 2;{self.owner.pk};{self.type.pk};beaucoup;\n"
+            f"Citerne 3;0;{self.type.pk};;\n"
+            f"Citerne 4;{self.owner.pk};{self.type.pk};;\n"
+        )
+
+        job = self.run_file("infrastructures.csv", content.encode())
+
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.progress, 1)
+        self.assertEqual(job.processed_rows, 4)
+        self.assertEqual(job.written_rows, 2)
+        self.assertEqual(job.error_count, 2)
+        self.assertEqual(
+            [(error["row"], list(error["errors"])) for error in job.errors],
+            [(3, ["capacite"]), (4, ["client_id"])],
+        )
+        infrastructure = Infrastructure.objects.get(nom="Citerne 1")
+        self.assertEqual(infrastructure.capacite, Decimal("1000"))
+        self.assertEqual(infrastructure.date_construction, datetime.date(2023, 7, 14))
+        # Empty cells are missing values, not invalid ones
+        self.assertIsNone(Infrastructure.objects.get(nom="Citerne 4").capacite)
+
+    def test_xlsx_import_converts_spreadsheet_values(self):
+        content = self.xlsx(
+            [
+                [
+                    "Nom ",
+                    "Client_ID",
+                    "Type_infrastructure_id",
+                    "Capacite",
+                    "Date_construction",
+                ],
+                [
+                    "Citerne 1",
+                    float(self.owner.pk),
+                    float(self.type.pk),
+                    1500.0,
+                    datetime.datetime(2023, 7, 14),
+                ],
+                ["Citerne 2", 0.0, float(self.type.pk), None, None],
+            ]
+        )
+
+        job = self.run_file("infrastructures.xlsx", content)
+
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.written_rows, 1)
+        self.assertEqual([error["row"] for error in job.errors], [3])
+        infrastructure = Infrastructure.objects.get(nom="Citerne 1")
+        self.assertEqual(infrastructure.client, self.owner)
+        self.assertEqual(infrastructure.date_construction, datetime.date(2023, 7, 14))
+
+    def test_line_numbers_follow_the_file_across_chunks(self):
+        lines = ["nom,email"]
+        lines += [f"Client {index},client{index}@example.org" for index in range(4)]
+        lines += ["Client 4,not-an-email", "Client 5,client5@example.org"]
+
+        with mock.patch("ceedd_stream.imports.IMPORT_CHUNK_SIZE", 2):
+            job = self.run_file("clients.csv", "\n".join(lines).encode(), "clients")
+
+        self.assertEqual(job.processed_rows, 6)
+        self.assertEqual(job.written_rows, 5)
+        self.assertEqual([error["row"] for error in job.errors], [6])
+
+    def test_fails_on_unreadable_files(self):
+        job = self.run_file("infrastructures.xlsx", b"not a workbook")
+
+        self.assertEqual(job.status, "failed")
+        self.assertTrue(job.message)
+
+    def test_upload_queues_the_import(self):
+        self.client.force_authenticate(User.objects.create_user("agent"))
+        upload = ContentFile(b"nom\nIlunga\n", name="clients.csv")
+
+        response = self.client.post(
+            "/api/v1/imports/", {"kind": "clients", "file": upload}, format="multipart"
+        )
+
+        self.assertEqual(response.status_code, 202)
+        job = Job.objects.get(pk=response.data["job"])
+        self.assertEqual(job.params, {"import_job": response.data["id"]})
+
+    def test_upload_rejects_other_file_types(self):
+        self.client.force_authenticate(User.objects.create_user("agent"))
+        upload = ContentFile(b"nom\nIlunga\n", name="clients.txt")
+
+        response = self.client.post(
+            "/api/v1/imports/", {"kind": "clients", "file": upload}, format="multipart"
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("file", response.data)
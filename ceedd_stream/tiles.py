@@ -0,0 +1,137 @@
+"""
+Mapbox Vector Tiles built by PostGIS (ST_AsMVT).
+
+Geometries are clipped to the tile, simplified to about one tile pixel for
+the requested zoom and encoded in the database. Encoded tiles are cached
+under a key that embeds the data versions of the models the layer reads,
+and dropped once one of those models changes. Each process reuses the
+versions it read for `LOCAL_VERSION_TIMEOUT` seconds, so a cached tile is
+served without touching the database, at the cost of tiles lagging a
+change made by another process by as much.
+"""
+
+from django.core.cache import cache
+from django.db import connection
+
+from .cache import get_recent_data_version
+from .models import (
+    Infrastructure,
+    Shp,
+    ShpFeature,
+    TypeInfrastructure,
+    ZoneContributive,
+)
+
+MAX_ZOOM = 22
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+TILE_TIMEOUT = 60 * 60 * 24
+
+# Width of the web mercator world, in meters
+WORLD_WIDTH = 40075016.68557849
+
+INFRASTRUCTURES_SQL = f"""
+WITH bounds AS (SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom),
+mvtgeom AS (
+    SELECT
+        ST_AsMVTGeom(
+            ST_Transform(i.location, 3857),
+            bounds.geom,
+            {TILE_EXTENT},
+            {TILE_BUFFER},
+            true
+        ) AS geom,
+        i.id,
+        i.nom,
+        i.capacite::float8 AS capacite,
+        i.unite,
+        t.nom AS type_infrastructure,
+        i.zone_id
+    FROM {Infrastructure._meta.db_table} i
+    CROSS JOIN bounds
+    LEFT JOIN {TypeInfrastructure._meta.db_table} t
+        ON t.id = i.type_infrastructure_id
+    WHERE i.location && ST_Transform(bounds.geom, 4326)
+)
+SELECT ST_AsMVT(mvtgeom.*, %(layer)s, {TILE_EXTENT}, 'geom')
+FROM mvtgeom
+WHERE geom IS NOT NULL
+"""
+
+ZONES_SQL = f"""
+WITH bounds AS (SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom),
+mvtgeom AS (
+    SELECT
+        ST_AsMVTGeom(
+            ST_Simplify(ST_Transform(f.geom, 3857), %(tolerance)s, true),
+            bounds.geom,
+            {TILE_EXTENT},
+            {TILE_BUFFER},
+            true
+        ) AS geom,
+        z.id,
+        z.nom,
+        z.etat_ravin,
+        f.shp_id
+    FROM {ShpFeature._meta.db_table} f
+    CROSS JOIN bounds
+    -- Every zone drawn with the features of the shapefile it links to now
+    JOIN {ZoneContributive._meta.db_table} z ON z.shapefile_id_id = f.shp_id
+    WHERE f.geom && ST_Transform(bounds.geom, 4326)
+)
+SELECT ST_AsMVT(mvtgeom.*, %(layer)s, {TILE_EXTENT}, 'geom')
+FROM mvtgeom
+WHERE geom IS NOT NULL
+"""
+
+SHAPEFILES_SQL = f"""
+WITH bounds AS (SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom),
+mvtgeom AS (
+    SELECT
+        ST_AsMVTGeom(
+            ST_Simplify(ST_Transform(f.geom, 3857), %(tolerance)s, true),
+            bounds.geom,
+            {TILE_EXTENT},
+            {TILE_BUFFER},
+            true
+        ) AS geom,
+        f.shp_id,
+        f.fid
+    FROM {ShpFeature._meta.db_table} f
+    CROSS JOIN bounds
+    WHERE f.geom && ST_Transform(bounds.geom, 4326)
+)
+SELECT ST_AsMVT(mvtgeom.*, %(layer)s, {TILE_EXTENT}, 'geom')
+FROM mvtgeom
+WHERE geom IS NOT NULL
+"""
+
+# Layer name -> (SQL, models whose changes invalidate the layer's tiles).
+# ShpFeature rows are only written by the ingest, which saves its Shp.
+LAYERS = {
+    "infrastructures": (INFRASTRUCTURES_SQL, (Infrastructure, TypeInfrastructure)),
+    "zones": (ZONES_SQL, (ZoneContributive, Shp)),
+    "shapefiles": (SHAPEFILES_SQL, (Shp,)),
+}
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def get_tile(layer, z, x, y):
+    """Returns the encoded tile `z/x/y` of `layer`, from the cache when possible."""
+    sql, models = LAYERS[layer]
+    key = f"tile:{layer}:{get_recent_data_version(*models)}:{z}:{x}:{y}"
+
+    tile = cache.get(key)
+    if tile is None:
+        # Simplify to about one tile pixel at this zoom level
+        tolerance = WORLD_WIDTH / 2**z / TILE_EXTENT
+        params = {"z": z, "x": x, "y": y, "layer": layer, "tolerance": tolerance}
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        tile = bytes(row[0]) if row and row[0] is not None else b""
+        cache.set(key, tile, TILE_TIMEOUT)
+    return tile
@@ -7,9 +7,12 @@ from .views import (
     ClientViewSet,
     InfrastructureViewSet,
     FinanceViewSet,
+    ImportJobViewSet,
     InspectionViewSet,
+    JobViewSet,
     PhotoViewSet,
     UploadShapefileViewSet,
+    get_vector_tile,
 )
 
 router = DefaultRouter()
@@ -24,7 +27,14 @@ router.register(r"finances", FinanceViewSet, basename="finance")
 router.register(r"inspections", InspectionViewSet, basename="inspection")
 router.register(r"photos", PhotoViewSet, basename="photo")
 router.register(r"shps", UploadShapefileViewSet, basename="shp")
+router.register(r"imports", ImportJobViewSet, basename="importjob")
+router.register(r"jobs", JobViewSet, basename="job")
 
 urlpatterns = [
     path("", include(router.urls)),
+    path(
+        "tiles/<str:layer>/<int:z>/<int:x>/<int:y>.mvt",
+        get_vector_tile,
+        name="get_vector_tile",
+    ),
 ]
@@ -1,19 +1,18 @@
-import glob
 import json
-import os
-import tempfile
-import zipfile
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal
 
-import fiona
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import Avg, Count, Sum
+from django.db.models.functions import TruncMonth, TruncQuarter, TruncYear
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import generics, status, viewsets
-from rest_framework.decorators import action, api_view
+from rest_framework.decorators import action, api_view, throttle_classes
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.permissions import (
     AllowAny,
@@ -25,59 +24,148 @@ from rest_framework.response import Response
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework import filters
 
+from .bulk import BulkUpsertMixin
+from .cache import cache_response
+from .clusters import cluster_infrastructures
+from .exports import export_geodata, stream_csv
+from .filters import (
+    FuzzySearchFilter,
+    InfrastructureSpatialFilter,
+    ZoneContributiveFilter,
+    trigram_filter,
+)
+from .imports import start_import
+from .mixins import ConditionalGetMixin, DynamicFieldsViewSetMixin
 from .models import (
     Bailleur,
+    CapaciteRollup,
     Client,
     Finance,
+    ImportJob,
     Infrastructure,
     Inspection,
+    Job,
     Photo,
     Shp,
     TypeInfrastructure,
     ZoneContributive,
 )
+from .pagination import FeaturePagination, KeysetPagination
+from .photos import (
+    MAX_PHOTO_OBJECTS,
+    get_photo_content_type,
+    photos_by_object,
+    prefetch_photo_objects,
+)
+from .rollups import rollup_aggregates
 from .serializers import (
     BailleurSerializer,
     ClientSerializer,
     FinanceSerializer,
+    ImportJobSerializer,
+    JobSerializer,
     InfrastructureSerializer,
     InspectionSerializer,
     PhotoSerializer,
+    ShpFeatureSerializer,
+    ShpMetadataSerializer,
     ShpSerializer,
     TypeInfrastructureSerializer,
     UserSerializer,
     ZoneContributiveSerializer,
 )
+from .shapefiles import (
+    ShapefileError,
+    artifacts_outdated,
+    enqueue_ingest,
+    find_shp,
+    stream_featurecollection,
+)
+from .tiles import LAYERS as TILE_LAYERS
+from .tiles import MAX_ZOOM, get_tile, valid_tile
 
 
 # Create your views here.
-class ZoneContributiveViewSet(viewsets.ModelViewSet):
-    queryset = ZoneContributive.objects.prefetch_related("infrastructure_set").all()
+class ZoneContributiveViewSet(
+    ConditionalGetMixin, DynamicFieldsViewSetMixin, viewsets.ModelViewSet
+):
+    queryset = ZoneContributive.objects.with_aggregates()
     serializer_class = ZoneContributiveSerializer
+    # Aggregated, and expandable to the infrastructures; deleting a
+    # shapefile sets shapefile_id to NULL
+    validator_models = (
+        Infrastructure,
+        Finance,
+        Inspection,
+        Client,
+        TypeInfrastructure,
+        Shp,
+    )
     permission_classes = [IsAuthenticated]
     lookup_field = "pk"
-    # filterset_fields = ['nom', 'description']
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_class = ZoneContributiveFilter
     # search_fields = ['nom', 'description']
-    # ordering_fields = ['nom', 'created_at']
+    ordering_fields = [
+        "nom",
+        "created_at",
+        "updated_at",
+        "infrastructures_count",
+        "total_capacite",
+        "total_financement",
+        "derniere_inspection",
+    ]
     ordering = ["nom"]
 
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        # Reload the new zone with its aggregate annotations for the response
+        serializer.instance = self.get_queryset().get(pk=serializer.instance.pk)
+
 
-class BailleurViewSet(viewsets.ModelViewSet):
-    queryset = Bailleur.objects.prefetch_related("finances").all()
+class BailleurViewSet(
+    ConditionalGetMixin, DynamicFieldsViewSetMixin, viewsets.ModelViewSet
+):
+    queryset = Bailleur.objects.all()
     serializer_class = BailleurSerializer
+    validator_models = (Finance, Infrastructure)
     lookup_field = "pk"
 
 
-class TypeInfrastructureViewSet(viewsets.ModelViewSet):
+class TypeInfrastructureViewSet(
+    ConditionalGetMixin, DynamicFieldsViewSetMixin, viewsets.ModelViewSet
+):
     queryset = TypeInfrastructure.objects.all()
     serializer_class = TypeInfrastructureSerializer
     lookup_field = "pk"
 
 
-class ClientViewSet(viewsets.ModelViewSet):
+@method_decorator(
+    name="list",
+    decorator=swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                "fuzzy",
+                openapi.IN_QUERY,
+                required=False,
+                description="Typo-tolerant search, results ranked by similarity",
+                type=openapi.TYPE_BOOLEAN,
+            ),
+        ],
+    ),
+)
+class ClientViewSet(
+    ConditionalGetMixin,
+    BulkUpsertMixin,
+    DynamicFieldsViewSetMixin,
+    viewsets.ModelViewSet,
+):
     queryset = Client.objects.all()
     serializer_class = ClientSerializer
     lookup_field = "pk"
+    filter_backends = [FuzzySearchFilter]
+    search_fields = ["nom", "prenom", "avenue", "quartier", "commune"]
+    fuzzy_search_fields = ["nom", "avenue", "quartier", "commune", "province"]
 
     def create(self, request, *args, **kwargs):
         """
@@ -103,34 +191,235 @@ class ClientViewSet(viewsets.ModelViewSet):
         )
 
 
-class FinanceViewSet(viewsets.ModelViewSet):
+class FinanceViewSet(
+    ConditionalGetMixin,
+    BulkUpsertMixin,
+    DynamicFieldsViewSetMixin,
+    viewsets.ModelViewSet,
+):
     queryset = Finance.objects.all()
     serializer_class = FinanceSerializer
     lookup_field = "pk"
 
 
-class InfrastructureViewSet(viewsets.ModelViewSet):
-    queryset = (
-        Infrastructure.objects.select_related("client", "type_infrastructure")
-        .prefetch_related("finance_set", "inspections")
-        .all()
-    )
+@method_decorator(
+    name="list",
+    decorator=swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                "in_bbox",
+                openapi.IN_QUERY,
+                required=False,
+                description="Bounding box: minx,miny,maxx,maxy (EPSG:4326)",
+                type=openapi.TYPE_STRING,
+            ),
+            openapi.Parameter(
+                "point",
+                openapi.IN_QUERY,
+                required=False,
+                description="Center of the radius search: lon,lat (used with dist)",
+                type=openapi.TYPE_STRING,
+            ),
+            openapi.Parameter(
+                "dist",
+                openapi.IN_QUERY,
+                required=False,
+                description="Radius around point, in meters",
+                type=openapi.TYPE_NUMBER,
+            ),
+            openapi.Parameter(
+                "within_shp",
+                openapi.IN_QUERY,
+                required=False,
+                description="Only infrastructures inside the features of this shapefile",
+                type=openapi.TYPE_INTEGER,
+            ),
+            openapi.Parameter(
+                "fuzzy",
+                openapi.IN_QUERY,
+                required=False,
+                description="Typo-tolerant search, results ranked by similarity",
+                type=openapi.TYPE_BOOLEAN,
+            ),
+        ],
+    ),
+)
+class InfrastructureViewSet(
+    ConditionalGetMixin,
+    BulkUpsertMixin,
+    DynamicFieldsViewSetMixin,
+    viewsets.ModelViewSet,
+):
+    queryset = Infrastructure.objects.all()
     serializer_class = InfrastructureSerializer
+    # Deleting a zone sets zone to NULL
+    validator_models = (
+        Client,
+        TypeInfrastructure,
+        ZoneContributive,
+        Finance,
+        Inspection,
+    )
+    pagination_class = KeysetPagination
+    default_expand = (
+        "client",
+        "type_infrastructure",
+        "infrastructure_finances",
+        "inspections",
+    )
     permission_classes = [IsAuthenticatedOrReadOnly]
     lookup_field = "pk"
-    filter_backends = [filters.SearchFilter]
+    filter_backends = [FuzzySearchFilter, InfrastructureSpatialFilter]
     search_fields = ["=nom", "client__nom", "type_infrastructure__nom"]
+    fuzzy_search_fields = ["nom", "client__nom", "type_infrastructure__nom"]
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                "in_bbox",
+                openapi.IN_QUERY,
+                required=True,
+                description="Bounding box of the map view: minx,miny,maxx,maxy (EPSG:4326)",
+                type=openapi.TYPE_STRING,
+            ),
+            openapi.Parameter(
+                "zoom",
+                openapi.IN_QUERY,
+                required=True,
+                description="Zoom level of the map view (0–22)",
+                type=openapi.TYPE_INTEGER,
+            ),
+        ],
+    )
+    @action(detail=False, methods=["get"], url_path="clusters")
+    def clusters(self, request):
+        """
+        Clusters of the infrastructures inside `in_bbox` for a map `zoom`:
+        centroid, count, summed capacite and breakdown by type.
+        """
+        try:
+            zoom = int(request.query_params.get("zoom", ""))
+        except ValueError:
+            zoom = -1
+        if not 0 <= zoom <= MAX_ZOOM:
+            return Response(
+                {"error": f"zoom must be an integer between 0 and {MAX_ZOOM}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if not request.query_params.get("in_bbox"):
+            return Response(
+                {"error": "`in_bbox` query parameter is required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(
+            {"zoom": zoom, "clusters": cluster_infrastructures(queryset, zoom)},
+            status=status.HTTP_200_OK,
+        )
+
+    @action(
+        detail=False,
+        methods=["get"],
+        url_path=r"export/(?P<file_format>csv|gpkg|shp)",
+    )
+    def export(self, request, file_format):
+        """
+        Every infrastructure matching the list filters, with its client,
+        type, zone and total financing, as CSV, GeoPackage or zipped
+        shapefile.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        if file_format == "csv":
+            response = StreamingHttpResponse(
+                stream_csv(queryset), content_type="text/csv; charset=utf-8"
+            )
+            response["Content-Disposition"] = (
+                'attachment; filename="infrastructures.csv"'
+            )
+            return response
+
+        if file_format == "gpkg":
+            filename = "infrastructures.gpkg"
+            content_type = "application/geopackage+sqlite3"
+        else:
+            filename = "infrastructures.zip"
+            content_type = "application/zip"
+        return FileResponse(
+            export_geodata(queryset, file_format),
+            as_attachment=True,
+            filename=filename,
+            content_type=content_type,
+        )
 
 
-class InspectionViewSet(viewsets.ModelViewSet):
+class InspectionViewSet(
+    ConditionalGetMixin,
+    BulkUpsertMixin,
+    DynamicFieldsViewSetMixin,
+    viewsets.ModelViewSet,
+):
     queryset = Inspection.objects.all()
+    # Rendered with depth = 1
+    validator_models = (Infrastructure,)
     serializer_class = InspectionSerializer
+    pagination_class = KeysetPagination
     lookup_field = "pk"
 
 
-class PhotoViewSet(viewsets.ModelViewSet):
+class PhotoViewSet(
+    ConditionalGetMixin, DynamicFieldsViewSetMixin, viewsets.ModelViewSet
+):
     queryset = Photo.objects.all()
     serializer_class = PhotoSerializer
+    # Described by related_object
+    validator_models = (Infrastructure, Bailleur, ZoneContributive, Inspection)
+    pagination_class = KeysetPagination
+    lookup_field = "pk"
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if "related_object" in self.get_serializer().fields:
+            queryset = prefetch_photo_objects(queryset)
+        return queryset
+
+
+class ImportJobViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
+    """
+    Upload a CSV or XLSX file of infrastructures or clients: the import runs
+    in the background and the returned job reports its progress and row
+    errors.
+    """
+
+    queryset = ImportJob.objects.all().order_by("-created_at")
+    serializer_class = ImportJobSerializer
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
+    http_method_names = ["get", "post", "head", "options"]
+    lookup_field = "pk"
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED
+        response.data["job"] = self.job.id
+        return response
+
+    def perform_create(self, serializer):
+        self.job = start_import(serializer.save())
+
+
+class JobViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Background jobs (imports, shapefile ingests, photo renditions): poll one
+    for its status, progress and result.
+    """
+
+    queryset = Job.objects.all().order_by("-created_at")
+    serializer_class = JobSerializer
+    permission_classes = [IsAuthenticated]
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ["kind", "status"]
     lookup_field = "pk"
 
 
@@ -175,6 +464,21 @@ Par exemple, si on veut connaitre le nombre ou volume des citernes de tel quarti
 """
 
 
+# Models the statistics are computed from, directly or through the rollup
+STATS_MODELS = (Infrastructure, Client, TypeInfrastructure, ZoneContributive)
+
+# Accepted values of `group_by` -> lookup of the grouping column, and of the
+# name rendered with it when it is a foreign key (names aren't unique)
+VOLUME_GROUP_BY = {
+    "commune": ("client__commune", None),
+    "quartier": ("client__quartier", None),
+    "avenue": ("client__avenue", None),
+    "province": ("client__province", None),
+    "type_infrastructure": ("type_infrastructure_id", "type_infrastructure__nom"),
+    "zone": ("zone_id", "zone__nom"),
+}
+
+
 @swagger_auto_schema(
     method="get",
     manual_parameters=[
@@ -199,11 +503,48 @@ Par exemple, si on veut connaitre le nombre ou volume des citernes de tel quarti
             description="Filter by commune",
             type=openapi.TYPE_STRING,
         ),
+        openapi.Parameter(
+            "province",
+            openapi.IN_QUERY,
+            required=False,
+            description="Filter by province",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "match",
+            openapi.IN_QUERY,
+            required=False,
+            description="How the filters above match: contains (default, "
+            "case-insensitive), exact (uses the address indexes) or fuzzy "
+            "(tolerates typos)",
+            type=openapi.TYPE_STRING,
+            enum=["contains", "exact", "fuzzy"],
+        ),
+        openapi.Parameter(
+            "group_by",
+            openapi.IN_QUERY,
+            required=False,
+            description="Return the volume, count and average of every group "
+            "instead of a single total. Groups of type_infrastructure and zone "
+            "are by id, with the name next to it",
+            type=openapi.TYPE_STRING,
+            enum=list(VOLUME_GROUP_BY),
+        ),
     ],
     responses={
         200: openapi.Response(
             description="Success",
-            examples={"application/json": {"total_volume": 1500.50}},
+            examples={
+                "application/json": {
+                    "total_volume": 1500.50,
+                    "count": 12,
+                    "average_volume": 125.04,
+                }
+            },
+        ),
+        400: openapi.Response(
+            description="Bad Request",
+            examples={"application/json": {"error": "Invalid group_by"}},
         ),
         404: openapi.Response(
             description="Not Found",
@@ -216,31 +557,78 @@ Par exemple, si on veut connaitre le nombre ou volume des citernes de tel quarti
     },
 )
 @api_view(http_method_names=["GET"])
+@cache_response(*STATS_MODELS)
 def get_volume_by_filters(request):
-    avenue = request.query_params.get("avenue")
-    quartier = request.query_params.get("quartier")
-    commune = request.query_params.get("commune")
-
-    qs = Infrastructure.objects.all()
-
-    if avenue:
-        qs = qs.filter(client__avenue__icontains=avenue)
-
-    if quartier:
-        qs = qs.filter(client__quartier__icontains=quartier)
+    match = request.query_params.get("match", "contains")
+    group_by = request.query_params.get("group_by")
+    if match not in ("contains", "exact", "fuzzy"):
+        return Response(
+            {"error": "match must be 'contains', 'exact' or 'fuzzy'"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if group_by is not None and group_by not in VOLUME_GROUP_BY:
+        return Response(
+            {"error": f"group_by must be one of: {', '.join(VOLUME_GROUP_BY)}"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
 
-    if commune:
-        qs = qs.filter(client__commune__icontains=commune)
+    # Read the rollup, a few rows per group, unless avenues are involved:
+    # they are not part of its key
+    use_rollup = not request.query_params.get("avenue") and group_by != "avenue"
+    if use_rollup:
+        qs = CapaciteRollup.objects.all()
+        prefix = ""
+        aggregates = rollup_aggregates()
+    else:
+        qs = Infrastructure.objects.all()
+        prefix = "client__"
+        aggregates = {
+            "total_volume": Sum("capacite"),
+            "count": Count("id"),
+            "average_volume": Avg("capacite"),
+        }
+
+    # exact compares the raw column, so the address indexes apply; contains
+    # and fuzzy use the trigram indexes on UPPER()
+    lookup = "exact" if match == "exact" else "icontains"
+    for name in ("avenue", "quartier", "commune", "province"):
+        value = request.query_params.get(name)
+        if value and match == "fuzzy":
+            qs = trigram_filter(qs, f"{prefix}{name}", value)
+        elif value:
+            qs = qs.filter(**{f"{prefix}{name}__{lookup}": value})
+
+    if group_by:
+        column, name = VOLUME_GROUP_BY[group_by]
+        if use_rollup:
+            column = column.removeprefix("client__")
+        columns = [column] if name is None else [name, column]
+        rows = (
+            qs.values(*columns)
+            .annotate(**aggregates)
+            .filter(count__gt=0)
+            .order_by(*columns)
+        )
+        results = []
+        for row in rows:
+            # e.g. {"zone": <nom>, "zone_id": <id>, ...}
+            group = {group_by: row.pop(columns[0])}
+            if name is not None:
+                group[f"{group_by}_id"] = row.pop(column)
+            results.append({**group, **row})
+        return Response(
+            {"group_by": group_by, "results": results}, status=status.HTTP_200_OK
+        )
 
-    if not qs.exists():
+    # A single query: the count tells whether anything matched
+    totals = qs.aggregate(**aggregates)
+    if not totals["count"]:
         return Response(
             {"message": "No infrastructures found matching the criteria"},
             status=status.HTTP_404_NOT_FOUND,
         )
 
-    total_volume = qs.aggregate(total_volume=Sum("capacite"))["total_volume"]
-
-    return Response({"total_volume": total_volume}, status=status.HTTP_200_OK)
+    return Response(totals, status=status.HTTP_200_OK)
 
 
 """Pour l’INFRASTRUCTURE on devra plutôt fournir la date de la construction. Le semestre/trimestre/mois/année pourra être obtenu par requête, par exemple,
@@ -253,6 +641,55 @@ si on veut connaitre le nombre ou volume des citernes construites au 3 e trimest
 """
 
 
+# Accepted values of `bucket` -> truncation of date_construction. Semesters
+# are merged from quarters, there is no semester truncation in SQL.
+VOLUME_BUCKETS = {
+    "month": TruncMonth,
+    "trimester": TruncQuarter,
+    "semester": TruncQuarter,
+    "year": TruncYear,
+}
+
+
+def period_label(period, bucket):
+    if bucket == "month":
+        return f"{period.year}-{period.month:02d}"
+    if bucket == "trimester":
+        return f"{period.year}-T{(period.month - 1) // 3 + 1}"
+    if bucket == "semester":
+        return f"{period.year}-S{1 if period.month <= 6 else 2}"
+    return str(period.year)
+
+
+def volume_series(rows, bucket):
+    """
+    Builds the series of `bucket` periods from rows of (period, count,
+    total_volume) ordered by period, adding the cumulative volume.
+    """
+    series = []
+    for row in rows:
+        period = row["period"]
+        if bucket == "semester":
+            period = period.replace(month=1 if period.month <= 6 else 7)
+        if not series or series[-1]["period"] != period:
+            series.append(
+                {
+                    "period": period,
+                    "label": period_label(period, bucket),
+                    "count": 0,
+                    "total_volume": Decimal(0),
+                }
+            )
+        series[-1]["count"] += row["count"]
+        series[-1]["total_volume"] += row["total_volume"] or 0
+
+    cumulative = Decimal(0)
+    for entry in series:
+        cumulative += entry["total_volume"]
+        entry["cumulative_volume"] = cumulative
+    return series
+
+
 @swagger_auto_schema(
     method="get",
     manual_parameters=[
@@ -294,11 +731,19 @@ si on veut connaitre le nombre ou volume des citernes construites au 3 e trimest
             type=openapi.TYPE_STRING,
             format=openapi.FORMAT_DATE,
         ),
+        openapi.Parameter(
+            name="bucket",
+            in_=openapi.IN_QUERY,
+            description="Return the series of every period of this size "
+            "(count, volume and cumulative volume) instead of a single total",
+            type=openapi.TYPE_STRING,
+            enum=list(VOLUME_BUCKETS),
+        ),
     ],
     responses={
         200: openapi.Response(
             description="Successful response",
-            examples={"application/json": {"total_volume": 2500.00}},
+            examples={"application/json": {"total_volume": 2500.00, "count": 18}},
         ),
         400: openapi.Response(
             description="Bad Request",
@@ -311,12 +756,13 @@ si on veut connaitre le nombre ou volume des citernes construites au 3 e trimest
     },
 )
 @api_view(http_method_names=["GET"])
+@cache_response(*STATS_MODELS)
 def get_volume_by_date(request):
-    qs = Infrastructure.objects.all()
-
-    if not qs.exists():
+    bucket = request.query_params.get("bucket")
+    if bucket is not None and bucket not in VOLUME_BUCKETS:
         return Response(
-            {"message": "No infrastructures found"}, status=status.HTTP_404_NOT_FOUND
+            {"error": f"bucket must be one of: {', '.join(VOLUME_BUCKETS)}"},
+            status=status.HTTP_400_BAD_REQUEST,
         )
 
     # Extract filters
@@ -327,13 +773,46 @@ def get_volume_by_date(request):
     date_from = request.query_params.get("date_from")
     date_to = request.query_params.get("date_to")
 
+    if date_from:
+        try:
+            date_from = datetime.strptime(date_from, "%Y-%m-%d").date()
+        except:
+            return Response(
+                {"error": "date_from must be YYYY-MM-DD"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+    if date_to:
+        try:
+            date_to = datetime.strptime(date_to, "%Y-%m-%d").date()
+        except:
+            return Response(
+                {"error": "date_to must be YYYY-MM-DD"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+    # The rollup counts by construction month: read it unless the date range
+    # cuts through a month
+    use_rollup = (not date_from or date_from.day == 1) and (
+        not date_to or (date_to + timedelta(days=1)).day == 1
+    )
+    if use_rollup:
+        qs = CapaciteRollup.objects.all()
+        field = "month"
+        aggregates = rollup_aggregates()
+        del aggregates["average_volume"]
+    else:
+        qs = Infrastructure.objects.all()
+        field = "date_construction"
+        aggregates = {"total_volume": Sum("capacite"), "count": Count("id")}
+
     # --- YEAR ---
     if year:
-        qs = qs.filter(date_construction__year=year)
+        qs = qs.filter(**{f"{field}__year": year})
 
     # --- MONTH ---
     if month:
-        qs = qs.filter(date_construction__month=month)
+        qs = qs.filter(**{f"{field}__month": month})
 
     # --- TRIMESTER ---
     if trimester:
@@ -344,9 +823,7 @@ def get_volume_by_date(request):
             )
         month_ranges = {1: (1, 3), 2: (4, 6), 3: (7, 9), 4: (10, 12)}
         start, end = month_ranges[trimester]
-        qs = qs.filter(
-            date_construction__month__gte=start, date_construction__month__lte=end
-        )
+        qs = qs.filter(**{f"{field}__month__gte": start, f"{field}__month__lte": end})
 
     # --- SEMESTER ---
     if semester:
@@ -356,35 +833,39 @@ def get_volume_by_date(request):
                 {"error": "semester must be 1 or 2"}, status=status.HTTP_400_BAD_REQUEST
             )
         if semester == 1:
-            qs = qs.filter(date_construction__month__lte=6)
+            qs = qs.filter(**{f"{field}__month__lte": 6})
         else:
-            qs = qs.filter(date_construction__month__gte=7)
+            qs = qs.filter(**{f"{field}__month__gte": 7})
 
     # --- Custom date range ---
     if date_from:
-        try:
-            date_from = datetime.strptime(date_from, "%Y-%m-%d").date()
-        except:
-            return Response(
-                {"error": "date_from must be YYYY-MM-DD"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-        qs = qs.filter(date_construction__gte=date_from)
+        qs = qs.filter(**{f"{field}__gte": date_from})
 
     if date_to:
-        try:
-            date_to = datetime.strptime(date_to, "%Y-%m-%d").date()
-        except:
-            return Response(
-                {"error": "date_to must be YYYY-MM-DD"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-        qs = qs.filter(date_construction__lte=date_to)
+        qs = qs.filter(**{f"{field}__lte": date_to})
+
+    # --- Series: one row per period, from a single GROUP BY ---
+    if bucket:
+        rows = (
+            qs.filter(**{f"{field}__isnull": False})
+            .annotate(period=VOLUME_BUCKETS[bucket](field))
+            .values("period")
+            .annotate(**aggregates)
+            .order_by("period")
+        )
+        return Response(
+            {"bucket": bucket, "results": volume_series(rows, bucket)},
+            status=status.HTTP_200_OK,
+        )
 
-    # Compute the total volume
-    total_volume = qs.aggregate(total_volume=Sum("capacite"))["total_volume"]
+    # Compute the total volume, and the count in the same query
+    totals = qs.aggregate(**aggregates)
+    if not totals["count"] and not request.query_params:
+        return Response(
+            {"message": "No infrastructures found"}, status=status.HTTP_404_NOT_FOUND
+        )
 
-    return Response({"total_volume": total_volume}, status=status.HTTP_200_OK)
+    return Response(totals, status=status.HTTP_200_OK)
 
 
 """
@@ -434,9 +915,8 @@ def get_photos_for_object(request):
             status=status.HTTP_400_BAD_REQUEST,
         )
 
-    try:
-        content_type = ContentType.objects.get(model=model_name.lower())
-    except ContentType.DoesNotExist:
+    content_type = get_photo_content_type(model_name)
+    if content_type is None:
         return Response(
             {"error": f"Invalid model_name: '{model_name}'."},
             status=status.HTTP_404_NOT_FOUND,
@@ -451,11 +931,161 @@ def get_photos_for_object(request):
             status=status.HTTP_404_NOT_FOUND,
         )
 
-    photos = Photo.objects.filter(content_type=content_type, object_id=object_id)
+    photos = prefetch_photo_objects(
+        Photo.objects.filter(content_type=content_type, object_id=object_id)
+    )
     serializer = PhotoSerializer(photos, many=True, context={"request": request})
     return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+def parse_photo_objects(params):
+    """
+    Returns the (ContentType, object id) pairs named by `params`, in order
+    and without duplicates, from `model_name` and `object_ids=1,2` or
+    from `objects=infrastructure:1,bailleur:2`.
+    """
+    if params.get("objects"):
+        items = [
+            item.partition(":")[::2]
+            for item in params["objects"].split(",")
+            if item.strip()
+        ]
+    elif params.get("model_name") and params.get("object_ids"):
+        items = [
+            (params["model_name"], object_id)
+            for object_id in params["object_ids"].split(",")
+            if object_id.strip()
+        ]
+    else:
+        raise ValueError(
+            "`objects`, or `model_name` and `object_ids`, query parameters are "
+            "required."
+        )
+
+    if len(items) > MAX_PHOTO_OBJECTS:
+        raise ValueError(f"At most {MAX_PHOTO_OBJECTS} objects per request.")
+
+    pairs = {}
+    for model_name, object_id in items:
+        content_type = get_photo_content_type(model_name.strip())
+        if content_type is None:
+            raise ValueError(f"Invalid model_name: '{model_name}'.")
+        try:
+            object_id = int(object_id.strip())
+        except ValueError:
+            raise ValueError(f"Invalid object id: '{object_id}'.")
+        pairs[(content_type, object_id)] = None
+    return list(pairs)
+
+
+@swagger_auto_schema(
+    method="get",
+    manual_parameters=[
+        openapi.Parameter(
+            "objects",
+            openapi.IN_QUERY,
+            required=False,
+            description="Objects of any models as model:id pairs, e.g. "
+            "'infrastructure:12,bailleur:3'",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "model_name",
+            openapi.IN_QUERY,
+            required=False,
+            description="Model of the objects listed in object_ids "
+            "('infrastructure', 'bailleur', 'zonecontributive', 'inspection')",
+            type=openapi.TYPE_STRING,
+        ),
+        openapi.Parameter(
+            "object_ids",
+            openapi.IN_QUERY,
+            required=False,
+            description="Comma-separated ids of objects of model_name",
+            type=openapi.TYPE_STRING,
+        ),
+    ],
+    responses={
+        200: openapi.Response(
+            description="Photos of each object, in the order requested",
+            examples={
+                "application/json": {
+                    "results": [
+                        {"model_name": "infrastructure", "object_id": 12, "photos": []}
+                    ]
+                }
+            },
+        ),
+        400: "Bad Request - Missing or invalid parameters.",
+    },
+)
+@api_view(http_method_names=["GET"])
+def get_photos_for_objects(request):
+    """
+    Retrieves the photos of many objects at once, grouped by object. An
+    object that doesn't exist has no photos.
+    """
+    try:
+        pairs = parse_photo_objects(request.query_params)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    grouped = photos_by_object(pairs)
+    results = [
+        {
+            "model_name": content_type.model,
+            "object_id": object_id,
+            "photos": PhotoSerializer(
+                grouped[(content_type, object_id)],
+                many=True,
+                context={"request": request},
+            ).data,
+        }
+        for content_type, object_id in pairs
+    ]
+    return Response({"results": results}, status=status.HTTP_200_OK)
+
+
+"""
+Exemple:
+/api/v1/tiles/infrastructures/12/2165/2071.mvt
+/api/v1/tiles/zones/10/541/517.mvt
+/api/v1/tiles/shapefiles/10/541/517.mvt
+"""
+
+
+@swagger_auto_schema(
+    method="get",
+    responses={
+        200: "Mapbox Vector Tile (application/vnd.mapbox-vector-tile)",
+        400: "Bad Request - Invalid tile coordinates.",
+        404: "Not Found - Unknown layer.",
+    },
+)
+@api_view(http_method_names=["GET"])
+@throttle_classes([])
+def get_vector_tile(request, layer, z, x, y):
+    """
+    Serves one vector tile of `layer` (infrastructures, zones or shapefiles).
+    Map clients load many tiles per view, so tiles are not throttled.
+    """
+    if layer not in TILE_LAYERS:
+        return Response(
+            {"error": f"Unknown layer: '{layer}'."},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+
+    if not valid_tile(z, x, y):
+        return Response(
+            {"error": f"Invalid tile coordinates: {z}/{x}/{y}."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    return HttpResponse(
+        get_tile(layer, z, x, y), content_type="application/vnd.mapbox-vector-tile"
+    )
+
+
 class UploadShapefileViewSet(viewsets.ModelViewSet):
     serializer_class = ShpSerializer
     queryset = Shp.objects.all()
@@ -465,6 +1095,17 @@ class UploadShapefileViewSet(viewsets.ModelViewSet):
     def create(self, request):
         uploaded_zip = request.FILES.get("file")
         description = request.data.get("description", "")
+        zone_id = request.data.get("zone_id")
+
+        zone = None
+        if zone_id:
+            try:
+                zone = ZoneContributive.objects.get(pk=zone_id)
+            except (ZoneContributive.DoesNotExist, ValueError):
+                return Response(
+                    {"error": f"Zone contributive {zone_id} not found"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
 
         if not uploaded_zip:
             return Response(
@@ -478,116 +1119,96 @@ class UploadShapefileViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # 1. Save the zip temporarily
-        with tempfile.TemporaryDirectory() as tmpdir:
-            zip_path = os.path.join(tmpdir, uploaded_zip.name)
-
-            # Save temporarily
-            with open(zip_path, "wb+") as destination:
-                for chunk in uploaded_zip.chunks():
-                    destination.write(chunk)
-
-            # 2. Extract ZIP
-            with zipfile.ZipFile(zip_path, "r") as zip_ref:
-                zip_ref.extractall(tmpdir)
-
-            # 3. Find the .shp file
-            shp_files = [f for f in glob.glob(f"{tmpdir}/**/*.shp", recursive=True)]
-
-            if not shp_files:
-                return Response(
-                    {"error": "No .shp file found inside the ZIP"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+        # 1. Check that the archive holds a .shp, from its central directory
+        # only: nothing is extracted or copied
+        try:
+            find_shp(uploaded_zip)
+        except ShapefileError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        uploaded_zip.seek(0)
+
+        # 2. Save record for uploaded shapefile, which stores the upload once
+        # in its final location. The post_save signal queues its ingest: a
+        # worker reads it once, loads its features into ShpFeature and
+        # stores its bbox, feature count, CRS and GeoJSON artifact.
+        shp_record = Shp(
+            name=uploaded_zip.name,
+            description=description,
+            file=uploaded_zip,  # <-- THIS line saves to media/shapefiles/YYYY/MM/DD/
+        )
 
-            # shp_path = shp_files[0]
+        try:
+            # The record, its zone and its job are committed together
+            with transaction.atomic():
+                shp_record.save()
+                # 3. Link the zone contributive, drawn with the features
+                if zone is not None:
+                    zone.shapefile_id = shp_record
+                    zone.save(update_fields=["shapefile_id", "updated_at"])
+                job = enqueue_ingest(shp_record)
+        except Exception as e:
+            # DELETE MEDIA FILE
+            if shp_record.file:
+                shp_record.file.delete(save=False)
+
+            # DELETE DB RECORD
+            if shp_record.pk:
+                shp_record.delete()
 
-            # 4. Save record for uploaded shapefile
-            shp_record = Shp.objects.create(
-                name=uploaded_zip.name,
-                description=description,
-                file=uploaded_zip,  # <-- THIS line saves to media/shapefiles/YYYY/MM/DD/
+            return Response(
+                {"error": f"Failed to import shapefile: {str(e)}"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-            # # 5. Import using LayerMapping
-            # mapping = {
-            #     # "nom": "NAME",
-            #     "geom": "Geometry",
-            # }
-
-            # try:
-            #     lm = LayerMapping(ZoneContributive, shp_path, mapping, transform=True)
-            #     lm.save(strict=True, verbose=True)
-
-            # except Exception as e:
-            #     # DELETE MEDIA FILE
-            #     if shp_record.file:
-            #         shp_record.file.delete(save=False)
+        return Response(
+            {
+                "message": f"Shapefile uploaded, import queued: {shp_record.name}, shapefile_id: {shp_record.id}",
+                "shapefile_id": shp_record.id,
+                "job": job.id,
+            },
+            status=status.HTTP_202_ACCEPTED,
+        )
 
-            #     # DELETE DB RECORD
-            #     shp_record.delete()
+    def get_serializer_class(self):
+        if self.action == "list":
+            return ShpMetadataSerializer
+        return super().get_serializer_class()
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                "inline",
+                openapi.IN_QUERY,
+                required=False,
+                description="Return every shapefile with all its features inline (not paginated)",
+                type=openapi.TYPE_BOOLEAN,
+            ),
+        ],
+    )
+    def list(self, request):
+        if request.query_params.get("inline", "").lower() in ("1", "true", "yes"):
+            return self.list_inline(request)
 
-            #     return Response(
-            #         {"error": f"Failed to import shapefile: {str(e)}"},
-            #         status=status.HTTP_400_BAD_REQUEST,
-            #     )
+        # Metadata only, paginated; features come from /shps/{id}/features/
+        page = self.paginate_queryset(self.get_queryset())
+        for shp in page:
+            self.pending_ingest(shp)
 
-            return Response(
-                {
-                    "message": f"Shapefile imported successfully: {shp_record.name}, shapefile_id: {shp_record.id}"
-                },
-                status=status.HTTP_201_CREATED,
-            )
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
-    def list(self, request):
+    def list_inline(self, request):
         data = []
 
-        for shp in self.queryset:
-            file_path = shp.file.path
+        for shp in self.get_queryset():
             bbox = None
             featurecollection = None
 
-            # Extract if ZIP
-            with tempfile.TemporaryDirectory() as tmpdir:
-                if file_path.endswith(".zip"):
-                    with zipfile.ZipFile(file_path, "r") as z:
-                        z.extractall(tmpdir)
-                    shp_files = glob.glob(f"{tmpdir}/**/*.shp", recursive=True)
-                    if not shp_files:
-                        data.append(
-                            {
-                                "id": shp.id,
-                                "name": shp.name,
-                                "description": shp.description,
-                                "uploaded_date": shp.uploaded_date,
-                                "bbox": None,
-                                "featurecollection": None,
-                            }
-                        )
-                        continue
-                    shp_path = shp_files[0]
-                else:
-                    shp_path = file_path
-
-                # 2. Read shapefile → bbox + features
-                with fiona.open(shp_path) as src:
-                    bbox = list(src.bounds)
-
-                    features = [
-                        {
-                            "type": "Feature",
-                            "geometry": f["geometry"],
-                            "properties": f["properties"],
-                        }
-                        for f in src
-                    ]
-
-                    featurecollection = {
-                        "type": "FeatureCollection",
-                        "features": features,
-                    }
+            if self.pending_ingest(shp) is None and shp.geojson:
+                bbox = shp.bbox
+                with shp.geojson.open("rb") as fh:
+                    featurecollection = json.load(fh)
 
-            # 3. Append to response list
             data.append(
                 {
                     "id": shp.id,
@@ -601,6 +1222,80 @@ class UploadShapefileViewSet(viewsets.ModelViewSet):
 
         return Response(data, status=status.HTTP_200_OK)
 
+    def pending_ingest(self, shp):
+        """
+        Returns None once the artifacts of `shp` are built. Otherwise queues
+        their build (rows uploaded before the ingest pipeline existed are
+        built on first access) and returns the response to send meanwhile.
+        """
+        if not artifacts_outdated(shp):
+            return None
+        job = enqueue_ingest(shp)
+        if job.status == "failed":
+            return Response(
+                {"error": job.message, "job": job.id},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(
+            {"message": "The shapefile is being imported", "job": job.id},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                "limit",
+                openapi.IN_QUERY,
+                required=False,
+                description="Number of features to return per page",
+                type=openapi.TYPE_INTEGER,
+            ),
+            openapi.Parameter(
+                "offset",
+                openapi.IN_QUERY,
+                required=False,
+                description="Index of the first feature to return",
+                type=openapi.TYPE_INTEGER,
+            ),
+            openapi.Parameter(
+                "cursor",
+                openapi.IN_QUERY,
+                required=False,
+                description="Feature id to resume from (count-free paging)",
+                type=openapi.TYPE_INTEGER,
+            ),
+        ],
+    )
+    @action(detail=True, methods=["get"], url_path="features")
+    def features(self, request, pk=None):
+        shp = self.get_object()
+        pending = self.pending_ingest(shp)
+        if pending is not None:
+            return pending
+        if not shp.geojson:
+            return Response(
+                {"error": "No .shp file found inside the ZIP"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        paginator = FeaturePagination()
+        page = paginator.paginate_queryset(
+            shp.features.order_by("fid"), request, view=self
+        )
+        serializer = ShpFeatureSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                "stream",
+                openapi.IN_QUERY,
+                required=False,
+                description="Stream the features one at a time instead of serving the stored file",
+                type=openapi.TYPE_BOOLEAN,
+            ),
+        ],
+    )
     @action(detail=True, methods=["get"], url_path="export")
     def export_geojson(self, request, pk=None):
         try:
@@ -610,42 +1305,31 @@ class UploadShapefileViewSet(viewsets.ModelViewSet):
                 {"error": "Shapefile not found"}, status=status.HTTP_404_NOT_FOUND
             )
 
-        file_path = shp.file.path
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # If zipped
-            if file_path.endswith(".zip"):
-                with zipfile.ZipFile(file_path, "r") as z:
-                    z.extractall(tmpdir)
-                shp_files = glob.glob(f"{tmpdir}/**/*.shp", recursive=True)
-                if not shp_files:
-                    return Response(
-                        {"error": "No .shp inside ZIP"},
-                        status=status.HTTP_400_BAD_REQUEST,
-                    )
-                shp_path = shp_files[0]
-            else:
-                shp_path = file_path
-
-            # Read & convert to GeoJSON
-            with fiona.open(shp_path) as src:
-                features = [
-                    {
-                        "type": "Feature",
-                        "geometry": f["geometry"],
-                        "properties": f["properties"],
-                    }
-                    for f in src
-                ]
-
-                geojson_data = {"type": "FeatureCollection", "features": features}
-
-            # Prepare downloadable file
-            response = HttpResponse(
-                json.dumps(geojson_data), content_type="application/geo+json"
+        pending = self.pending_ingest(shp)
+        if pending is not None:
+            return pending
+        if not shp.geojson:
+            return Response(
+                {"error": "No .shp file found inside the ZIP"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if request.query_params.get("stream", "").lower() in ("1", "true", "yes"):
+            # Header, then one feature at a time from a server-side cursor,
+            # then the footer: memory stays flat whatever the size of the layer
+            response = StreamingHttpResponse(
+                stream_featurecollection(shp),
+                content_type="application/geo+json",
             )
             response["Content-Disposition"] = (
                 f'attachment; filename="{shp.name}.geojson"'
             )
-
             return response
+
+        # Serve the stored GeoJSON artifact as a downloadable file
+        return FileResponse(
+            shp.geojson.open("rb"),
+            as_attachment=True,
+            filename=f"{shp.name}.geojson",
+            content_type="application/geo+json",
+        )
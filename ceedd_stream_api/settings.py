@@ -46,12 +46,14 @@ DJANGO_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "django.contrib.gis",
+    "django.contrib.postgres",
 ]
 
 THIRD_PARTY_APPS = [
     "leaflet",
     "rest_framework",
     "rest_framework_gis",
+    "django_filters",
     "corsheaders",
     "drf_yasg",
 ]
@@ -150,6 +152,9 @@ USE_TZ = True
 # Media files
 MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_URL = "/media/"
+# Hosts photo URLs outside MEDIA_URL may be downloaded from to build their
+# renditions, as in ALLOWED_HOSTS (".example.com" matches subdomains)
+PHOTO_SOURCE_HOSTS = config("PHOTO_SOURCE_HOSTS", default="", cast=Csv())
 
 # Static files
 STATIC_URL = "static/"
@@ -171,6 +176,19 @@ STORAGES = {
 }
 
 
+# Cache shared by all gunicorn workers (vector tiles, statistics); the data
+# versions keying them are kept in the database (see ceedd_stream/cache.py)
+CACHES = {
+    "default": {
+        "BACKEND": config(
+            "CACHE_BACKEND",
+            default="django.core.cache.backends.filebased.FileBasedCache",
+        ),
+        "LOCATION": config("CACHE_LOCATION", default=str(BASE_DIR / ".cache")),
+    }
+}
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
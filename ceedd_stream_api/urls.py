@@ -13,6 +13,7 @@ from ceedd_stream.views import (
     get_volume_by_date,
     get_volume_by_filters,
     get_photos_for_object,
+    get_photos_for_objects,
 )
 from rest_framework_simplejwt.views import TokenRefreshView
 
@@ -62,4 +63,9 @@ urlpatterns += [
         get_photos_for_object,
         name="get_photos_for_object",
     ),
+    path(
+        "api/photos/by_objects/",
+        get_photos_for_objects,
+        name="get_photos_for_objects",
+    ),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)